@@ -17,6 +17,7 @@ class InvoiceGenerator:
         root = ET.Element("InvoicesDoc", {
             "xmlns": "http://www.aade.gr/myDATA/invoice/v1.0",
             "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+            "xmlns:icls": "https://www.aade.gr/myDATA/incomeClassificaton/v1.0",
             "xsi:schemaLocation": "http://www.aade.gr/myDATA/invoice/v1.0/InvoicesDoc-v0.6.xsd"
         })
         
@@ -43,6 +44,8 @@ class InvoiceGenerator:
         ET.SubElement(header, "issueDate").text = invoice.issue_date.strftime("%Y-%m-%d")
         ET.SubElement(header, "invoiceType").text = invoice.invoice_type.value
         ET.SubElement(header, "currency").text = invoice.currency
+        for mark in invoice.correlated_invoices:
+            ET.SubElement(header, "correlatedInvoices").text = str(mark)
         
         # Payment details
         payment = ET.SubElement(invoice_elem, "paymentMethods")
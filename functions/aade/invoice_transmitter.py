@@ -1,19 +1,29 @@
+import concurrent.futures
 import os
-import httpx
+import xml.etree.ElementTree as ET
 from aade.types import AADEInvoice
 from aade.invoice_generator import InvoiceGenerator
+from aade.runtime import AADE_HTTP_TIMEOUT_SEC, get_runtime
+from aade.validation import validate_invoice_xml
+from telemetry import registry
 
 class InvoiceTransmitter:
     """Transmits invoices to AADE myDATA."""
     
     PROD_URL = "https://mydatapi.aade.gr/myDATA/SendInvoices"
     DEV_URL = "https://mydata-dev.azure-api.net/SendInvoices"
+    PROD_CANCEL_URL = "https://mydatapi.aade.gr/myDATA/CancelInvoice"
+    DEV_CANCEL_URL = "https://mydata-dev.azure-api.net/CancelInvoice"
+    SYNC_TIMEOUT_SEC = 3 * AADE_HTTP_TIMEOUT_SEC
     
     def __init__(self):
         self.user_id = os.environ.get("AADE_USER_ID")
         self.subscription_key = os.environ.get("AADE_SUBSCRIPTION_KEY")
         self.env = os.environ.get("AADE_ENVIRONMENT", "development")
         self.url = self.PROD_URL if self.env == "production" else self.DEV_URL
+        self.cancel_url = self.PROD_CANCEL_URL if self.env == "production" else self.DEV_CANCEL_URL
+        # Check generated XML against the myDATA XSD before sending (see aade/validation.py)
+        self.validate_xml = os.environ.get("AADE_VALIDATE_XML", "true").lower() == "true"
         
         if not self.user_id or not self.subscription_key:
             print("Notice: AADE credentials missing. Running in MOCK/DEV mode (Logging only).")
@@ -26,6 +36,17 @@ class InvoiceTransmitter:
         
         # 1. Generate XML
         xml_content = InvoiceGenerator.generate_xml(invoice)
+
+        # 1b. Reject documents AADE would reject anyway, without the round trip
+        if self.validate_xml:
+            errors = validate_invoice_xml(xml_content)
+            if errors:
+                registry.counter("aade.xml_rejected").inc()
+                return {
+                    "success": False,
+                    "error": "XSD validation failed: " + "; ".join(errors),
+                    "validation_errors": errors,
+                }
         
         # 2a. Check Mock Mode
         if self.mock_mode:
@@ -40,39 +61,90 @@ class InvoiceTransmitter:
             }
 
         # 2. Prepare headers
-        headers = {
+        headers = self._headers()
+        
+        # 3. Send (shared client on the AADE runtime loop; see aade/runtime.py)
+        client = get_runtime().http_client()
+        response = await client.post(
+            self.url,
+            content=xml_content,
+            headers=headers
+        )
+
+        # 4. Parse response
+        if response.status_code == 200:
+            result = self.parse_response(response.text)
+            result["xml_sent"] = xml_content
+            return result
+        else:
+            return {
+                "success": False,
+                "error": response.text,
+                "status": response.status_code
+            }
+
+    async def cancel_invoice(self, mark: int) -> dict:
+        """Cancels a previously transmitted invoice by its MARK."""
+        if self.mock_mode:
+            print(f"--- [AADE MOCK MODE] WOULD CANCEL MARK {mark} ---")
+            return {"success": True, "cancellation_mark": f"MOCK-CANCEL-{mark}"}
+
+        client = get_runtime().http_client()
+        response = await client.post(self.cancel_url, params={"mark": str(mark)}, headers=self._headers())
+        if response.status_code != 200:
+            return {"success": False, "error": response.text, "status": response.status_code}
+        return self.parse_response(response.text)
+
+    def _headers(self) -> dict:
+        return {
             "aade-user-id": self.user_id,
             "Ocp-Apim-Subscription-Key": self.subscription_key,
             "Content-Type": "application/xml"
         }
+
+    @staticmethod
+    def parse_response(text: str) -> dict:
+        """Parses a myDATA ResponseDoc (first response element)."""
+        try:
+            root = ET.fromstring(text)
+        except ET.ParseError:
+            return {"success": False, "error": f"Unparseable AADE response: {text[:200]}"}
         
-        # 3. Send
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                self.url,
-                content=xml_content,
-                headers=headers
-            )
-            
-            # 4. Parse response (Simplified)
-            if response.status_code == 200:
-                # Need to parse XML response to get UID/MARK
-                # For now returning raw text
-                return {
-                    "success": True,
-                    "response": response.text,
-                    "xml_sent": xml_content
-                }
-            else:
-                return {
-                    "success": False,
-                    "error": response.text,
-                    "status": response.status_code
-                }
+        # Responses may or may not be namespaced; match on local names
+        values = {}
+        errors = []
+        for elem in root.iter():
+            tag = elem.tag.rsplit("}", 1)[-1]
+            if tag == "message" and elem.text:
+                errors.append(elem.text)
+            elif tag not in values and elem.text and elem.text.strip():
+                values[tag] = elem.text.strip()
+
+        success = values.get("statusCode") == "Success"
+        result = {
+            "success": success,
+            "status_code": values.get("statusCode"),
+            "mark": int(values["invoiceMark"]) if values.get("invoiceMark", "").isdigit() else None,
+            "uid": values.get("invoiceUid"),
+            "response": text,
+        }
+        if "cancellationMark" in values:
+            result["cancellation_mark"] = values["cancellationMark"]
+        if not success:
+            result["error"] = "; ".join(errors) or values.get("statusCode") or text[:200]
+        return result
+
+    def submit_invoice(self, invoice: AADEInvoice) -> concurrent.futures.Future:
+        """Starts transmission on the AADE runtime loop; the future resolves to the result dict."""
+        return get_runtime().submit(self.transmit_invoice(invoice))
+
+    def submit_cancellation(self, mark: int) -> concurrent.futures.Future:
+        return get_runtime().submit(self.cancel_invoice(mark))
 
     def submit_invoice_sync(self, invoice: AADEInvoice) -> dict:
         """Synchronous wrapper for Cloud Functions."""
-        import asyncio
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return loop.run_until_complete(self.transmit_invoice(invoice))
+        return self.submit_invoice(invoice).result(timeout=self.SYNC_TIMEOUT_SEC)
+
+    def cancel_invoice_sync(self, mark: int) -> dict:
+        """Synchronous wrapper for cancel_invoice."""
+        return self.submit_cancellation(mark).result(timeout=self.SYNC_TIMEOUT_SEC)
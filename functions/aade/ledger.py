@@ -0,0 +1,64 @@
+from typing import Any, Dict, List, Optional
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from aade.types import AADEInvoice, InvoiceType
+
+
+class InvoiceLedger:
+    """
+    Firestore record of every invoice we transmitted (or tried to) to AADE.
+    One document per invoice in 'aade_invoices', keyed by the invoice uid.
+    Used to find the MARK of an order's invoice for credit notes and cancellations.
+    """
+
+    COLLECTION = "aade_invoices"
+
+    def __init__(self, db=None):
+        self.db = db or firestore.client()
+
+    def record(self, invoice: AADEInvoice, order_id: Any, result: Dict[str, Any],
+               order_name: Optional[str] = None, source_topic: Optional[str] = None) -> Dict[str, Any]:
+        entry = {
+            "uid": invoice.uid,
+            "order_id": str(order_id),
+            "order_name": order_name,
+            "source_topic": source_topic,
+            "invoice_type": invoice.invoice_type.value,
+            "series": invoice.series,
+            "aa": invoice.aa,
+            "issue_date": invoice.issue_date.isoformat() if invoice.issue_date else None,
+            "currency": invoice.currency,
+            "total_net_value": round(invoice.summary.total_net_value, 2),
+            "total_vat_amount": round(invoice.summary.total_vat_amount, 2),
+            "total_gross_value": round(invoice.summary.total_gross_value, 2),
+            "counterpart_vat": invoice.counterpart.vat_number if invoice.counterpart else None,
+            "counterpart_country": invoice.counterpart.country if invoice.counterpart else None,
+            "correlated_invoices": list(invoice.correlated_invoices),
+            "status": "transmitted" if result.get("success") else "failed",
+            "mark": result.get("mark"),
+            "aade_uid": result.get("uid"),
+            "error": result.get("error"),
+            "created_at": firestore.SERVER_TIMESTAMP,
+        }
+        self.db.collection(self.COLLECTION).document(invoice.uid).set(entry)
+        return entry
+
+    def find_for_order(self, order_id: Any, invoice_types: Optional[List[InvoiceType]] = None,
+                       status: str = "transmitted") -> List[Dict[str, Any]]:
+        query = (self.db.collection(self.COLLECTION)
+                 .where(filter=FieldFilter("order_id", "==", str(order_id)))
+                 .where(filter=FieldFilter("status", "==", status)))
+        entries = [doc.to_dict() for doc in query.get()]
+        if invoice_types:
+            wanted = {t.value for t in invoice_types}
+            entries = [e for e in entries if e.get("invoice_type") in wanted]
+        return entries
+
+    def mark_cancelled(self, uid: str, cancellation_mark: Any):
+        self.db.collection(self.COLLECTION).document(uid).update({
+            "status": "cancelled",
+            "cancellation_mark": cancellation_mark,
+            "cancelled_at": firestore.SERVER_TIMESTAMP,
+        })
@@ -0,0 +1,353 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+from firebase_functions import scheduler_fn
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from aade.runtime import on_shutdown
+from aade.types import AADEInvoice, InvoiceType
+from telemetry import registry, span, traced
+
+# Invoice Numbering (series / aa)
+# myDATA identifies a document by issuer, type, series and number (aa), so
+# each (series, invoice type) pair is its own sequence. A single counter
+# document per sequence would allow ~1 write/s, so instead each instance
+# leases a block of numbers in one transaction on 'aade_sequences/{key}'
+# and hands them out from memory. Block size adapts to the issue rate
+# (about NUMBER_BLOCK_TARGET_SEC worth of numbers, within min/max), so a
+# busy instance takes one transaction per hundred invoices or so.
+# Every block is recorded under 'aade_sequences/{key}/leases'. When a block
+# is given up part-way (retired for age, instance shutting down), its unused
+# tail goes back to the sequence if no block was leased after it, so the
+# next lease starts where it stopped. Only numbers that cannot be handed
+# back, because a later block was already leased or the instance died with
+# them, are written to 'aade_sequences/{key}/gaps' for audit;
+# audit_invoice_number_gaps finds leases abandoned by dead instances and
+# checks them against the invoice ledger. Numbers AADE rejected are
+# recorded there too (reason "rejected"): a retried order gets a new one.
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_COLLECTION = "aade_sequences"
+FIRST_NUMBER = 1
+
+# Series per document type; AADE_SERIES may override it with JSON, e.g. {"11.1": "R"}
+SERIES = {
+    InvoiceType.SALES_INVOICE.value: "A",
+    InvoiceType.SERVICE_INVOICE.value: "A",
+    InvoiceType.RETAIL_RECEIPT.value: "A",
+    InvoiceType.CREDIT_NOTE.value: "CN",
+    InvoiceType.RETAIL_CREDIT_NOTE.value: "CN",
+}
+SERIES.update(json.loads(os.environ.get("AADE_SERIES", "{}")))
+
+NUMBER_BLOCK_MIN = int(os.environ.get("AADE_NUMBER_BLOCK_MIN", "10"))
+NUMBER_BLOCK_MAX = int(os.environ.get("AADE_NUMBER_BLOCK_MAX", "100"))
+NUMBER_BLOCK_TARGET_SEC = 60.0
+# A block older than this is retired even if unused numbers remain, so numbers
+# issued by different instances stay roughly in issue-date order
+NUMBER_LEASE_MAX_AGE_SEC = float(os.environ.get("AADE_NUMBER_LEASE_MAX_AGE_SEC", "3600"))
+LEDGER_IN_LIMIT = 30      # values per Firestore 'in' filter
+
+
+def sequence_key(series: str, invoice_type: str) -> str:
+    return f"{series}-{invoice_type}"
+
+
+@dataclass
+class NumberLease:
+    key: str
+    series: str
+    invoice_type: str
+    start: int
+    end: int            # exclusive
+    next: int
+    acquired_at: float
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.next
+
+    @property
+    def lease_id(self) -> str:
+        return f"{self.start:012d}"
+
+
+def _reserve_block(transaction, sequence_ref, lease_ref_of, series: str, invoice_type: str,
+                   size: int, owner: str) -> Tuple[int, int]:
+    snapshot = sequence_ref.get(transaction=transaction)
+    start = (snapshot.get("next") if snapshot.exists else None) or FIRST_NUMBER
+    end = start + size
+    transaction.set(sequence_ref, {
+        "series": series,
+        "invoice_type": invoice_type,
+        "next": end,
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+    transaction.set(lease_ref_of(start), {
+        "start": start,
+        "end": end,
+        "owner": owner,
+        "state": "active",
+        "acquired_at": time.time(),
+    })
+    return start, end
+
+
+def _return_tail(transaction, sequence_ref, lease_ref, first: int, end: int,
+                 settled: Dict[str, Any]) -> Optional[bool]:
+    """
+    Settles an active lease whose numbers from `first` on were never issued.
+    If no block was leased after it (the sequence's next is still its end),
+    those numbers go back to the sequence and the lease is shrunk to end at
+    `first`. Returns whether they were handed back, or None if the lease was
+    already settled elsewhere (e.g. by the audit).
+    """
+    entry = lease_ref.get(transaction=transaction)
+    if not entry.exists or entry.get("state") != "active":
+        return None
+    sequence = sequence_ref.get(transaction=transaction)
+    handed_back = first < end and sequence.exists and sequence.get("next") == end
+    if handed_back:
+        transaction.update(sequence_ref, {"next": first, "updated_at": firestore.SERVER_TIMESTAMP})
+    transaction.update(lease_ref, dict(settled, end=first if handed_back else end, closed_at=time.time()))
+    return handed_back
+
+
+class NumberAllocator:
+    """Hands out (series, aa) per invoice type from leased blocks; thread-safe."""
+
+    def __init__(self, db=None, owner: Optional[str] = None,
+                 block_min: int = NUMBER_BLOCK_MIN, block_max: int = NUMBER_BLOCK_MAX,
+                 max_age_sec: float = NUMBER_LEASE_MAX_AGE_SEC):
+        self.db = db or firestore.client()
+        self.owner = owner or f"{os.environ.get('K_REVISION', 'local')}-{uuid.uuid4().hex[:8]}"
+        self.block_min = block_min
+        self.block_max = block_max
+        self.max_age_sec = max_age_sec
+        self._leases: Dict[str, NumberLease] = {}
+        self._block_size: Dict[str, int] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _sequence_ref(self, key: str):
+        return self.db.collection(SEQUENCE_COLLECTION).document(key)
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def next_number(self, invoice_type: InvoiceType) -> Tuple[str, str]:
+        series = SERIES.get(invoice_type.value, "A")
+        key = sequence_key(series, invoice_type.value)
+        with self._key_lock(key):
+            lease = self._leases.get(key)
+            if lease is not None and time.time() - lease.acquired_at > self.max_age_sec:
+                self._retire(lease, "expired")
+                lease = None
+            if lease is None or lease.remaining <= 0:
+                lease = self._lease(key, series, invoice_type.value)
+            number = lease.next
+            lease.next += 1
+            if lease.remaining <= 0:
+                self._close(lease)
+        registry.counter("aade.numbers_issued").inc()
+        return series, str(number)
+
+    def assign(self, invoice: AADEInvoice) -> AADEInvoice:
+        invoice.series, invoice.aa = self.next_number(invoice.invoice_type)
+        return invoice
+
+    # --- Leases ---
+
+    def _adapt_block_size(self, lease: NumberLease):
+        """Next block for this sequence covers about NUMBER_BLOCK_TARGET_SEC at the rate this one was used."""
+        elapsed = max(time.time() - lease.acquired_at, 1e-3)
+        size = int((lease.next - lease.start) / elapsed * NUMBER_BLOCK_TARGET_SEC)
+        self._block_size[lease.key] = max(self.block_min, min(self.block_max, size))
+
+    def _lease(self, key: str, series: str, invoice_type: str) -> NumberLease:
+        size = self._block_size.get(key, self.block_min)
+        sequence_ref = self._sequence_ref(key)
+        leases = sequence_ref.collection("leases")
+        with span("aade.number_lease", sequence=key, size=size):
+            start, end = firestore.transactional(_reserve_block)(
+                self.db.transaction(), sequence_ref, lambda n: leases.document(f"{n:012d}"),
+                series, invoice_type, size, self.owner)
+        registry.counter("aade.number_leases").inc()
+        lease = NumberLease(key, series, invoice_type, start, end, start, time.time())
+        self._leases[key] = lease
+        logger.info(f"Leased {key} numbers {start}-{end - 1} for {self.owner}")
+        return lease
+
+    def _close(self, lease: NumberLease):
+        """Every number in the block was issued."""
+        self._leases.pop(lease.key, None)
+        self._adapt_block_size(lease)
+        try:
+            self._sequence_ref(lease.key).collection("leases").document(lease.lease_id).update(
+                {"state": "used", "closed_at": time.time()})
+        except Exception as e:
+            logger.warning(f"Could not close number lease {lease.key}/{lease.lease_id}: {e}")
+
+    def _retire(self, lease: NumberLease, reason: str):
+        """
+        Gives up the rest of a block: its unissued numbers are handed back to
+        the sequence if no later block was leased, else they become an audited gap.
+        """
+        self._leases.pop(lease.key, None)
+        self._adapt_block_size(lease)
+        try:
+            sequence_ref = self._sequence_ref(lease.key)
+            handed_back = firestore.transactional(_return_tail)(
+                self.db.transaction(), sequence_ref, sequence_ref.collection("leases").document(lease.lease_id),
+                lease.next, lease.end, {"state": "released", "issued": lease.next - lease.start})
+            if handed_back:
+                registry.counter("aade.numbers_handed_back").inc(lease.remaining)
+                logger.info(f"Handed {lease.key} numbers {lease.next}-{lease.end - 1} back ({reason})")
+            elif handed_back is False and lease.remaining > 0:
+                record_gap(sequence_ref, lease.series, lease.invoice_type, lease.next, lease.end - 1, reason)
+        except Exception as e:
+            logger.warning(f"Could not release number lease {lease.key}/{lease.lease_id}: {e}")
+
+    def release_all(self, reason: str = "shutdown"):
+        for lease in list(self._leases.values()):
+            with self._key_lock(lease.key):
+                if self._leases.get(lease.key) is lease:
+                    self._retire(lease, reason)
+
+
+def record_gap(sequence_ref, series: str, invoice_type: str, first: int, last: int, reason: str):
+    registry.counter("aade.number_gaps").inc(last - first + 1)
+    sequence_ref.collection("gaps").document(f"{first:012d}").set({
+        "series": series,
+        "invoice_type": invoice_type,
+        "first": first,
+        "last": last,
+        "count": last - first + 1,
+        "reason": reason,
+        "recorded_at": firestore.SERVER_TIMESTAMP,
+    })
+    logger.warning(f"Invoice numbers {series}/{invoice_type} {first}-{last} were never issued ({reason})")
+
+
+def record_rejected(invoice: AADEInvoice, error: Any = None):
+    """
+    An invoice AADE did not accept keeps its number out of the series (a
+    retry is numbered again), so the number is recorded as a gap.
+    """
+    try:
+        sequence_ref = firestore.client().collection(SEQUENCE_COLLECTION).document(
+            sequence_key(invoice.series, invoice.invoice_type.value))
+        number = int(invoice.aa)
+        record_gap(sequence_ref, invoice.series, invoice.invoice_type.value, number, number, "rejected")
+    except Exception as e:
+        logger.error(f"Could not record rejected invoice number {invoice.series}/{invoice.aa} "
+                     f"({invoice.uid}, {error}) as a gap: {e}")
+
+
+_allocator: Optional[NumberAllocator] = None
+_allocator_lock = threading.Lock()
+
+
+def get_allocator() -> NumberAllocator:
+    """One allocator per instance; its open blocks are released on shutdown."""
+    global _allocator
+    with _allocator_lock:
+        if _allocator is None:
+            _allocator = NumberAllocator()
+        return _allocator
+
+
+def _release_allocator():
+    if _allocator is not None:
+        _allocator.release_all()
+
+
+on_shutdown(_release_allocator)
+
+
+def assign_number(invoice: AADEInvoice) -> AADEInvoice:
+    return get_allocator().assign(invoice)
+
+
+# --- Gap audit ---
+
+def issued_numbers(db, series: str, invoice_type: str, start: int, end: int) -> List[int]:
+    """
+    Numbers in [start, end) that appear in the invoice ledger: transmitted,
+    or failed and already recorded as a "rejected" gap when they were sent.
+    """
+    from aade.ledger import InvoiceLedger
+    wanted = [str(n) for n in range(start, end)]
+    issued = []
+    collection = db.collection(InvoiceLedger.COLLECTION)
+    for i in range(0, len(wanted), LEDGER_IN_LIMIT):
+        query = (collection
+                 .where(filter=FieldFilter("series", "==", series))
+                 .where(filter=FieldFilter("invoice_type", "==", invoice_type))
+                 .where(filter=FieldFilter("aa", "in", wanted[i:i + LEDGER_IN_LIMIT])))
+        issued.extend(int(doc.get("aa")) for doc in query.select(["aa"]).stream())
+    return sorted(set(issued))
+
+
+def audit_gaps(db, stale_after_sec: float = 2 * NUMBER_LEASE_MAX_AGE_SEC) -> Dict[str, Any]:
+    """
+    Settles leases still 'active' long after any live instance would have
+    retired them (their instance died): the unissued tail after the last
+    number in the ledger is handed back when no later block was leased,
+    other numbers missing from the ledger are recorded as gaps, and the
+    lease is marked 'lost'.
+    """
+    cutoff = time.time() - stale_after_sec
+    report = {"leases_checked": 0, "leases_lost": 0, "gap_numbers": 0, "numbers_handed_back": 0}
+    for sequence in db.collection(SEQUENCE_COLLECTION).stream():
+        data = sequence.to_dict() or {}
+        series, invoice_type = data.get("series"), data.get("invoice_type")
+        leases = (sequence.reference.collection("leases")
+                  .where(filter=FieldFilter("state", "==", "active"))
+                  .where(filter=FieldFilter("acquired_at", "<", cutoff)))
+        # Latest block first: once it is handed back, the one before it may be the tail
+        for lease in sorted(leases.stream(), key=lambda doc: doc.get("start"), reverse=True):
+            entry = lease.to_dict()
+            report["leases_checked"] += 1
+            issued = set(issued_numbers(db, series, invoice_type, entry["start"], entry["end"]))
+            tail = max(issued) + 1 if issued else entry["start"]
+            handed_back = firestore.transactional(_return_tail)(
+                db.transaction(), sequence.reference, lease.reference, tail, entry["end"],
+                {"state": "lost", "issued": len(issued)})
+            if handed_back is None:
+                continue
+            if handed_back:
+                report["numbers_handed_back"] += entry["end"] - tail
+            last = tail if handed_back else entry["end"]
+            run_start = None
+            for n in range(entry["start"], last + 1):
+                if n < last and n not in issued:
+                    run_start = n if run_start is None else run_start
+                elif run_start is not None:
+                    record_gap(sequence.reference, series, invoice_type, run_start, n - 1, "lost")
+                    report["gap_numbers"] += n - run_start
+                    run_start = None
+            report["leases_lost"] += 1
+    return report
+
+
+@scheduler_fn.on_schedule(
+    schedule="every day 04:15",
+    timezone=scheduler_fn.Timezone("Europe/Athens"),
+    region="europe-west1",
+    timeout_sec=540,
+)
+@traced("audit_invoice_number_gaps")
+def audit_invoice_number_gaps(event: scheduler_fn.ScheduledEvent) -> None:
+    """Nightly settlement of number leases abandoned by dead instances."""
+    report = audit_gaps(firestore.client())
+    print(f"Invoice number audit: {report}")
@@ -0,0 +1,317 @@
+"""
+Month-end reconciliation of paid Shopify orders against the invoice ledger.
+
+Every paid order should have exactly one accepted myDATA sales document
+(1.1 or 11.1, status 'transmitted' in 'aade_invoices') whose totals match
+the order. Both sides are streamed from JSONL exports into numpy columns
+and joined on order id with a sort + searchsorted, so 100k orders take
+seconds and nothing touches Firestore or AADE. Usage (from functions/):
+
+    python -m aade.reconciliation --orders orders.jsonl --invoices invoices.jsonl --out report.json
+    python -m aade.reconciliation --export-ledger invoices.jsonl
+
+orders.jsonl holds one Shopify order per line (orders/paid payloads or a
+bulk-operation export, gzip allowed); invoices.jsonl holds one ledger
+document per line, as written by --export-ledger.
+"""
+import argparse
+import gzip
+import json
+import logging
+import sys
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Expected totals follow webhooks.shopify.map_shopify_to_aade: line price is
+# net, VAT at the standard rate on top (see build_row)
+VAT_RATE = 0.24
+TOLERANCE = 0.01          # ledger totals are rounded to cents
+SALES_TYPES = ("1.1", "11.1")
+ACCEPTED_STATUS = "transmitted"
+UNPAID_STATUSES = ("pending", "authorized", "voided", "expired")
+TOTAL_FIELDS = ("net", "vat", "gross")
+
+
+def iter_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def parse_order_id(value: Any) -> Optional[int]:
+    """Numeric order id from an id, a ledger string or a gid://shopify/Order/... URI."""
+    if value is None:
+        return None
+    text = str(value).rsplit("/", 1)[-1]
+    return int(text) if text.isdigit() else None
+
+
+def in_month(value: Any, month: Optional[str]) -> bool:
+    return month is None or not value or str(value).startswith(month)
+
+
+# --- Columns ---
+
+def load_orders(rows: Iterable[Dict[str, Any]], month: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Paid orders as columns with their expected invoice totals. Line items are
+    flattened and summed per order with bincount rather than per-order loops.
+    Cancelled and unpaid orders, and orders outside `month` (YYYY-MM, by
+    processed_at/created_at when present), are skipped.
+    """
+    ids, names, currencies = [], [], []
+    line_order, line_amount = [], []
+    skipped = 0
+    for order in rows:
+        order_id = parse_order_id(order.get("id"))
+        if (order_id is None or order.get("cancelled_at")
+                or order.get("financial_status") in UNPAID_STATUSES
+                or not in_month(order.get("processed_at") or order.get("created_at"), month)):
+            skipped += 1
+            continue
+        index = len(ids)
+        ids.append(order_id)
+        names.append(order.get("name"))
+        currencies.append(order.get("currency") or "EUR")
+        for line in order.get("line_items") or []:
+            line_order.append(index)
+            line_amount.append(float(line.get("price", "0.0")) * int(line.get("quantity", 1)))
+
+    order_ids = np.asarray(ids, dtype=np.int64)
+    net = np.bincount(np.asarray(line_order, dtype=np.int64),
+                      weights=np.asarray(line_amount, dtype=np.float64), minlength=len(ids))
+    vat = net * VAT_RATE
+    columns = {
+        "order_id": order_ids,
+        "name": np.asarray(names, dtype=object),
+        "currency": np.asarray(currencies, dtype=object),
+        "net": net,
+        "vat": vat,
+        "gross": net + vat,
+        "skipped": skipped,
+    }
+    # An export may repeat an order (e.g. overlapping pages); keep the first
+    _, first = np.unique(order_ids, return_index=True)
+    if len(first) != len(order_ids):
+        keep = np.sort(first)
+        columns.update({k: v[keep] for k, v in columns.items() if isinstance(v, np.ndarray)})
+        columns["skipped"] += len(order_ids) - len(keep)
+    return columns
+
+
+def load_invoices(rows: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Ledger entries (aade_invoices documents) as columns."""
+    fields = {name: [] for name in ("order_id", "uid", "mark", "invoice_type", "status",
+                                    "currency", "issue_date", "error", "net", "vat", "gross")}
+    skipped = 0
+    for entry in rows:
+        order_id = parse_order_id(entry.get("order_id"))
+        if order_id is None:
+            skipped += 1
+            continue
+        fields["order_id"].append(order_id)
+        for name in ("uid", "mark", "invoice_type", "status", "currency", "issue_date", "error"):
+            fields[name].append(entry.get(name))
+        fields["net"].append(entry.get("total_net_value") or 0.0)
+        fields["vat"].append(entry.get("total_vat_amount") or 0.0)
+        fields["gross"].append(entry.get("total_gross_value") or 0.0)
+
+    columns = {name: np.asarray(values, dtype=object) for name, values in fields.items()}
+    columns["order_id"] = np.asarray(fields["order_id"], dtype=np.int64)
+    for name in TOTAL_FIELDS:
+        columns[name] = np.asarray(fields[name], dtype=np.float64)
+    columns["skipped"] = skipped
+    return columns
+
+
+# --- Join ---
+
+def reconcile(orders: Dict[str, Any], invoices: Dict[str, Any], month: Optional[str] = None,
+              tolerance: float = TOLERANCE) -> Dict[str, Any]:
+    """
+    Joins orders to accepted sales invoices on order id and reports:
+      missing     paid orders without an accepted invoice (with any failed attempts)
+      duplicates  orders with more than one accepted invoice
+      mismatched  orders whose invoice net/VAT/gross or currency differ from the order
+      orphaned    accepted invoices for orders not in the export (in `month`, if given)
+    """
+    accepted = (invoices["status"] == ACCEPTED_STATUS) & np.isin(invoices["invoice_type"], SALES_TYPES)
+    accepted_rows = np.flatnonzero(accepted)
+    accepted_ids = invoices["order_id"][accepted_rows]
+
+    # Accepted invoices grouped by order id: uniq[k] starts at by_order[first[k]]
+    by_order = accepted_rows[np.argsort(accepted_ids, kind="stable")]
+    uniq, first, counts = np.unique(invoices["order_id"][by_order], return_index=True, return_counts=True)
+
+    order_ids = orders["order_id"]
+    pos = np.searchsorted(uniq, order_ids)
+    pos_c = np.minimum(pos, max(len(uniq) - 1, 0))
+    found = (pos < len(uniq)) & (uniq[pos_c] == order_ids) if len(uniq) else np.zeros(len(order_ids), bool)
+
+    missing = np.flatnonzero(~found)
+    matched = np.flatnonzero(found)
+    duplicated = matched[counts[pos_c[matched]] > 1]
+
+    # Totals of each order's first accepted invoice, compared column by column
+    inv_rows = by_order[first[pos_c[matched]]]
+    diffs = {name: invoices[name][inv_rows] - orders[name][matched] for name in TOTAL_FIELDS}
+    bad = np.zeros(len(matched), dtype=bool)
+    for diff in diffs.values():
+        bad |= np.abs(diff) > tolerance
+    bad |= invoices["currency"][inv_rows] != orders["currency"][matched]
+    mismatched = np.flatnonzero(bad)
+
+    orphan_mask = ~np.isin(accepted_ids, order_ids)
+    if month:
+        orphan_mask &= np.array([in_month(d, month) for d in invoices["issue_date"][accepted_rows]], dtype=bool)
+    orphaned = accepted_rows[orphan_mask]
+
+    failed = invoices["status"] == "failed"
+    failed_ids, failed_counts = np.unique(invoices["order_id"][failed], return_counts=True)
+    last_errors = dict(zip(invoices["order_id"][failed].tolist(), invoices["error"][failed].tolist()))
+
+    def order_ref(i: int) -> Dict[str, Any]:
+        return {"order_id": str(order_ids[i]), "order_name": orders["name"][i]}
+
+    missing_rows = []
+    for i in missing:
+        attempts = 0
+        k = np.searchsorted(failed_ids, order_ids[i])
+        if k < len(failed_ids) and failed_ids[k] == order_ids[i]:
+            attempts = int(failed_counts[k])
+        missing_rows.append(dict(order_ref(i), gross=round(float(orders["gross"][i]), 2),
+                                 failed_attempts=attempts, last_error=last_errors.get(int(order_ids[i]))))
+
+    duplicate_rows = []
+    for i in duplicated:
+        k = pos_c[i]
+        rows = by_order[first[k]:first[k] + counts[k]]
+        duplicate_rows.append(dict(order_ref(i), uids=invoices["uid"][rows].tolist(),
+                                   marks=invoices["mark"][rows].tolist()))
+
+    mismatch_rows = []
+    for j in mismatched:
+        i, row = matched[j], inv_rows[j]
+        fields = {name: {"order": round(float(orders[name][i]), 2), "invoice": float(invoices[name][row])}
+                  for name in TOTAL_FIELDS if abs(diffs[name][j]) > tolerance}
+        if invoices["currency"][row] != orders["currency"][i]:
+            fields["currency"] = {"order": orders["currency"][i], "invoice": invoices["currency"][row]}
+        mismatch_rows.append(dict(order_ref(i), uid=invoices["uid"][row], mark=invoices["mark"][row], fields=fields))
+
+    orphan_rows = [{"order_id": str(invoices["order_id"][row]), "uid": invoices["uid"][row],
+                    "mark": invoices["mark"][row], "issue_date": invoices["issue_date"][row]}
+                   for row in orphaned]
+
+    return {
+        "month": month,
+        "orders": int(len(order_ids)),
+        "orders_skipped": orders["skipped"],
+        "invoices": int(len(invoices["order_id"])),
+        "invoices_accepted": int(len(accepted_rows)),
+        "summary": {
+            "matched": int(len(matched) - len(mismatched)),
+            "missing": len(missing_rows),
+            "duplicates": len(duplicate_rows),
+            "mismatched": len(mismatch_rows),
+            "orphaned": len(orphan_rows),
+        },
+        "missing": missing_rows,
+        "duplicates": duplicate_rows,
+        "mismatched": mismatch_rows,
+        "orphaned": orphan_rows,
+    }
+
+
+def reconcile_files(orders_path: str, invoices_path: str, month: Optional[str] = None,
+                    tolerance: float = TOLERANCE) -> Dict[str, Any]:
+    timings = {}
+    started = time.perf_counter()
+    orders = load_orders(iter_jsonl(orders_path), month)
+    timings["load_orders_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    started = time.perf_counter()
+    invoices = load_invoices(iter_jsonl(invoices_path))
+    timings["load_invoices_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    started = time.perf_counter()
+    report = reconcile(orders, invoices, month, tolerance)
+    timings["reconcile_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    report["timings"] = timings
+    return report
+
+
+def export_ledger(db, path: str, page_size: int = 1000) -> int:
+    """Streams aade_invoices to JSONL (paged by document id) for offline reconciliation."""
+    from aade.ledger import InvoiceLedger
+    collection = db.collection(InvoiceLedger.COLLECTION)
+    written = 0
+    last = None
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        while True:
+            query = collection.order_by("__name__").limit(page_size)
+            if last is not None:
+                query = query.start_after(last)
+            page = list(query.stream())
+            for doc in page:
+                f.write(json.dumps(doc.to_dict(), default=str, ensure_ascii=False) + "\n")
+            written += len(page)
+            if len(page) < page_size:
+                return written
+            last = page[-1]
+
+
+def print_report(report: Dict[str, Any], limit: int = 20):
+    summary = report["summary"]
+    print(f"Reconciliation {report['month'] or '(all dates)'}: {report['orders']} paid orders, "
+          f"{report['invoices_accepted']} accepted invoices ({report['invoices']} ledger entries)")
+    print("  " + ", ".join(f"{k}={v}" for k, v in summary.items()))
+    if report.get("timings"):
+        print("  " + ", ".join(f"{k}={v}" for k, v in report["timings"].items()))
+    for section in ("missing", "duplicates", "mismatched", "orphaned"):
+        rows = report[section]
+        if rows:
+            print(f"\n{section} ({len(rows)}):")
+            for row in rows[:limit]:
+                print(f"  {json.dumps(row, ensure_ascii=False, default=str)}")
+            if len(rows) > limit:
+                print(f"  ... {len(rows) - limit} more")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Reconcile paid Shopify orders against the AADE invoice ledger")
+    parser.add_argument("--orders", help="JSONL export of paid Shopify orders")
+    parser.add_argument("--invoices", help="JSONL export of aade_invoices (see --export-ledger)")
+    parser.add_argument("--month", help="YYYY-MM; restricts orders (and orphan invoices) to that month")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--out", help="write the full report as JSON to this file")
+    parser.add_argument("--limit", type=int, default=20, help="rows printed per section")
+    parser.add_argument("--export-ledger", metavar="PATH", help="export aade_invoices from Firestore and exit")
+    args = parser.parse_args(argv)
+
+    if args.export_ledger:
+        import firebase_admin
+        from firebase_admin import firestore
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app()
+        count = export_ledger(firestore.client(), args.export_ledger)
+        print(f"Exported {count} ledger entries to {args.export_ledger}")
+        return 0
+    if not (args.orders and args.invoices):
+        parser.error("--orders and --invoices are required")
+
+    report = reconcile_files(args.orders, args.invoices, args.month, args.tolerance)
+    print_report(report, args.limit)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False, default=str)
+    summary = report["summary"]
+    return 1 if summary["missing"] or summary["duplicates"] or summary["mismatched"] or summary["orphaned"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
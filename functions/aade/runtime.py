@@ -0,0 +1,174 @@
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import os
+import signal
+import threading
+from typing import Callable, Coroutine, List, Optional, Set
+
+import httpx
+
+from telemetry import registry
+
+# AADE Async Runtime
+# One event loop per process, running on a daemon thread, with one
+# long-lived httpx.AsyncClient (HTTP/2 when the h2 package is installed),
+# so every myDATA call reuses the same loop and pooled connections instead
+# of creating a loop and a client per invoice. Synchronous callers (the
+# webhook handlers) submit coroutines and get concurrent.futures.Future
+# objects back. On shutdown in-flight calls are given AADE_DRAIN_SEC to
+# finish before the client is closed and the loop stops.
+# Cloud Run stops an instance with SIGTERM, which does not run atexit
+# handlers, so shutdown hooks (this drain, the invoice number allocator's
+# release) run from a SIGTERM handler that then chains to the previous one
+# (gunicorn's worker exit, or the default termination), and from atexit on
+# a normal interpreter exit. Each hook runs once.
+
+logger = logging.getLogger(__name__)
+
+AADE_HTTP_TIMEOUT_SEC = float(os.environ.get("AADE_HTTP_TIMEOUT_SEC", "20"))
+AADE_MAX_CONNECTIONS = int(os.environ.get("AADE_MAX_CONNECTIONS", "32"))
+AADE_DRAIN_SEC = float(os.environ.get("AADE_DRAIN_SEC", "10"))
+
+
+class AsyncRuntime:
+    def __init__(self, name: str = "aade-runtime"):
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._pending: Set[concurrent.futures.Future] = set()
+        self._lock = threading.Lock()
+        self._closing = False
+
+    def _start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            ready.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """Schedules the coroutine on the runtime loop; safe to call from any thread."""
+        with self._lock:
+            if self._closing:
+                coro.close()
+                raise RuntimeError(f"{self.name} is shutting down")
+            if self._thread is None:
+                self._start()
+            future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+            self._pending.add(future)
+        registry.gauge(f"{self.name}.in_flight").set(len(self._pending))
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: concurrent.futures.Future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def http_client(self) -> httpx.AsyncClient:
+        """The shared client; only use it from coroutines running on this runtime."""
+        if self._client is None:
+            limits = httpx.Limits(max_connections=AADE_MAX_CONNECTIONS, max_keepalive_connections=AADE_MAX_CONNECTIONS)
+            try:
+                self._client = httpx.AsyncClient(http2=True, timeout=AADE_HTTP_TIMEOUT_SEC, limits=limits)
+            except ImportError:
+                logger.warning("h2 is not installed; the AADE client uses HTTP/1.1")
+                self._client = httpx.AsyncClient(timeout=AADE_HTTP_TIMEOUT_SEC, limits=limits)
+        return self._client
+
+    def shutdown(self, timeout: float = AADE_DRAIN_SEC):
+        """Stops taking work, waits up to `timeout` for in-flight calls, then stops the loop."""
+        with self._lock:
+            if self._closing or self._thread is None:
+                self._closing = True
+                return
+            self._closing = True
+            pending = list(self._pending)
+        done, not_done = concurrent.futures.wait(pending, timeout=timeout)
+        if not_done:
+            logger.warning(f"{self.name}: {len(not_done)} AADE calls still running after {timeout}s; abandoning them")
+        if self._client is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result(timeout=5)
+            except Exception as e:
+                logger.warning(f"{self.name}: could not close HTTP client: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        logger.info(f"{self.name}: drained {len(done)} in-flight calls and stopped")
+
+
+_runtime: Optional[AsyncRuntime] = None
+_runtime_pid: Optional[int] = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime() -> AsyncRuntime:
+    """The process-wide runtime (recreated in a forked child, which does not inherit the thread)."""
+    global _runtime, _runtime_pid
+    with _runtime_lock:
+        if _runtime is None or _runtime_pid != os.getpid():
+            _runtime = AsyncRuntime()
+            _runtime_pid = os.getpid()
+        return _runtime
+
+
+def shutdown_runtime(timeout: float = AADE_DRAIN_SEC):
+    global _runtime
+    with _runtime_lock:
+        runtime, _runtime = _runtime, None
+    if runtime is not None and _runtime_pid == os.getpid():
+        runtime.shutdown(timeout)
+
+
+_shutdown_hooks: List[Callable[[], None]] = []
+_shutdown_lock = threading.Lock()
+
+
+def on_shutdown(hook: Callable[[], None]):
+    """Registers a hook to run once when the instance shuts down (SIGTERM or interpreter exit)."""
+    with _shutdown_lock:
+        _shutdown_hooks.append(hook)
+
+
+def run_shutdown_hooks():
+    while True:
+        with _shutdown_lock:
+            if not _shutdown_hooks:
+                return
+            hook = _shutdown_hooks.pop(0)
+        try:
+            hook()
+        except Exception as e:
+            logger.warning(f"Shutdown hook {getattr(hook, '__name__', hook)} failed: {e}")
+
+
+def _install_sigterm_handler():
+    if threading.current_thread() is not threading.main_thread():
+        # Signal handlers can only be set from the main thread
+        logger.warning("aade-runtime: imported off the main thread; shutdown hooks only run at interpreter exit")
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        run_shutdown_hooks()
+        if callable(previous):
+            previous(signum, frame)
+        elif previous == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+on_shutdown(shutdown_runtime)
+atexit.register(run_shutdown_hooks)
+_install_sigterm_handler()
@@ -8,6 +8,7 @@ class InvoiceType(Enum):
     SERVICE_INVOICE = "2.1"
     RETAIL_RECEIPT = "11.1"
     CREDIT_NOTE = "5.1"
+    RETAIL_CREDIT_NOTE = "11.4"
 
 class VATExemption(Enum):
     WITHOUT_VAT_ART_22 = "1"
@@ -57,8 +58,8 @@ class AADEInvoice:
     counterpart: Party = None
     
     invoice_type: InvoiceType = InvoiceType.RETAIL_RECEIPT
-    series: str = "A"
-    aa: str = "1"
+    series: Optional[str] = None  # series / aa are assigned at transmission (aade/numbering.py)
+    aa: Optional[str] = None
     issue_date: date = None
     currency: str = "EUR"
     
@@ -66,3 +67,5 @@ class AADEInvoice:
     summary: InvoiceSummary = None
     
     payment_method: int = 5  # 5=Web Banking, 1=Cash
+    
+    correlated_invoices: List[int] = field(default_factory=list)  # MARKs credited by a credit note
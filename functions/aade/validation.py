@@ -0,0 +1,111 @@
+import glob
+import logging
+import os
+import re
+import threading
+from typing import List, Optional, Union
+
+# XSD Pre-validation
+# Generated InvoicesDoc XML is checked against the myDATA schema before it
+# is sent, so a malformed document fails locally (with the element path)
+# instead of after a round trip to AADE. The schema is compiled once per
+# process. Place AADE's published XSD package (InvoicesDoc-v*.xsd with the
+# files it imports) in aade/schemas or point AADE_XSD_DIR at it; without
+# it, or without lxml, validation is skipped with a warning.
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_DIR = os.environ.get("AADE_XSD_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas")
+SCHEMA_PATTERN = "InvoicesDoc*.xsd"
+MAX_ERRORS = 10
+
+
+class InvoiceSchemaValidator:
+    def __init__(self, schema_path: str):
+        from lxml import etree
+        self._etree = etree
+        self.schema_path = schema_path
+        self.schema = etree.XMLSchema(etree.parse(schema_path))
+        self._parser = etree.XMLParser(resolve_entities=False, no_network=True)
+        # lxml parsers and a schema's error_log are not safe to share between threads
+        self._lock = threading.Lock()
+
+    def validate(self, xml: Union[str, bytes]) -> List[str]:
+        """Returns the schema violations as 'element path: message' (empty when valid)."""
+        if isinstance(xml, str):
+            xml = xml.encode("utf-8")
+        with self._lock:
+            try:
+                doc = self._etree.fromstring(xml, self._parser)
+            except self._etree.XMLSyntaxError as e:
+                return [f"line {e.lineno}: {e.msg}"]
+            if self.schema.validate(doc):
+                return []
+            return [f"{self._element_path(doc, entry.path)}: {entry.message}"
+                    for entry in list(self.schema.error_log)[:MAX_ERRORS]]
+
+    def _element_path(self, doc, xpath: str) -> str:
+        """lxml reports '/*/*[3]/*[2]'; turns it into '/InvoicesDoc/invoice/invoiceHeader/issueDate'."""
+        try:
+            nodes = doc.xpath(xpath)
+        except self._etree.XPathError:
+            return xpath
+        if not nodes or not isinstance(nodes[0], self._etree._Element):
+            return xpath
+        parts = []
+        element = nodes[0]
+        while element is not None:
+            name = self._etree.QName(element).localname
+            parent = element.getparent()
+            if parent is not None:
+                same = [e for e in parent if e.tag == element.tag]
+                if len(same) > 1:
+                    name += f"[{same.index(element) + 1}]"
+            parts.append(name)
+            element = parent
+        return "/" + "/".join(reversed(parts))
+
+
+def find_schema(directory: str = SCHEMA_DIR) -> Optional[str]:
+    """Newest InvoicesDoc schema in the directory (by the version in its file name)."""
+    paths = glob.glob(os.path.join(directory, SCHEMA_PATTERN))
+    version = lambda path: [int(n) for n in re.findall(r"\d+", os.path.basename(path))]
+    return max(paths, key=version) if paths else None
+
+
+_validator: Optional[InvoiceSchemaValidator] = None
+_loaded = False
+_lock = threading.Lock()
+
+
+def get_validator() -> Optional[InvoiceSchemaValidator]:
+    """The per-process validator, or None if the schema (or lxml) is unavailable."""
+    global _validator, _loaded
+    if _loaded:
+        return _validator
+    with _lock:
+        if not _loaded:
+            path = find_schema()
+            if path is None:
+                logger.warning(f"No myDATA schema ({SCHEMA_PATTERN}) in {SCHEMA_DIR}; XML validation disabled.")
+            else:
+                try:
+                    _validator = InvoiceSchemaValidator(path)
+                    logger.info(f"Validating myDATA XML against {os.path.basename(path)}")
+                except ImportError:
+                    logger.warning("lxml is not installed; XML validation disabled.")
+                except Exception as e:
+                    logger.error(f"Could not compile myDATA schema {path}: {e}; XML validation disabled.")
+            _loaded = True
+    return _validator
+
+
+def reset_validator():
+    global _validator, _loaded
+    with _lock:
+        _validator, _loaded = None, False
+
+
+def validate_invoice_xml(xml: Union[str, bytes]) -> List[str]:
+    validator = get_validator()
+    return validator.validate(xml) if validator is not None else []
@@ -1,18 +1,61 @@
 from firebase_functions import https_fn, options
 from firebase_admin import firestore
 from google import genai
-from google.genai import types
-from .config import AIConfig
+from .bundle_graph import graph_bundles
+from .config import AIConfig, StaticContext, context_caches, router
+from .index_snapshot import nearest_products
+from .prompting import PromptBuilder, log_usage
+from .scheduler import GeminiUnavailable, Priority, schedule
+from .singleflight import SingleFlight, request_key
+from telemetry import registry, span, traced
+import json
 import numpy as np
 
 # Advisor Agent
 # Uses Vector Search (RAG) to find relevant products in the catalogue
-# and uses Gemini to reason about bundling them.
+# and uses Gemini to reason about bundling them. Requests for a known
+# product (productTitle only) are served from the precomputed bundle graph
+# (see ai/bundle_graph.py); the LLM handles free-text needs and graph misses.
+
+# Prompt for the Bundler Agent
+# The instructions are the same for every request and go in the system
+# instruction (a context cache when large enough); the need and the
+# retrieved candidates follow per request.
+BUNDLE_INSTRUCTIONS = """
+    You are an expert Personal Shopper and Bundle Advisor.
+    You are given a User Need and the available products from our catalogue that
+    match it (retrieved via RAG), one per line, columns separated by "|".
+
+    Task:
+    1. Select the best 3-5 items that form a COMPLETE usage set (e.g. Paint + Brush + Tape).
+    2. Explain WHY they go together.
+    3. Return a JSON with:
+       - bundle_title: Catchy name for the set
+       - items: List of selected product titles and their prices
+       - total_price: Sum of prices
+       - reason: Explanation
+
+    If no good bundle can be made, explain missing items.
+    """
+
+BUNDLE_PROMPT = """
+    User Need: "{query_text}"
+
+    Available products:
+    {candidates}
+    """
+
+BUNDLE_CONTEXT = StaticContext(name="suggest_bundles", system_instruction=BUNDLE_INSTRUCTIONS)
+
+
+bundle_flight = SingleFlight("suggest_bundles")
+
 
 @https_fn.on_call(
     region=AIConfig.LOCATION,
     memory=options.MemoryOption.MB_512,
 )
+@traced("suggest_bundles")
 def suggest_bundles(req: https_fn.CallableRequest) -> dict:
     """
     Suggests a bundle of products based on a seed product or a user need.
@@ -25,77 +68,104 @@ def suggest_bundles(req: https_fn.CallableRequest) -> dict:
         return {"error": "Provide productTitle or userNeed"}
 
     db = firestore.client()
-    client = genai.Client(
+
+    # 0. Precomputed bundles for a live product: no embedding, search or generation
+    if product_title and not user_need and AIConfig.BUNDLE_GRAPH_ENABLED:
+        try:
+            with span("bundles.graph_lookup") as s:
+                bundles = graph_bundles(db, product_title)
+                s.set(hit=bundles is not None)
+        except Exception as e:
+            print(f"Bundle graph lookup failed, using the LLM: {e}")
+            bundles = None
+        if bundles:
+            registry.counter("bundles.graph_hits").inc()
+            return {"recommendation": json.dumps(bundles[0], ensure_ascii=False), "bundles": bundles, "source": "graph"}
+        registry.counter("bundles.graph_misses").inc()
+
+    query_text = user_need if user_need else f"Accessories and complementary items for {product_title}"
+
+    # Identical requests in flight at the same time share one search + generation.
+    # Degraded answers are not handed to other instances.
+    return bundle_flight.do(
+        request_key(query_text),
+        lambda: recommend_bundle(db, query_text),
+        shareable=lambda result: not result.get("degraded"),
+    )
+
+def recommend_bundle(db, query_text: str) -> dict:
+    """Vector search for the need, then Gemini picks and explains the bundle."""
+    client = schedule(genai.Client(
         vertexai=True, 
         project=AIConfig.PROJECT_ID, 
         location=AIConfig.LOCATION
-    )
+    ), Priority.INTERACTIVE)
 
     # 1. Search Logic (The "FileSearch" equivalent using our Vector Store)
     # We query the 'product_drafts' (which act as our catalogue memory)
     # matching the semantic need.
     
-    query_text = user_need if user_need else f"Accessories and complementary items for {product_title}"
-    
     # Generate embedding for the query
-    embedding_resp = client.models.embed_content(
-        model="text-embedding-004",
-        contents=query_text
-    )
+    try:
+        with span("bundles.embed"):
+            embedding_resp = client.models.embed_content(
+                model="text-embedding-004",
+                contents=query_text
+            )
+    except GeminiUnavailable as e:
+        print(f"Bundle suggestion degraded (embedding unavailable): {e}")
+        return {"error": "Bundle suggestions are temporarily unavailable. Please try again shortly.", "degraded": True}
     query_vector = embedding_resp.embeddings[0].values
     
-    # Vector Search in Firestore
+    # Vector Search: the memory-mapped index snapshot, or Firestore when there is none yet
     # User requested to ONLY search Live products (the actual shopify backend mirror)
-    collection = db.collection("products_live")
-    
-    # Require a vector index on 'embedding_field'
-    vector_query = collection.find_nearest(
-        vector_field="embedding_field",
-        query_vector=query_vector,
-        distance_measure=firestore.DistanceMeasure.COSINE,
-        limit=10, # Fetch top 10 candidates
-        distance_result_field="vector_distance"
-    )
-    
-    docs = vector_query.get()
-    candidates = []
-    for doc in docs:
-        d = doc.to_dict()
-        # Remove vector to save tokens
-        if "embedding_field" in d:
-            del d["embedding_field"]
-        candidates.append(d)
+    with span("bundles.vector_search") as s:
+        candidates = nearest_products(db, "products_live", query_vector, limit=10) # Fetch top 10 candidates
+        s.set(results=len(candidates))
         
     # 2. Reasoning (The Agent)
     # We feed the candidates to Gemini and ask it to form a logical bundle.
-    
-    # Prompt for the Bundler Agent
-    prompt = f"""
-    You are an expert Personal Shopper and Bundle Advisor.
-    User Need: "{query_text}"
-    
-    Here are the available products from our catalogue that match this need (retrieved via RAG):
-    {candidates}
-    
-    Task:
-    1. Select the best 3-5 items that form a COMPLETE usage set (e.g. Paint + Brush + Tape).
-    2. Explain WHY they go together.
-    3. Return a JSON with:
-       - bundle_title: Catchy name for the set
-       - items: List of selected product titles and their prices
-       - total_price: Sum of prices
-       - reason: Explanation
-       
-    If no good bundle can be made, explain missing items.
-    """
-    
-    response = client.models.generate_content(
-        model=AIConfig.MODEL_NAME,
-        contents=prompt,
-        config=types.GenerateContentConfig(
-            response_mime_type="application/json",
-            temperature=0.3
-        )
+    # Candidates are serialized as a compact whitelisted table (no vectors,
+    # timestamps or other bookkeeping fields) trimmed to the token budget.
+    # Bundling is multi-product reasoning: the large model, unless that route is over its SLO
+    route = router.select("multi_product")
+    prompt = PromptBuilder(client=client, model=route.model).build(
+        BUNDLE_PROMPT,
+        candidates,
+        query_text=query_text.replace('"', "'"),
     )
     
+    try:
+        with span("bundles.generate", route=route.name, model=route.model) as s:
+            response = context_caches.generate_content(
+                client,
+                route.model,
+                BUNDLE_CONTEXT,
+                prompt,
+                response_mime_type="application/json",
+                temperature=0.3
+            )
+    except GeminiUnavailable as e:
+        print(f"Bundle suggestion degraded (generation unavailable): {e}")
+        return {"recommendation": fallback_bundle(query_text, candidates), "degraded": True}
+    router.record(route, s.duration_ms, response, "multi_product")
+    log_usage("suggest_bundles", response)
+    
     return {"recommendation": response.text}
+
+def fallback_bundle(query_text: str, candidates: list) -> str:
+    """
+    Degraded answer when Gemini is unavailable: the closest vector matches,
+    in the same JSON shape the model would have returned.
+    """
+    items = [
+        {"title": c.get("title"), "price": c.get("price")}
+        for c in candidates[:3] if c.get("title")
+    ]
+    return json.dumps({
+        "bundle_title": "Top matches",
+        "items": items,
+        "total_price": round(sum(i["price"] for i in items if isinstance(i["price"], (int, float))), 2),
+        "reason": f"These are the closest catalogue matches for \"{query_text}\". "
+                  "Our advisor is busy right now, so they have not been hand-picked.",
+    })
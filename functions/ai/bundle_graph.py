@@ -0,0 +1,351 @@
+import logging
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from firebase_admin import firestore
+from firebase_functions import options, scheduler_fn
+
+from .config import AIConfig
+from telemetry import registry, span, traced
+
+# Complementary Product Graph
+# Bundles for a given product hardly change, so instead of a vector search
+# plus an LLM call per request they are precomputed offline. The nightly
+# build scores every pair of live products on three signals:
+#   - embedding: cosine similarity of the product embeddings (same project/use)
+#   - tags: category rules, e.g. paint goes with brushes, primer and tape
+#   - co_purchase: how often the two were paid for in the same order
+# Products in the same category are substitutes rather than complements and
+# are never paired. Each product keeps its top neighbours and a few
+# ready-made bundles in 'bundle_graph/{product_id}', which suggest_bundles
+# serves directly for productTitle requests.
+
+logger = logging.getLogger(__name__)
+
+LIVE_COLLECTION = "products_live"
+GRAPH_COLLECTION = "bundle_graph"
+BASKETS_COLLECTION = "order_baskets"
+META_COLLECTION = "bundle_graph_meta"   # "rules" (optional overrides) and "latest" (last build stats)
+
+BLOCK_ROWS = 512            # similarity rows computed per matrix product
+MIN_CO_PURCHASES = 2        # a single shared order is noise
+WRITE_BATCH_SIZE = 400
+
+# Checked in order, so "Paint Tray" is an applicator and not paint
+DEFAULT_CATEGORIES = {
+    "applicator": ["brush", "roller", "tray", "spray gun", "πινέλο", "ρολό", "λεκάνη"],
+    "prep": ["tape", "drop cloth", "sandpaper", "filler", "putty", "scraper",
+             "ταινία", "νάιλον", "γυαλόχαρτο", "στόκος", "σπάτουλα"],
+    "primer": ["primer", "undercoat", "αστάρι"],
+    "sealant": ["sealant", "silicone", "caulk", "σιλικόνη", "μαστίχη"],
+    "wood_finish": ["varnish", "stain", "wood oil", "βερνίκι", "λάκα"],
+    "paint": ["paint", "emulsion", "enamel", "χρώμα", "μπογιά"],
+}
+
+DEFAULT_COMPLEMENTS = {
+    "paint": ["primer", "applicator", "prep"],
+    "primer": ["paint", "applicator", "prep"],
+    "wood_finish": ["applicator", "prep"],
+    "sealant": ["prep"],
+    "applicator": ["paint", "primer", "wood_finish", "prep"],
+    "prep": ["paint", "primer", "wood_finish", "sealant", "applicator"],
+}
+
+
+def title_key(title: Optional[str]) -> str:
+    return " ".join((title or "").lower().split())
+
+
+def parse_price(value: Any) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# --- Co-purchase collection (orders/paid) ---
+
+def record_basket(db, order: Dict[str, Any]) -> int:
+    """
+    Stores the distinct products of a paid order in 'order_baskets/{order_id}'.
+    Keyed by order, so webhook redeliveries overwrite instead of double counting.
+    Returns the number of products recorded.
+    """
+    product_ids: List[str] = []
+    for line in order.get("line_items", []):
+        product_id = line.get("product_id")
+        if product_id and str(product_id) not in product_ids:
+            product_ids.append(str(product_id))
+    if not product_ids or order.get("id") is None:
+        return 0
+
+    day = (order.get("processed_at") or order.get("created_at") or "")[:10] or time.strftime("%Y-%m-%d", time.gmtime())
+    db.collection(BASKETS_COLLECTION).document(str(order["id"])).set({
+        "product_ids": product_ids[:AIConfig.CO_PURCHASE_MAX_ITEMS],
+        "day": day,
+        "recorded_at": firestore.SERVER_TIMESTAMP,
+    })
+    registry.counter("bundle_graph.baskets_recorded").inc()
+    return len(product_ids)
+
+
+# --- Build ---
+
+def load_rules(db) -> Tuple[Dict[str, List[str]], Dict[str, List[str]]]:
+    """Category keywords and complement rules, optionally overridden by 'bundle_graph_meta/rules'."""
+    categories, complements = DEFAULT_CATEGORIES, DEFAULT_COMPLEMENTS
+    try:
+        doc = db.collection(META_COLLECTION).document("rules").get()
+        if doc.exists:
+            data = doc.to_dict()
+            categories = data.get("categories") or categories
+            complements = data.get("complements") or complements
+    except Exception as e:
+        logger.warning(f"Could not load bundle rules, using defaults: {e}")
+    return categories, complements
+
+
+def category_of(product: Dict[str, Any], categories: Dict[str, List[str]]) -> Optional[str]:
+    text = " ".join([product.get("title") or ""] + [str(t) for t in product.get("tags") or []]).lower()
+    for category, keywords in categories.items():
+        if any(k in text for k in keywords):
+            return category
+    return None
+
+
+def load_products(db) -> List[Dict[str, Any]]:
+    products = []
+    for doc in db.collection(LIVE_COLLECTION).stream():
+        d = doc.to_dict() or {}
+        if d.get("status", "active") != "active" or not d.get("title"):
+            continue
+        products.append({
+            "id": doc.id,
+            "title": d.get("title"),
+            "price": d.get("price"),
+            "currency": d.get("currency", "EUR"),
+            "tags": d.get("tags") or [],
+            "embedding": d.get("embedding_field"),
+        })
+    return products
+
+
+def load_co_purchases(db, index: Dict[str, int]) -> Tuple[List[Dict[int, int]], np.ndarray]:
+    """Pair counts per product (partners[i][j]) and orders per product over the window."""
+    cutoff = time.strftime("%Y-%m-%d", time.gmtime(time.time() - AIConfig.CO_PURCHASE_WINDOW_DAYS * 86400))
+    partners: List[Dict[int, int]] = [{} for _ in index]
+    orders = np.zeros(len(index), dtype=np.float32)
+    for doc in db.collection(BASKETS_COLLECTION).where("day", ">=", cutoff).stream():
+        rows = sorted({index[p] for p in doc.get("product_ids") or [] if p in index})
+        for i in rows:
+            orders[i] += 1
+        for a in range(len(rows)):
+            for b in range(a + 1, len(rows)):
+                i, j = rows[a], rows[b]
+                partners[i][j] = partners[i].get(j, 0) + 1
+                partners[j][i] = partners[j].get(i, 0) + 1
+    return partners, orders
+
+
+def embedding_matrix(products: List[Dict[str, Any]]) -> np.ndarray:
+    """Row-normalised embeddings; products without one get a zero row (no similarity signal)."""
+    dim = next((len(p["embedding"]) for p in products if p["embedding"] is not None), 0)
+    matrix = np.zeros((len(products), dim), dtype=np.float32)
+    for i, p in enumerate(products):
+        if p["embedding"] is not None and len(p["embedding"]) == dim:
+            matrix[i] = np.asarray(p["embedding"], dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def build_neighbours(products, categories, complements, partners, orders) -> List[List[Dict[str, Any]]]:
+    """Top BUNDLE_GRAPH_NEIGHBOURS complements per product, highest score first."""
+    n = len(products)
+    weights = AIConfig.BUNDLE_SIGNAL_WEIGHTS
+    k = min(AIConfig.BUNDLE_GRAPH_NEIGHBOURS, max(n - 1, 0))
+    names = list(categories)
+    unknown = len(names)
+    cats = np.array([names.index(c) if c else unknown for c in (p["category"] for p in products)], dtype=np.int32)
+    # (C+1)x(C+1) lookup; the last row/column is "no category" and matches nothing
+    rule = np.zeros((unknown + 1, unknown + 1), dtype=bool)
+    for c, others in complements.items():
+        if c in names:
+            for o in others:
+                if o in names:
+                    rule[names.index(c), names.index(o)] = True
+
+    matrix = embedding_matrix(products)
+    neighbours: List[List[Dict[str, Any]]] = []
+    for start in range(0, n, BLOCK_ROWS):
+        stop = min(start + BLOCK_ROWS, n)
+        sims = matrix[start:stop] @ matrix.T if matrix.shape[1] else np.zeros((stop - start, n), dtype=np.float32)
+        tags = rule[cats[start:stop]][:, cats]
+        score = weights["embedding"] * np.clip(sims, 0.0, None) + weights["tags"] * tags
+
+        for local, i in enumerate(range(start, stop)):
+            for j, count in partners[i].items():
+                if count >= MIN_CO_PURCHASES:
+                    score[local, j] += weights["co_purchase"] * count / math.sqrt(orders[i] * orders[j])
+
+        same = (cats[start:stop, None] == cats[None, :]) & (cats[start:stop, None] != unknown)
+        blocked = same | (sims > AIConfig.BUNDLE_DUPLICATE_SIMILARITY) | (score < AIConfig.BUNDLE_MIN_SCORE)
+        blocked[np.arange(stop - start), np.arange(start, stop)] = True
+        score[blocked] = -np.inf
+
+        top = np.argpartition(-score, k - 1, axis=1)[:, :k] if k else np.zeros((stop - start, 0), dtype=int)
+        for local, i in enumerate(range(start, stop)):
+            row = []
+            for j in sorted(top[local], key=lambda j: -score[local, j]):
+                if not np.isfinite(score[local, j]):
+                    break
+                other = products[j]
+                row.append({
+                    "id": other["id"],
+                    "title": other["title"],
+                    "price": other["price"],
+                    "category": other["category"],
+                    "score": round(float(score[local, j]), 4),
+                    "signals": {
+                        "embedding": round(float(sims[local, j]), 4),
+                        "tags": bool(tags[local, j]),
+                        "co_purchases": partners[i].get(j, 0),
+                    },
+                })
+            neighbours.append(row)
+    return neighbours
+
+
+def make_bundles(seed: Dict[str, Any], neighbours: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Up to BUNDLES_PER_PRODUCT bundles in the shape the bundle LLM returns.
+    Each bundle takes the best neighbour per category; later bundles only use
+    neighbours that earlier bundles did not.
+    """
+    bundles = []
+    used = set()
+    for n in range(AIConfig.BUNDLES_PER_PRODUCT):
+        picked, taken = [], set()
+        for nb in neighbours:
+            if nb["id"] in used or (nb["category"] and nb["category"] in taken):
+                continue
+            picked.append(nb)
+            taken.add(nb["category"])
+            if len(picked) == AIConfig.BUNDLE_SIZE - 1:
+                break
+        if not picked:
+            break
+        used.update(nb["id"] for nb in picked)
+
+        items = [{"id": seed["id"], "title": seed["title"], "price": seed["price"]}]
+        items += [{"id": nb["id"], "title": nb["title"], "price": nb["price"]} for nb in picked]
+        bought = [nb["title"] for nb in picked if nb["signals"]["co_purchases"]]
+        rest = [nb["title"] for nb in picked if not nb["signals"]["co_purchases"]]
+        reason = []
+        if bought:
+            reason.append(f"Customers who bought {seed['title']} often also bought {', '.join(bought)}.")
+        if rest:
+            reason.append(f"{', '.join(rest)} {'completes' if len(rest) == 1 else 'complete'} the set.")
+        prices = [parse_price(i["price"]) for i in items]
+        bundles.append({
+            "bundle_title": f"{seed['title']} complete set" if n == 0 else f"{seed['title']} alternative set {n}",
+            "items": items,
+            "total_price": round(sum(p for p in prices if p is not None), 2),
+            "reason": " ".join(reason),
+        })
+    return bundles
+
+
+def build_bundle_graph(db) -> Dict[str, Any]:
+    """Rebuilds 'bundle_graph' from products_live and recent baskets. Returns build stats."""
+    with span("bundle_graph.build") as s:
+        categories, complements = load_rules(db)
+        with span("bundle_graph.load"):
+            products = load_products(db)
+            for p in products:
+                p["category"] = category_of(p, categories)
+            index = {p["id"]: i for i, p in enumerate(products)}
+            partners, orders = load_co_purchases(db, index)
+
+        with span("bundle_graph.score"):
+            neighbours = build_neighbours(products, categories, complements, partners, orders)
+
+        with span("bundle_graph.write"):
+            built_at = firestore.SERVER_TIMESTAMP
+            batch = db.batch()
+            pending = 0
+            with_bundles = 0
+            for product, row in zip(products, neighbours):
+                bundles = make_bundles(product, row)
+                with_bundles += bool(bundles)
+                batch.set(db.collection(GRAPH_COLLECTION).document(product["id"]), {
+                    "title": product["title"],
+                    "title_key": title_key(product["title"]),
+                    "category": product["category"],
+                    "neighbours": row,
+                    "bundles": bundles,
+                    "built_at": built_at,
+                })
+                pending += 1
+                if pending >= WRITE_BATCH_SIZE:
+                    batch.commit()
+                    batch, pending = db.batch(), 0
+
+            # Products that were unpublished since the last build
+            stale = 0
+            for doc in db.collection(GRAPH_COLLECTION).stream():
+                if doc.id not in index:
+                    batch.delete(doc.reference)
+                    stale += 1
+                    pending += 1
+                    if pending >= WRITE_BATCH_SIZE:
+                        batch.commit()
+                        batch, pending = db.batch(), 0
+            if pending:
+                batch.commit()
+
+        stats = {
+            "products": len(products),
+            "with_bundles": with_bundles,
+            "edges": sum(len(r) for r in neighbours),
+            "co_purchase_pairs": sum(len(p) for p in partners) // 2,
+            "uncategorised": sum(1 for p in products if p["category"] is None),
+            "stale_removed": stale,
+        }
+        s.set(**stats)
+
+    stats["elapsed_ms"] = round(s.duration_ms, 1)
+    db.collection(META_COLLECTION).document("latest").set(dict(stats, built_at=firestore.SERVER_TIMESTAMP))
+    registry.gauge("bundle_graph.products").set(stats["products"])
+    registry.gauge("bundle_graph.edges").set(stats["edges"])
+    return stats
+
+
+# --- Serving ---
+
+def graph_bundles(db, product_title: str) -> Optional[List[Dict[str, Any]]]:
+    """Precomputed bundles for a live product title, or None if the graph has none."""
+    docs = db.collection(GRAPH_COLLECTION).where("title_key", "==", title_key(product_title)).limit(1).get()
+    for doc in docs:
+        bundles = doc.get("bundles")
+        if bundles:
+            return bundles
+    return None
+
+
+@scheduler_fn.on_schedule(
+    schedule=AIConfig.BUNDLE_GRAPH_SCHEDULE,
+    timezone=scheduler_fn.Timezone("Europe/Athens"),
+    region=AIConfig.LOCATION,
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=540,
+)
+@traced("rebuild_bundle_graph")
+def rebuild_bundle_graph(event: scheduler_fn.ScheduledEvent) -> None:
+    """Nightly rebuild of the complementary-product graph."""
+    if not AIConfig.BUNDLE_GRAPH_ENABLED:
+        print("Bundle graph disabled (BUNDLE_GRAPH_ENABLED=false); skipping rebuild.")
+        return
+    stats = build_bundle_graph(firestore.client())
+    print(f"Bundle graph rebuilt: {stats}")
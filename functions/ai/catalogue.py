@@ -1,12 +1,21 @@
-import os
+import collections
 import json
+import os
 import tempfile
 import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 from firebase_functions import https_fn, storage_fn, options
 from firebase_admin import firestore, storage, initialize_app
+from google.cloud.firestore_v1.vector import Vector
 from google import genai
 from google.genai import types
-from .config import AIConfig
+from .config import AIConfig, StaticContext, context_caches
+from .tabular import TabularIngest, tabular_kind, supplier_from_path
+from .extraction_cache import ExtractionCache, cache_key, content_hash, record_upload
+from .json_stream import ProductStreamParser
+from .draft_writer import DraftWriter
+from .scheduler import Priority, schedule
+from telemetry import registry, span, traced
 
 # Initialize Firebase if not already done
 try:
@@ -14,6 +23,29 @@ try:
 except ValueError:
     pass
 
+EXTRACTION_PROMPT = """
+    You are an expert e-commerce data entry specialist.
+    Analyze this catalogue file and extract ALL products found.
+    For each product, return a JSON object with:
+    - title: Product name
+    - description: Detailed description (include material, care instructions if available)
+    - price: Price as a number (if found, else null)
+    - currency: Currency code (e.g., EUR, USD)
+    - sku: SKU or identifier (if found, else null)
+    - tags: List of relevant category tags (e.g. 'Men', 'Summer', 'Casual', 'Shirt')
+    - options: List of variants if available (e.g. sizes, colors)
+
+    Return the response as a JSON object with a key "products" containing the list.
+    """
+
+# Follow-up when the extraction output was cut off before the end of the catalogue
+EXTRACTION_CONTINUE_PROMPT = """
+    The previous answer stopped early. {count} products have been extracted so far;
+    the last one was: {last}
+    Continue with the products that come AFTER it in the catalogue, in the same
+    format (a JSON object with a key "products"). Do not repeat earlier products.
+    """
+
 @storage_fn.on_object_finalized(
     region=AIConfig.LOCATION,
     memory=options.MemoryOption.GB_1,
@@ -21,14 +53,16 @@ except ValueError:
     cpu=1,
     bucket=os.environ.get("FIREBASE_STORAGE_BUCKET") # Dynamic bucket
 )
+@traced("process_catalogue_upload")
 def process_catalogue_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
     """
     Triggered when a file is uploaded to the catalogue bucket.
-    Extracts product data using Gemini and stores it in Firestore 'product_drafts'.
+    Extracts product data (deterministically for CSV/XLSX price lists, with
+    Gemini for everything else) and stores it in Firestore 'product_drafts'.
     """
     bucket_name = event.data.bucket
     file_path = event.data.name
-    
+
     # Only process files in the 'catalogues/' path
     if not file_path.startswith("catalogues/"):
         print(f"Skipping file {file_path} (not in catalogues/)")
@@ -39,110 +73,239 @@ def process_catalogue_upload(event: storage_fn.CloudEvent[storage_fn.StorageObje
 
     print(f"Processing catalogue file: {file_path}")
 
-    # Initialize Gemini Client
-    client = genai.Client(
-        vertexai=True, 
-        project=AIConfig.PROJECT_ID, 
+    # Initialize Gemini Client (batch priority: shoppers' requests go first)
+    client = schedule(genai.Client(
+        vertexai=True,
+        project=AIConfig.PROJECT_ID,
         location=AIConfig.LOCATION
-    )
+    ), Priority.BATCH)
 
     gcs_uri = f"gs://{bucket_name}/{file_path}"
     blob = bucket.blob(file_path)
     content_type = event.data.content_type
 
-    # 1. Extract Product Data using Gemini Long Context
-    # We use Long Context (passing the file URI directly) because we want ALL products.
-    # RAG (FileSearch) is better for querying specific info, not bulk extraction.
-    
-    prompt = """
-    You are an expert e-commerce data entry specialist.
-    Analyze this catalogue file and extract ALL products found.
-    For each product, return a JSON object with:
-    - title: Product name
-    - description: Detailed description (include material, care instructions if available)
-    - price: Price as a number (if found, else null)
-    - currency: Currency code (e.g., EUR, USD)
-    - sku: SKU or identifier (if found, else null)
-    - tags: List of relevant category tags (e.g. 'Men', 'Summer', 'Casual', 'Shirt')
-    - options: List of variants if available (e.g. sizes, colors)
-    
-    Return the response as a JSON object with a key "products" containing the list.
+    # 1. Extract Product Data
+    kind = tabular_kind(content_type, file_path)
+    if kind:
+        # Fast path: supplier price lists are mapped column-by-column and streamed;
+        # Gemini only sees the rows we could not map.
+        ingest = TabularIngest(db, supplier_from_path(file_path))
+        products = ingest.products(blob, kind, client)
+    else:
+        # Products are embedded and written while Gemini is still streaming the rest
+        products = extract_cached(db, bucket, client, event.data, gcs_uri)
+
+    # 2. Store in Firestore 'product_drafts'
+    written = write_drafts(db, client, products, source_file=file_path, source_gcs_uri=gcs_uri)
+
+    if kind:
+        print(f"Tabular ingest stats: {ingest.stats}")
+        ingest.record(file_path, written)
+    print(f"Catalogue processing complete. {written} drafts created.")
+
+def extract_cached(db, bucket, client, object_data, gcs_uri: str) -> Iterator[Dict[str, Any]]:
     """
-    
-    try:
-        response = client.models.generate_content(
-            model=AIConfig.MODEL_NAME,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_uri(file_uri=gcs_uri, mime_type=content_type),
-                        types.Part.from_text(text=prompt)
-                    ]
-                )
-            ],
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json", 
-                temperature=0.1
-            )
-        )
-        products_data = json.loads(response.text)
-        if isinstance(products_data, dict):
-             products_data = products_data.get("products", [])
-        
-    except Exception as e:
-        print(f"Gemini Extraction Failed: {e}")
-        # Log failure logic here?
+    Runs extract_with_gemini through the extraction cache. A byte-identical
+    re-upload (same md5/crc32c, prompt and model) replays the cached products.
+    On a miss, products are compressed into the cache as they stream past and
+    the entry is only stored if the extraction finished cleanly.
+    """
+    file_path = object_data.name
+    content_type = object_data.content_type
+    object_hash = content_hash(object_data)
+    run = ExtractionRun()
+    if not AIConfig.EXTRACTION_CACHE_ENABLED or not object_hash:
+        yield from extract_with_gemini(client, gcs_uri, content_type, run, object_hash, object_data.size)
         return
 
-    print(f"Extracted {len(products_data)} products.")
+    cache = ExtractionCache(bucket)
+    key = cache_key(object_hash, content_type, EXTRACTION_PROMPT, AIConfig.MODEL_NAME)
+    started = time.perf_counter()
+    cached = cache.get(key)
+    if cached is not None:
+        products, metadata = cached
+        lookup_ms = (time.perf_counter() - started) * 1000
+        saved_ms = max(float(metadata.get("extraction_ms", 0)) - lookup_ms, 0.0)
+        print(f"Extraction cache hit for {file_path} (first seen as {metadata.get('source_file')}), saved ~{saved_ms:.0f}ms.")
+        record_upload(db, file_path, object_hash, "hit", len(products), lookup_ms, saved_ms)
+        yield from products
+        return
 
-    # 2. Store in Firestore 'product_drafts'
-    batch = db.batch()
-    
-    for product in products_data:
-        # Create Document Ref in DRAFTS
-        doc_ref = db.collection("product_drafts").document()
-        
-        # Generate embedding for the draft (for Agent searching later)
-        text_to_embed = f"{product.get('title', '')} {product.get('description', '')} {' '.join(product.get('tags', []))}"
-        
+    writer = cache.writer(key)
+    for product in extract_with_gemini(client, gcs_uri, content_type, run, object_hash, object_data.size):
+        writer.add(product)
+        yield product
+
+    if run.error or run.truncated:
+        record_upload(db, file_path, object_hash, "failed" if not run.products else "partial",
+                      run.products, run.wait_ms)
+        return
+
+    writer.commit({
+        "source_file": file_path,
+        "model": AIConfig.MODEL_NAME,
+        "extraction_ms": round(run.wait_ms, 1),
+        "extracted_at": int(time.time()),
+    })
+    record_upload(db, file_path, object_hash, "miss", run.products, run.wait_ms)
+
+class ExtractionRun:
+    """Outcome of one streamed extraction (filled in while the generator runs)."""
+
+    def __init__(self):
+        self.products = 0
+        self.passes = 0
+        self.wait_ms = 0.0  # time spent waiting on Gemini, excluding our own embedding/writing
+        self.first_product_ms: Optional[float] = None
+        self.truncated = False
+        self.error: Optional[str] = None
+
+def _product_key(product: Dict[str, Any]) -> tuple:
+    return (str(product.get("title") or "").strip().lower(), str(product.get("sku") or "").strip().lower())
+
+def extract_with_gemini(client, gcs_uri: str, content_type: str, run: Optional[ExtractionRun] = None,
+                        object_hash: Optional[str] = None, size: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Extracts products using Gemini Long Context.
+    We use Long Context (passing the file URI directly) because we want ALL products.
+    RAG (FileSearch) is better for querying specific info, not bulk extraction.
+
+    The response is streamed and parsed incrementally, so each product is
+    yielded as soon as its JSON object closes. If the output is cut off
+    (output token limit), follow-up requests ask for the products after the
+    last one received, up to EXTRACTION_MAX_PASSES; the file is then read
+    from a context cache instead of being processed again. Products a
+    follow-up repeats from the end of the previous pass are skipped;
+    identical rows elsewhere in the catalogue are all kept. If a stream
+    fails, the products completed before that point are kept.
+    """
+    run = run or ExtractionRun()
+    # The file (by URI and content hash) is the static part of every pass
+    catalogue = StaticContext(
+        name="catalogue_extraction",
+        contents=(types.Content(role="user", parts=[types.Part.from_uri(file_uri=gcs_uri, mime_type=content_type)]),),
+        key=f"{gcs_uri}#{object_hash}" if object_hash else None,
+    )
+    # Keys of the last products yielded, which a follow-up pass may repeat
+    recent = collections.deque(maxlen=AIConfig.EXTRACTION_OVERLAP_WINDOW)
+    last: Optional[Dict[str, Any]] = None
+    chars = 0
+    started = time.perf_counter()
+    while run.passes < AIConfig.EXTRACTION_MAX_PASSES:
+        run.passes += 1
+        if run.passes == 1:
+            prompt = EXTRACTION_PROMPT
+        else:
+            prompt = EXTRACTION_CONTINUE_PROMPT.format(
+                count=run.products, last=json.dumps({k: last.get(k) for k in ("title", "sku")}, ensure_ascii=False))
+        # Cached only when the file is read more than once: for follow-ups, or from the
+        # first pass when it is large enough that a follow-up is likely
+        use_cache = catalogue.key is not None and (run.passes > 1 or (size or 0) >= AIConfig.CONTEXT_CACHE_FILE_MIN_BYTES)
+        parser = ProductStreamParser()
+        new_products = 0
+        overlap = list(recent) if run.passes > 1 else []
         try:
-            embedding_resp = client.models.embed_content(
-                model="text-embedding-004",
-                contents=text_to_embed
-            )
-            embedding_vector = embedding_resp.embeddings[0].values
-        except Exception:
-            embedding_vector = None # Proceed even if embedding fails
-
-        product_draft = {
-            "title": product.get("title"),
-            "description": product.get("description"),
-            "price": product.get("price"),
-            "currency": product.get("currency", "EUR"),
-            "sku": product.get("sku"),
-            "tags": product.get("tags", []),
-            "options": product.get("options", []),
-            
-            # Metadata
-            "source_file": file_path,
-            "source_gcs_uri": gcs_uri,
-            "status": "pending_review", # <--- Key Change
-            "created_at": firestore.SERVER_TIMESTAMP,
-            "ai_confidence": 0.85, # Placeholder or could be derived
-            
-            # Search
-            "embedding_field": firestore.Vector(embedding_vector) if embedding_vector else None
-        }
-        
-        batch.set(doc_ref, product_draft)
-        
-        if len(batch) >= 400:
-            batch.commit()
-            batch = db.batch()
-    
-    if len(batch) > 0:
-        batch.commit()
-
-    print("Catalogue processing complete. Drafts created.")
+            stream = iter(context_caches.generate_content_stream(
+                client,
+                AIConfig.MODEL_NAME,
+                catalogue,
+                [types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+                cache=use_cache,
+                response_mime_type="application/json",
+                temperature=0.1
+            ))
+            while True:
+                waited = time.perf_counter()
+                with span("catalogue.extract_chunk", quiet=True):
+                    chunk = next(stream, None)
+                run.wait_ms += (time.perf_counter() - waited) * 1000
+                if chunk is None:
+                    break
+                for product in parser.feed(chunk.text or ""):
+                    key = _product_key(product)
+                    if overlap and key in overlap:
+                        # Still in the repeated part: each earlier product is skipped once
+                        overlap.remove(key)
+                        registry.counter("catalogue.extract_overlap_skipped").inc()
+                        continue
+                    overlap = []
+                    recent.append(key)
+                    last = product
+                    new_products += 1
+                    run.products += 1
+                    if run.first_product_ms is None:
+                        run.first_product_ms = (time.perf_counter() - started) * 1000
+                    yield product
+
+        except Exception as e:
+            run.error = str(e)
+            print(f"Gemini Extraction Failed after {run.products} products: {e}")
+
+        parser.close()
+        chars += parser.stats["chars"]
+        run.truncated = parser.truncated
+        if run.error or not run.truncated or not new_products:
+            break
+        registry.counter("catalogue.extract_continuations").inc()
+
+    registry.histogram("catalogue.extract_ms").observe(run.wait_ms)
+    if run.first_product_ms is not None:
+        registry.histogram("catalogue.first_product_ms").observe(run.first_product_ms)
+    print(f"Extracted {run.products} products in {run.passes} passes ({chars} chars, "
+          f"first after {run.first_product_ms or 0:.0f}ms, truncated={run.truncated}).")
+
+def write_drafts(db, client, products: Iterable[Dict[str, Any]], source_file: str, source_gcs_uri: str) -> int:
+    """
+    Embeds each product and writes it as a draft through a DraftWriter
+    (parallel BulkWriter commits with retries). Returns the number of drafts
+    Firestore acknowledged.
+    """
+    writer = DraftWriter(db)
+    try:
+        for product in products:
+            # Create Document Ref in DRAFTS
+            doc_ref = db.collection("product_drafts").document()
+
+            # Generate embedding for the draft (for Agent searching later)
+            text_to_embed = f"{product.get('title', '')} {product.get('description', '')} {' '.join(product.get('tags', []))}"
+
+            try:
+                with span("catalogue.embed", quiet=True):
+                    embedding_resp = client.models.embed_content(
+                        model="text-embedding-004",
+                        contents=text_to_embed
+                    )
+                embedding_vector = embedding_resp.embeddings[0].values
+            except Exception:
+                embedding_vector = None # Proceed even if embedding fails
+
+            product_draft = {
+                "title": product.get("title"),
+                "description": product.get("description"),
+                "price": product.get("price"),
+                "currency": product.get("currency", "EUR"),
+                "sku": product.get("sku"),
+                "tags": product.get("tags", []),
+                "options": product.get("options", []),
+
+                # Metadata
+                "source_file": source_file,
+                "source_gcs_uri": source_gcs_uri,
+                "status": "pending_review", # <--- Key Change
+                "created_at": firestore.SERVER_TIMESTAMP,
+                "ai_confidence": product.get("ai_confidence", 0.85), # 1.0 for deterministic tabular rows
+
+                # Search
+                "embedding_field": Vector(embedding_vector) if embedding_vector else None
+            }
+
+            # Blocks while too many writes are in flight (back-pressure on embedding)
+            writer.set(doc_ref, product_draft)
+    finally:
+        # Drain whatever was queued, even if the product source failed part-way
+        report = writer.close()
+
+    print(f"Draft writes for {source_file}: {report}")
+    if report["failed"]:
+        print(f"WARNING: {report['failed']} drafts from {source_file} could not be written.")
+    return report["written"]
@@ -1,10 +1,48 @@
 import os
 import json
+import re
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from firebase_functions import https_fn, options
 from firebase_admin import firestore, initialize_app
 from google import genai
 from google.genai import types
 import numpy as np
+from .config import AIConfig, StaticContext, classify_intent, context_caches, router
+from .index_snapshot import nearest_products
+from .prompting import PromptBuilder, estimate_tokens, log_usage
+from .scheduler import GeminiUnavailable, Priority, schedule
+from telemetry import registry, span, traced
+
+# Speculative retrieval runs here, overlapping the first model call
+_prefetch_pool = ThreadPoolExecutor(max_workers=AIConfig.PREFETCH_WORKERS, thread_name_prefix="chat-prefetch")
+
+# Intents where the model almost always searches the catalogue
+SPECULATIVE_INTENTS = ("product_lookup", "multi_product")
+
+# Declared once (not from the per-request closure) so it can live in a context cache
+SEARCH_PRODUCTS_TOOL = types.Tool(function_declarations=[types.FunctionDeclaration(
+    name="search_products",
+    description="Searches the product catalogue using semantic vector search. "
+                "Returns a list of relevant product objects.",
+    parameters=types.Schema(
+        type=types.Type.OBJECT,
+        properties={"query": types.Schema(type=types.Type.STRING, description="The search query string.")},
+        required=["query"],
+    ),
+)])
+
+# The static part of every first-turn request (see ContextCacheManager)
+CHAT_CONTEXT = StaticContext(
+    name="chat_assistant",
+    tools=(SEARCH_PRODUCTS_TOOL,),
+    tool_config=types.ToolConfig(
+        function_calling_config=types.FunctionCallingConfig(
+            mode=types.FunctionCallingConfigMode.AUTO
+        )
+    ),
+)
 
 # Initialize Firebase if not already done
 # Initialize Firebase if not already done - moved inside
@@ -14,6 +52,7 @@ import numpy as np
 #     pass
 
 @https_fn.on_call(region="europe-west1", memory=options.MemoryOption.MB_512)
+@traced("chat_assistant")
 def chat_assistant(req: https_fn.CallableRequest) -> dict:
     """
     AI Buyer Assistant that uses RAG to answer questions about products.
@@ -38,11 +77,11 @@ def chat_assistant(req: https_fn.CallableRequest) -> dict:
     db = firestore.client()
     
     # 2. Setup Gemini Client & Tools
-    client = genai.Client(
+    client = schedule(genai.Client(
         vertexai=True, 
         project=os.environ.get("GOOGLE_CLOUD_PROJECT"), 
         location=os.environ.get("GOOGLE_CLOUD_LOCATION", "europe-west1")
-    )
+    ), Priority.INTERACTIVE)
 
     # Define the Search Tool function
     def search_products(query: str) -> list[dict]:
@@ -54,39 +93,39 @@ def chat_assistant(req: https_fn.CallableRequest) -> dict:
             A list of relevant product objects.
         """
         # Generate embedding for the query
-        emb_resp = client.models.embed_content(
-            model="text-embedding-004",
-            contents=query
-        )
+        with span("chat.embed"):
+            emb_resp = client.models.embed_content(
+                model="text-embedding-004",
+                contents=query
+            )
         query_vector = emb_resp.embeddings[0].values
         
-        # Perform Vector Search in Firestore
-        # Note: Requires a vector index on 'embedding_field'
-        products_ref = db.collection("products")
-        vector_query = products_ref.find_nearest(
-            vector_field="embedding_field",
-            query_vector=firestore.Vector(query_vector),
-            distance_measure=firestore.DistanceMeasure.COSINE,
-            limit=5
-        )
-        
-        results = []
-        for doc in vector_query.get():
-            data = doc.to_dict()
-            # Remove embedding field to save tokens
-            data.pop("embedding_field", None) 
-            data["id"] = doc.id
-            results.append(data)
+        # Vector search over the memory-mapped index snapshot (Firestore
+        # find_nearest on 'embedding_field' until the first snapshot exists)
+        with span("chat.vector_search") as s:
+            results = nearest_products(db, "products_live", query_vector, limit=5)
+            for data in results:
+                data.pop("vector_distance", None)
+            s.set(results=len(results))
             
         print(f"Found {len(results)} products for query: {query}")
         return results
 
+    # Speculative retrieval: search for the raw message while history is read and
+    # the model decides on its tool call (contextvars copied so spans nest correctly)
+    intent = classify_intent(message)
+    prefetch = None
+    if AIConfig.CHAT_SPECULATIVE_RETRIEVAL and intent in SPECULATIVE_INTENTS:
+        prefetch = _prefetch_pool.submit(contextvars.copy_context().run, search_products, message)
+        registry.counter("chat.prefetch.started").inc()
+
     # 3. Retrieve Conversation History
     # We store history in: chats/{sessionId}/messages/{messageId}
     history = []
     if session_id:
         messages_ref = db.collection("chats").document(session_id).collection("messages").order_by("created_at").limit(10)
-        docs = messages_ref.get()
+        with span("chat.history"):
+            docs = messages_ref.get()
         for doc in docs:
             msg_data = doc.to_dict()
             role = msg_data.get("role") # 'user' or 'model'
@@ -95,26 +134,42 @@ def chat_assistant(req: https_fn.CallableRequest) -> dict:
                 history.append(types.Content(role=role, parts=[types.Part.from_text(text=content)]))
 
     # 4. Generate Response with Tools
-    # First, let the model decide if it needs to search
-    tool_config = types.ToolConfig(
-        function_calling_config=types.FunctionCallingConfig(
-            mode=types.FunctionCallingMode.AUTO
-        )
-    )
+    # First, let the model decide if it needs to search (tool declaration and
+    # config come from CHAT_CONTEXT, cached when large enough)
     
     # Add user message to history
     history.append(types.Content(role="user", parts=[types.Part.from_text(text=message)]))
     
-    response = client.models.generate_content(
-        model="gemini-1.5-flash-001",
-        contents=history,
-        tools=[search_products], # Expose the python function as a tool
-        config=types.GenerateContentConfig(
-            temperature=0.7,
-            tools=[types.Tool(function_declarations=[search_products])],
-             # We just pass the function directly in updated SDKs or wrap it
-        )
-    )
+    # Pick the model for this turn: simple intents go to the fast route
+    route = router.select(intent)
+    
+    try:
+        with span("chat.generate", intent=intent, route=route.name, model=route.model) as s:
+            response = context_caches.generate_content(
+                client,
+                route.model,
+                CHAT_CONTEXT,
+                history,
+                temperature=0.7,
+                # Tool calls are executed manually below
+                automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True),
+            )
+    except GeminiUnavailable as e:
+        print(f"Chat degraded (generation unavailable): {e}")
+        try:
+            matches = prefetch.result() if prefetch else search_products(message)
+        except Exception as search_error:
+            # Still a degraded reply, whatever failed (embedding, Firestore, index snapshot)
+            print(f"Chat degraded search failed: {search_error}")
+            matches = []
+        return {
+            "response": degraded_answer(matches),
+            "sessionId": session_id or "new_session",
+            "degraded": True
+        }
+    
+    router.record(route, s.duration_ms, response, intent)
+    log_usage("chat_assistant.route", response)
     
     # Simple single-turn tool use handling (loop needed for multi-turn)
     # The SDK handles function execution if configured, or we handle it manually.
@@ -128,44 +183,117 @@ def chat_assistant(req: https_fn.CallableRequest) -> dict:
             if call.name == "search_products":
                 # Execute tool
                 query_arg = call.args.get("query")
-                search_results = search_products(query_arg)
+                try:
+                    search_results = take_prefetch(prefetch, message, query_arg)
+                    prefetch = None
+                    if search_results is None:
+                        search_results = search_products(query_arg)
+                except GeminiUnavailable as e:
+                    print(f"Chat degraded (search unavailable): {e}")
+                    final_text = degraded_answer([])
+                    continue
                 
-                # Send tool output back to model
+                # Send tool output back to model as a compact table
+                # (whitelisted fields, truncated descriptions) instead of raw docs,
+                # fitted into what the conversation leaves of the per-call budget
+                history_tokens = estimate_tokens(" ".join(p.text or "" for c in history for p in c.parts))
+                budget = max(AIConfig.PROMPT_TOKEN_BUDGET - history_tokens, AIConfig.CHAT_TOOL_MIN_TOKENS)
+                table = PromptBuilder(client=client, model=route.model, budget=budget).build(
+                    "{candidates}", search_results)
                 tool_output = types.Part.from_function_response(
                     name="search_products",
-                    response={"products": search_results}
+                    response={"products": table}
                 )
                 
                 # Append intermediate steps to history (conceptually)
                 # Generate final answer based on tool output
-                final_resp = client.models.generate_content(
-                    model="gemini-1.5-flash-001",
-                    contents=[
-                        *history, # Original context
-                        response.candidates[0].content, # The function call
-                        types.Content(role="tool", parts=[tool_output]) # The result
-                    ]
-                )
+                try:
+                    with span("chat.generate_answer", route=route.name, model=route.model) as s:
+                        final_resp = client.models.generate_content(
+                            model=route.model,
+                            contents=[
+                                *history, # Original context
+                                response.candidates[0].content, # The function call
+                                types.Content(role="tool", parts=[tool_output]) # The result
+                            ]
+                        )
+                except GeminiUnavailable as e:
+                    print(f"Chat degraded (answer unavailable): {e}")
+                    final_text = degraded_answer(search_results)
+                    continue
+                router.record(route, s.duration_ms, final_resp)
+                log_usage("chat_assistant.answer", final_resp)
                 final_text = final_resp.text
     else:
         final_text = response.text
 
+    if prefetch is not None:
+        # The model answered without searching: the speculative results are dropped
+        prefetch.cancel()
+        registry.counter("chat.prefetch.unused").inc()
+
     # 5. Persist History
     if session_id:
-        # Save User Message
-        db.collection("chats").document(session_id).collection("messages").add({
-            "role": "user",
-            "content": message,
-            "created_at": firestore.SERVER_TIMESTAMP
-        })
-        # Save AI Response
-        db.collection("chats").document(session_id).collection("messages").add({
-            "role": "model",
-            "content": final_text,
-            "created_at": firestore.SERVER_TIMESTAMP
-        })
+        with span("chat.persist"):
+            # Save User Message
+            db.collection("chats").document(session_id).collection("messages").add({
+                "role": "user",
+                "content": message,
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
+            # Save AI Response
+            db.collection("chats").document(session_id).collection("messages").add({
+                "role": "model",
+                "content": final_text,
+                "created_at": firestore.SERVER_TIMESTAMP
+            })
 
     return {
         "response": final_text,
         "sessionId": session_id or "new_session" # In reality generate a real ID
     }
+
+def degraded_answer(products: list) -> str:
+    """Plain reply used when Gemini is unavailable (circuit open or queue timeout)."""
+    if not products:
+        return "Sorry, our assistant is busy right now. Please try again in a moment."
+    lines = [
+        f"- {p.get('title')}" + (f" ({p.get('price')} {p.get('currency') or 'EUR'})" if p.get("price") is not None else "")
+        for p in products[:5]
+    ]
+    return "Our assistant is busy right now, but these products match your question:\n" + "\n".join(lines)
+
+def _words(text: str) -> set:
+    return {w for w in re.findall(r"\w+", (text or "").lower()) if len(w) > 2}
+
+def query_overlap(message: str, query: str) -> float:
+    """Share of the tool query's words that also appear in the user's message."""
+    query_words = _words(query)
+    if not query_words:
+        return 0.0
+    return len(query_words & _words(message)) / len(query_words)
+
+def take_prefetch(prefetch, message: str, query: str):
+    """
+    Returns the speculative search results if the model's query is close enough
+    to the message they were fetched for, else None (and the prefetch is dropped).
+    A hit saves the embedding and vector search round trips on the critical path.
+    """
+    if prefetch is None:
+        return None
+    if query_overlap(message, query) < AIConfig.SPECULATIVE_MIN_OVERLAP:
+        prefetch.cancel()
+        registry.counter("chat.prefetch.miss").inc()
+        return None
+    started = time.perf_counter()
+    try:
+        results = prefetch.result()
+    except Exception as e:
+        print(f"Speculative search failed, searching again: {e}")
+        registry.counter("chat.prefetch.failed").inc()
+        return None
+    # Whatever we still had to wait for was not overlapped with the model call
+    registry.histogram("chat.prefetch.wait_ms").observe((time.perf_counter() - started) * 1000)
+    registry.counter("chat.prefetch.hit").inc()
+    registry.counter("chat.round_trips_saved").inc(2)  # embed_content + find_nearest
+    return results
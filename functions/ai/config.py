@@ -1,25 +1,26 @@
+import collections
+import datetime
+import hashlib
+import json
+import logging
 import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from telemetry import registry
+
+logger = logging.getLogger(__name__)
 
 class AIConfig:
     # Model Configuration
-    # Using the preview model as requested for better reasoning capabilities
-    MODEL_NAME = "gemini-2.0-flash-exp" # "gemini-3-flash-preview" might not be available in all SDK versions yet, using 2.0 flash exp or falling back to a known valid string if needed. 
-    # Wait, the user specifically asked for "gemini-3-flash-preview". 
-    # I should use that string, but I'll add a fallback in case it fails, or just trust the user.
-    # Note: As of my knowledge cutoff, gemini-3 might not be public, but I'll follow instructions.
-    # Actually, let's use the exact string the user gave: "gemini-3-flash-preview"
-    # But usually these have specific version identifiers. I will stick to what was requested but be ready to debug.
-    
-    # Correction: The user said "gemini-3-flash-preview". I will use it.
-    MODEL_NAME = "gemini-1.5-pro-002" # Reverting to a known robust model for high reasoning or "gemini-1.5-flash-002" for speed.
-    # CAUTION: "gemini-3-flash-preview" is likely a hallucination or a very new private preview. 
-    # I will set it to "gemini-1.5-flash-002" (latest stable flash) or "gemini-2.0-flash-exp" if available.
-    # HOWEVER, the User EXPLICITLY requested "gemini-3-flash-preview". I will use it but add a comment.
-    MODEL_NAME = "gemini-2.0-flash-exp" # Let's use 2.0 flash exp which is the latest public "next gen". 
-    # If the user is internal Google, they might access 3. 
-    # I will assume "gemini-1.5-flash" is the safe bet for "feeding" but I'll update it to check env.
-    
+    # MODEL_NAME is the large model used for multi-product reasoning and
+    # catalogue extraction; FAST_MODEL serves simple chat intents (see routing below).
     MODEL_NAME = os.environ.get("GOOGLE_GENAI_MODEL", "gemini-2.0-flash-exp")
+    FAST_MODEL = os.environ.get("GOOGLE_GENAI_FAST_MODEL", "gemini-2.0-flash-lite-001")
 
     # Generation Configs
     JSON_GENERATION_CONFIG = {
@@ -37,5 +38,499 @@ class AIConfig:
         "max_output_tokens": 8192,
     }
 
+    # Prompt Budgets
+    # Upper bound on prompt tokens for RAG calls (candidates are trimmed to fit)
+    PROMPT_TOKEN_BUDGET = int(os.environ.get("GENAI_PROMPT_TOKEN_BUDGET", "6000"))
+    DESCRIPTION_MAX_CHARS = 280
+    # Smallest budget the chat search results get, however long the conversation
+    CHAT_TOOL_MIN_TOKENS = 500
+    # Local estimate: ~4 characters per token for Latin text, far fewer for
+    # Greek (and other non-Latin scripts), which much of the catalogue is in
+    NON_LATIN_CHARS_PER_TOKEN = float(os.environ.get("GENAI_NON_LATIN_CHARS_PER_TOKEN", "2.0"))
+    # Use the countTokens API (extra round trip) instead of the local estimate
+    EXACT_TOKEN_COUNT = os.environ.get("GENAI_EXACT_TOKEN_COUNT", "false").lower() == "true"
+
+    # Catalogue Extraction Cache
+    # Reuses Gemini extraction results for byte-identical re-uploads (see ai/extraction_cache.py)
+    EXTRACTION_CACHE_ENABLED = os.environ.get("GENAI_EXTRACTION_CACHE", "true").lower() == "true"
+    EXTRACTION_CACHE_PREFIX = "extraction_cache/"
+    # Follow-up requests for the rest of a catalogue whose extraction output was cut off
+    EXTRACTION_MAX_PASSES = int(os.environ.get("GENAI_EXTRACTION_MAX_PASSES", "4"))
+    EXTRACTION_OVERLAP_WINDOW = 20   # products at the end of a pass that a follow-up may repeat
+
+    # Context Caching (see ContextCacheManager below)
+    # Static prompt parts are stored as Vertex cached content and referenced by name
+    CONTEXT_CACHE_ENABLED = os.environ.get("GENAI_CONTEXT_CACHE", "true").lower() == "true"
+    CONTEXT_CACHE_TTL_SEC = int(os.environ.get("GENAI_CONTEXT_CACHE_TTL_SEC", "3600"))
+    CONTEXT_CACHE_REFRESH_SEC = 600   # a cache in use is extended once less than this is left
+    CONTEXT_CACHE_MARGIN_SEC = 30     # never reference a cache that may expire mid-request
+    # Vertex rejects smaller caches; below this static parts are sent inline
+    CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("GENAI_CONTEXT_CACHE_MIN_TOKENS", "2048"))
+    # Catalogue files this large are cached from the first extraction pass, not only for follow-ups
+    CONTEXT_CACHE_FILE_MIN_BYTES = int(os.environ.get("GENAI_CONTEXT_CACHE_FILE_MIN_BYTES", str(1024 * 1024)))
+    CACHED_INPUT_PRICE_RATIO = 0.25   # cached prompt tokens are billed at a quarter of the input price
+
+    # Draft Writes (BulkWriter, see ai/draft_writer.py)
+    DRAFT_WRITE_MAX_PENDING = int(os.environ.get("DRAFT_WRITE_MAX_PENDING", "1000"))
+    DRAFT_WRITE_MAX_ATTEMPTS = 5
+    DRAFT_WRITE_MAX_OPS_PER_SECOND = int(os.environ.get("DRAFT_WRITE_MAX_OPS_PER_SECOND", "2000"))
+
+    # Request Scheduler (see ai/scheduler.py)
+    # Per-model limits; GENAI_MODEL_LIMITS may override them with JSON, e.g.
+    # {"gemini-2.0-flash-exp": {"concurrency": 4, "tokens_per_minute": 200000}}
+    MODEL_LIMITS = {
+        "default": {"concurrency": 8, "tokens_per_minute": 1000000},
+        "text-embedding-004": {"concurrency": 16, "tokens_per_minute": 2000000},
+    }
+    MODEL_LIMITS.update(json.loads(os.environ.get("GENAI_MODEL_LIMITS", "{}")))
+    BATCH_CONCURRENCY_SHARE = 0.75   # batch work never takes the last quarter of a model's slots
+    INTERACTIVE_QUEUE_TIMEOUT_SEC = 10.0
+    BATCH_QUEUE_TIMEOUT_SEC = 300.0
+    CIRCUIT_FAILURE_THRESHOLD = 5
+    CIRCUIT_COOLDOWN_SEC = 30.0
+    # Shared quota (see ai/quota.py): lanes in every service draw tokens from one Firestore bucket per model
+    SHARED_QUOTA_ENABLED = os.environ.get("GENAI_SHARED_QUOTA", "true").lower() == "true"
+    QUOTA_GRANT_SEC = 2.0               # a grant covers at least this much of the model's rate
+    QUOTA_INTERACTIVE_WINDOW_SEC = 10.0  # batch yields while an interactive grant is this recent
+    QUOTA_INTERACTIVE_RESERVE = 0.5     # share of the bucket batch grants leave to shoppers meanwhile
+    QUOTA_MAX_RETRY_SEC = 2.0
+    QUOTA_FALLBACK_SEC = 30.0           # refill locally this long after Firestore fails, then retry
+
     LOCATION = os.environ.get("GOOGLE_CLOUD_LOCATION", "europe-west1")
     PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
+
+    # Model Routing
+    # Latency SLOs (p95 over the last ROUTE_WINDOW calls, up to ROUTE_SAMPLE_MAX_AGE_SEC old) per route; see ModelRouter
+    FAST_ROUTE_SLO_MS = int(os.environ.get("GENAI_FAST_ROUTE_SLO_MS", "1500"))
+    REASONING_ROUTE_SLO_MS = int(os.environ.get("GENAI_REASONING_ROUTE_SLO_MS", "6000"))
+    ROUTE_WINDOW = 50
+    ROUTE_SAMPLE_MAX_AGE_SEC = 120    # older latencies no longer count, so a breached route recovers
+    ROUTE_PROBE_SHARE = 0.05          # of traffic still sent to a route over its SLO, to measure it again
+
+    # Speculative Retrieval (chat_assistant)
+    # Embed + search the user's message while the first model call runs
+    CHAT_SPECULATIVE_RETRIEVAL = os.environ.get("CHAT_SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+    SPECULATIVE_MIN_OVERLAP = 0.6    # tool query vs message word overlap needed to reuse the prefetch
+    PREFETCH_WORKERS = 8
+
+    # Bundle Graph (see ai/bundle_graph.py)
+    # Precomputed complements per live product; suggest_bundles serves productTitle requests from it
+    BUNDLE_GRAPH_ENABLED = os.environ.get("BUNDLE_GRAPH_ENABLED", "true").lower() == "true"
+    BUNDLE_GRAPH_SCHEDULE = os.environ.get("BUNDLE_GRAPH_SCHEDULE", "every day 03:30")
+    BUNDLE_GRAPH_NEIGHBOURS = 12      # adjacency list length per product
+    BUNDLE_SIZE = 4                   # seed product + up to 3 complements
+    BUNDLES_PER_PRODUCT = 3
+    BUNDLE_SIGNAL_WEIGHTS = {"embedding": 0.3, "tags": 0.3, "co_purchase": 0.4}
+    BUNDLE_MIN_SCORE = 0.15
+    BUNDLE_DUPLICATE_SIMILARITY = 0.97  # above this two products are near-duplicates, not complements
+    CO_PURCHASE_WINDOW_DAYS = 180
+    CO_PURCHASE_MAX_ITEMS = 50        # distinct products per basket that count towards pairs
+
+    # Product Index Snapshots (see ai/index_snapshot.py)
+    # Embeddings + metadata per collection in Cloud Storage, memory-mapped from /tmp by each instance
+    INDEX_SNAPSHOT_ENABLED = os.environ.get("INDEX_SNAPSHOT_ENABLED", "true").lower() == "true"
+    INDEX_SNAPSHOT_BUCKET = os.environ.get("INDEX_SNAPSHOT_BUCKET") or os.environ.get("FIREBASE_STORAGE_BUCKET")
+    INDEX_SNAPSHOT_PREFIX = "index_snapshots/"
+    INDEX_SNAPSHOT_DIR = os.environ.get("INDEX_SNAPSHOT_DIR", "/tmp/product_index")
+    INDEX_SNAPSHOT_SCHEDULE = os.environ.get("INDEX_SNAPSHOT_SCHEDULE", "every 6 hours")
+    INDEX_COLLECTIONS = ("products_live",)
+    INDEX_MANIFEST_CHECK_SEC = 300    # how often an instance looks for a newer snapshot
+    INDEX_DELTA_SYNC_SEC = 30         # how often it applies changes made since its snapshot
+    INDEX_DELTA_OVERLAP_SEC = 60      # re-read window for clock skew (re-applying a change is harmless)
+
+    # Request Coalescing (see ai/singleflight.py)
+    # Identical concurrent requests share one computation per instance; with the
+    # lease enabled, instances also share it through a short-lived Firestore document
+    SINGLEFLIGHT_LEASE_ENABLED = os.environ.get("SINGLEFLIGHT_LEASE_ENABLED", "false").lower() == "true"
+    SINGLEFLIGHT_LEASE_SEC = 30.0     # a leader that has not finished by then is presumed dead
+    SINGLEFLIGHT_RESULT_SEC = 10.0    # how long a finished result is served to late arrivals
+    SINGLEFLIGHT_POLL_SEC = 0.2
+
+
+# --- Model Routing ---
+# Simple chat intents go to a small fast model; multi-product reasoning
+# (comparisons, bundles, "what do I need for...") goes to MODEL_NAME.
+# Intents come from a local keyword classifier, so routing costs no extra
+# model call. Each route has a latency SLO: when its recent p95 exceeds the
+# SLO (or its circuit is open) requests fall back to the other route.
+
+@dataclass(frozen=True)
+class Route:
+    name: str
+    model: str
+    slo_ms: float
+    fallback: Optional[str]
+    # List prices, USD per 1M tokens (update when Vertex pricing changes)
+    input_price: float
+    output_price: float
+
+
+ROUTES = {
+    "fast": Route("fast", AIConfig.FAST_MODEL, AIConfig.FAST_ROUTE_SLO_MS, "reasoning", 0.075, 0.30),
+    "reasoning": Route("reasoning", AIConfig.MODEL_NAME, AIConfig.REASONING_ROUTE_SLO_MS, "fast", 0.15, 0.60),
+}
+
+# Intent -> route
+INTENT_ROUTES = {
+    "greeting": "fast",
+    "order_status": "fast",
+    "product_lookup": "fast",
+    "multi_product": "reasoning",
+}
+
+_INTENT_PATTERNS = [
+    ("order_status", re.compile(
+        r"\b(order|orders|tracking|track|shipped|shipping|deliver(y|ed)?|refund|return|invoice)\b"
+        r"|παραγγελ|αποστολ|παράδοσ|επιστροφ|τιμολόγ", re.IGNORECASE)),
+    ("multi_product", re.compile(
+        r"\b(compare|comparison|vs|versus|difference|between|bundle|set|kit|together|everything|"
+        r"what (else|do i need)|which .+ (or|and) |recommend .+ and|for (a|my) (project|room|house))\b"
+        r"|σύγκρι|διαφορ|μαζί|σετ|ό,?τι χρειάζομαι", re.IGNORECASE)),
+    ("greeting", re.compile(
+        r"^\s*(hi|hello|hey|good (morning|afternoon|evening)|thanks|thank you|γει[αά]|καλημέρα|καλησπέρα|ευχαριστώ)\b[\s!.,?]*$",
+        re.IGNORECASE)),
+]
+
+
+def classify_intent(message: str) -> str:
+    """Cheap local intent classifier (regex keywords, English and Greek)."""
+    text = (message or "").strip()
+    for intent, pattern in _INTENT_PATTERNS:
+        if pattern.search(text):
+            return intent
+    # Long, list-like questions usually need reasoning across several products
+    if len(text) > 240 or text.count(",") >= 3 or text.count("?") >= 2:
+        return "multi_product"
+    return "product_lookup"
+
+
+class ModelRouter:
+    """
+    Chooses a route per intent and tracks per-route latency against its SLO.
+    A route over its SLO keeps a ROUTE_PROBE_SHARE of its traffic, and its
+    samples expire after ROUTE_SAMPLE_MAX_AGE_SEC, so it is taken back once
+    it is fast again (or once nothing recent says it is slow).
+    """
+
+    def __init__(self, routes: Dict[str, Route] = ROUTES, window: int = AIConfig.ROUTE_WINDOW,
+                 max_age_sec: float = AIConfig.ROUTE_SAMPLE_MAX_AGE_SEC,
+                 probe_share: float = AIConfig.ROUTE_PROBE_SHARE):
+        self.routes = routes
+        self.max_age_sec = max_age_sec
+        self.probe_share = probe_share
+        self._latencies = {name: collections.deque(maxlen=window) for name in routes}
+        self._lock = threading.Lock()
+
+    def p95(self, route_name: str) -> Optional[float]:
+        cutoff = time.monotonic() - self.max_age_sec
+        with self._lock:
+            samples = sorted(ms for at, ms in self._latencies[route_name] if at >= cutoff)
+        if len(samples) < 5:
+            return None
+        return samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))]
+
+    def healthy(self, route: Route) -> bool:
+        from .scheduler import get_scheduler  # scheduler imports this module
+        p95 = self.p95(route.name)
+        return (p95 is None or p95 <= route.slo_ms) and get_scheduler().is_available(route.model)
+
+    def select(self, intent: str) -> Route:
+        route = self.routes[INTENT_ROUTES.get(intent, "reasoning")]
+        if not self.healthy(route) and route.fallback:
+            fallback = self.routes[route.fallback]
+            if self.healthy(fallback):
+                if self._probe(route):
+                    registry.counter(f"route.{route.name}.probes").inc()
+                    return route
+                registry.counter(f"route.{route.name}.fallbacks").inc()
+                return fallback
+        return route
+
+    def _probe(self, route: Route) -> bool:
+        """Whether this call measures a slow route again (never one whose circuit is open)."""
+        from .scheduler import get_scheduler
+        return random.random() < self.probe_share and get_scheduler().is_available(route.model)
+
+    def record(self, route: Route, latency_ms: float, response: Any = None, intent: Optional[str] = None):
+        """Per-route latency, SLO breaches, token usage and estimated cost."""
+        with self._lock:
+            self._latencies[route.name].append((time.monotonic(), latency_ms))
+        registry.histogram(f"route.{route.name}.latency_ms").observe(latency_ms)
+        registry.counter(f"route.{route.name}.calls").inc()
+        if intent:
+            registry.counter(f"route.intent.{intent}").inc()
+        if latency_ms > route.slo_ms:
+            registry.counter(f"route.{route.name}.slo_breaches").inc()
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            prompt_tokens = usage.prompt_token_count or 0
+            cached_tokens = usage.cached_content_token_count or 0
+            output_tokens = usage.candidates_token_count or 0
+            registry.counter(f"route.{route.name}.prompt_tokens").inc(prompt_tokens)
+            registry.counter(f"route.{route.name}.cached_tokens").inc(cached_tokens)
+            registry.counter(f"route.{route.name}.output_tokens").inc(output_tokens)
+            input_tokens = prompt_tokens - cached_tokens + cached_tokens * AIConfig.CACHED_INPUT_PRICE_RATIO
+            registry.counter(f"route.{route.name}.cost_usd").inc(
+                (input_tokens * route.input_price + output_tokens * route.output_price) / 1e6
+            )
+
+
+router = ModelRouter()
+
+
+# --- Context Caching ---
+# Prompt parts that do not change between calls (system instructions, tool
+# declarations, a catalogue file queried more than once) are stored once as
+# Vertex cached content and referenced by name, so later calls neither
+# resend nor re-process them. A cache is identified by a hash of the model
+# and its parts and carried in its display name, so every instance finds
+# (on its first lookup) and shares the same cache. Caches in use are
+# extended before they expire; one that has expired or been deleted anyway
+# makes the call fall back to sending the parts inline, and is recreated on
+# the next call. Parts below CONTEXT_CACHE_MIN_TOKENS, models without cache
+# support and failed creations are sent inline. Every call records how many
+# of its prompt tokens were served from the cache.
+
+@dataclass(frozen=True)
+class StaticContext:
+    """The unchanging leading part of a request."""
+    name: str
+    system_instruction: Optional[str] = None
+    contents: Tuple[Any, ...] = ()
+    tools: Tuple[Any, ...] = ()
+    tool_config: Any = None
+    # Identifies parts whose content is not in the request itself (a file by URI + content hash)
+    key: Optional[str] = None
+
+    def fingerprint(self, model: str) -> str:
+        parts = [model, self.key or "", self.system_instruction or ""]
+        parts += [_dump(p) for p in self.contents + self.tools]
+        parts.append(_dump(self.tool_config))
+        return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()[:24]
+
+    def estimated_tokens(self) -> Optional[int]:
+        """Local estimate; None when a file part makes it unknowable."""
+        from .scheduler import estimate_request_tokens
+        if any(getattr(p, "file_data", None) for c in self.contents for p in (getattr(c, "parts", None) or [c])):
+            return None
+        tokens = estimate_request_tokens(list(self.contents)) + estimate_request_tokens(self.system_instruction)
+        return tokens + sum(estimate_request_tokens(_dump(t)) for t in self.tools)
+
+
+def _dump(value: Any) -> str:
+    if value is None:
+        return ""
+    if hasattr(value, "model_dump_json"):
+        return value.model_dump_json(exclude_none=True)
+    return str(value)
+
+
+def _merge_turns(contents: List[Any]) -> List[Any]:
+    """Joins consecutive Content turns of the same role (the inline request keeps its old shape)."""
+    from google.genai import types
+    merged: List[Any] = []
+    for content in contents:
+        previous = merged[-1] if merged else None
+        if (isinstance(content, types.Content) and isinstance(previous, types.Content)
+                and previous.role == content.role):
+            merged[-1] = types.Content(role=content.role, parts=list(previous.parts or []) + list(content.parts or []))
+        else:
+            merged.append(content)
+    return merged
+
+
+def is_cache_miss(error: Exception) -> bool:
+    """The referenced cached content no longer exists (expired or deleted)."""
+    code = getattr(error, "code", None)
+    return code in (400, 403, 404) and "cache" in str(error).lower()
+
+
+@dataclass
+class CacheEntry:
+    name: str
+    expire_at: float
+    tokens: Optional[int]
+
+
+class ContextCacheManager:
+    """Creates, shares, extends and falls back from Vertex cached content; thread-safe."""
+
+    def __init__(self, ttl_sec: float = AIConfig.CONTEXT_CACHE_TTL_SEC,
+                 refresh_sec: float = AIConfig.CONTEXT_CACHE_REFRESH_SEC,
+                 min_tokens: int = AIConfig.CONTEXT_CACHE_MIN_TOKENS,
+                 enabled: bool = AIConfig.CONTEXT_CACHE_ENABLED):
+        self.ttl_sec = ttl_sec
+        self.refresh_sec = refresh_sec
+        self.min_tokens = min_tokens
+        self.enabled = enabled
+        self._entries: Dict[str, CacheEntry] = {}
+        self._unavailable: Dict[str, float] = {}   # fingerprint -> retry after
+        self._listed = False
+        self._list_lock = threading.Lock()
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, fingerprint: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(fingerprint, threading.Lock())
+
+    @staticmethod
+    def _expire_at(cached: Any, default: float) -> float:
+        expire_time = getattr(cached, "expire_time", None)
+        return expire_time.timestamp() if isinstance(expire_time, datetime.datetime) else default
+
+    def _adopt_existing(self, client):
+        """Caches created by other instances (once per process)."""
+        with self._list_lock:
+            if self._listed:
+                return
+            self._listed = True
+            now = time.time()
+            try:
+                for cached in client.caches.list():
+                    fingerprint = (cached.display_name or "").rsplit(":", 1)[-1]
+                    expire_at = self._expire_at(cached, now)
+                    if fingerprint and expire_at > now + AIConfig.CONTEXT_CACHE_MARGIN_SEC:
+                        usage = getattr(cached, "usage_metadata", None)
+                        current = self._entries.get(fingerprint)
+                        if current is None or current.expire_at < expire_at:
+                            self._entries[fingerprint] = CacheEntry(cached.name, expire_at,
+                                                                    getattr(usage, "total_token_count", None))
+            except Exception as e:
+                logger.warning(f"Could not list context caches: {e}")
+
+    def lookup(self, client, model: str, context: StaticContext) -> Optional[str]:
+        """Name of a live cache for the context (created if needed), or None to send it inline."""
+        if not self.enabled:
+            return None
+        estimate = context.estimated_tokens()
+        if estimate is not None and estimate < self.min_tokens:
+            registry.counter(f"context_cache.{context.name}.too_small").inc()
+            return None
+        fingerprint = context.fingerprint(model)
+        with self._key_lock(fingerprint):
+            now = time.time()
+            if self._unavailable.get(fingerprint, 0) > now:
+                return None
+            self._adopt_existing(client)
+            entry = self._entries.get(fingerprint)
+            if entry is not None and entry.expire_at - now > AIConfig.CONTEXT_CACHE_MARGIN_SEC:
+                if entry.expire_at - now < self.refresh_sec:
+                    self._extend(client, context, entry)
+                registry.counter(f"context_cache.{context.name}.reused").inc()
+                return entry.name
+            return self._create(client, model, context, fingerprint)
+
+    def _extend(self, client, context: StaticContext, entry: CacheEntry):
+        from google.genai import types
+        try:
+            cached = client.caches.update(name=entry.name,
+                                          config=types.UpdateCachedContentConfig(ttl=f"{int(self.ttl_sec)}s"))
+            entry.expire_at = self._expire_at(cached, time.time() + self.ttl_sec)
+            registry.counter(f"context_cache.{context.name}.extended").inc()
+        except Exception as e:
+            # Still usable until it expires; the next call tries again
+            logger.warning(f"Could not extend context cache {entry.name}: {e}")
+
+    def _create(self, client, model: str, context: StaticContext, fingerprint: str) -> Optional[str]:
+        from google.genai import types
+        try:
+            cached = client.caches.create(model=model, config=types.CreateCachedContentConfig(
+                display_name=f"{context.name}:{fingerprint}",
+                system_instruction=context.system_instruction,
+                contents=list(context.contents) or None,
+                tools=list(context.tools) or None,
+                tool_config=context.tool_config,
+                ttl=f"{int(self.ttl_sec)}s",
+            ))
+        except Exception as e:
+            # Too small, unsupported model, quota: send inline and do not retry for a while
+            retry_sec = self.ttl_sec if getattr(e, "code", None) == 400 else 60.0
+            self._unavailable[fingerprint] = time.time() + retry_sec
+            registry.counter(f"context_cache.{context.name}.create_failed").inc()
+            logger.warning(f"Context cache for {context.name} on {model} unavailable, sending inline: {e}")
+            return None
+        usage = getattr(cached, "usage_metadata", None)
+        entry = CacheEntry(cached.name, self._expire_at(cached, time.time() + self.ttl_sec),
+                           getattr(usage, "total_token_count", None))
+        self._entries[fingerprint] = entry
+        registry.counter(f"context_cache.{context.name}.created").inc()
+        logger.info(f"Created context cache {entry.name} for {context.name} on {model} ({entry.tokens} tokens)")
+        return entry.name
+
+    def invalidate(self, model: str, context: StaticContext):
+        self._entries.pop(context.fingerprint(model), None)
+
+    def request(self, client, model: str, context: StaticContext, contents: Any, cache: bool = True,
+                **config: Any) -> Tuple[List[Any], Any, Optional[str]]:
+        """(contents, GenerateContentConfig, cache name) for a call with the context in front."""
+        from google.genai import types
+        contents = list(contents) if isinstance(contents, (list, tuple)) else [contents]
+        name = self.lookup(client, model, context) if cache else None
+        if name is not None:
+            return contents, types.GenerateContentConfig(cached_content=name, **config), name
+        return _merge_turns(list(context.contents) + contents), types.GenerateContentConfig(
+            system_instruction=context.system_instruction,
+            tools=list(context.tools) or None,
+            tool_config=context.tool_config,
+            **config,
+        ), None
+
+    def generate_content(self, client, model: str, context: StaticContext, contents: Any,
+                         cache: bool = True, **config: Any):
+        request_contents, request_config, name = self.request(client, model, context, contents, cache, **config)
+        try:
+            response = client.models.generate_content(model=model, contents=request_contents, config=request_config)
+        except Exception as e:
+            if name is None or not is_cache_miss(e):
+                raise
+            response = client.models.generate_content(
+                model=model, **self._fallback(client, model, context, contents, name, e, **config))
+        self.record(context, model, getattr(response, "usage_metadata", None))
+        return response
+
+    def generate_content_stream(self, client, model: str, context: StaticContext, contents: Any,
+                                cache: bool = True, **config: Any) -> Iterator[Any]:
+        request_contents, request_config, name = self.request(client, model, context, contents, cache, **config)
+        usage = None
+        started = False
+        try:
+            for chunk in client.models.generate_content_stream(model=model, contents=request_contents,
+                                                               config=request_config):
+                started = True
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                yield chunk
+        except Exception as e:
+            if started or name is None or not is_cache_miss(e):
+                raise
+            for chunk in client.models.generate_content_stream(
+                    model=model, **self._fallback(client, model, context, contents, name, e, **config)):
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                yield chunk
+        self.record(context, model, usage)
+
+    def _fallback(self, client, model: str, context: StaticContext, contents: Any, name: str,
+                  error: Exception, **config: Any) -> Dict[str, Any]:
+        # Expired or deleted under us: this call goes inline, the next one recreates the cache
+        logger.warning(f"Context cache {name} for {context.name} is gone ({error}); sending inline")
+        registry.counter(f"context_cache.{context.name}.expired").inc()
+        self.invalidate(model, context)
+        request_contents, request_config, _ = self.request(client, model, context, contents, cache=False, **config)
+        return {"contents": request_contents, "config": request_config}
+
+    def record(self, context: StaticContext, model: str, usage: Any) -> int:
+        """Prompt tokens served from the cache for one call (metrics + log line)."""
+        if usage is None:
+            return 0
+        prompt_tokens = usage.prompt_token_count or 0
+        cached_tokens = usage.cached_content_token_count or 0
+        registry.counter(f"context_cache.{context.name}.calls").inc()
+        registry.counter(f"context_cache.{context.name}.prompt_tokens").inc(prompt_tokens)
+        registry.counter(f"context_cache.{context.name}.cached_tokens").inc(cached_tokens)
+        if cached_tokens:
+            registry.counter(f"context_cache.{context.name}.hits").inc()
+        logger.info(f"[{context.name}] {model}: {cached_tokens}/{prompt_tokens} prompt tokens from context cache")
+        return cached_tokens
+
+
+context_caches = ContextCacheManager()
@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from google.cloud.firestore_v1.bulk_writer import BulkRetry, BulkWriterOptions, SendMode
+
+from .config import AIConfig
+from telemetry import registry, span
+
+# Draft Write Stage
+# Catalogue drafts used to be written with db.batch(): 400 operations per
+# commit, one commit after another. DraftWriter hands the writes to
+# Firestore's BulkWriter instead, which commits batches of 20 in parallel,
+# ramps its rate (500/50/5) and retries individual failed writes. The number
+# of writes that are queued but not yet acknowledged is capped; when the cap
+# is reached set() blocks, which slows the embedding stage feeding it down to
+# what Firestore can absorb.
+
+logger = logging.getLogger(__name__)
+
+
+class DraftWriter:
+    """Parallel, retrying writer for one upload. Call close() to drain and get the report."""
+
+    def __init__(self, db, max_pending: int = AIConfig.DRAFT_WRITE_MAX_PENDING,
+                 max_attempts: int = AIConfig.DRAFT_WRITE_MAX_ATTEMPTS,
+                 max_ops_per_second: int = AIConfig.DRAFT_WRITE_MAX_OPS_PER_SECOND):
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.stats = {"queued": 0, "written": 0, "failed": 0, "retries": 0, "backpressure_waits": 0}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._started = time.perf_counter()
+        self._first_write_ms: Optional[float] = None
+        self._bulk = db.bulk_writer(options=BulkWriterOptions(
+            initial_ops_per_second=min(500, max_ops_per_second),
+            max_ops_per_second=max_ops_per_second,
+            mode=SendMode.parallel,
+            retry=BulkRetry.linear,
+        ))
+        self._bulk.on_write_result(self._on_result)
+        self._bulk.on_write_error(self._on_error)
+
+    # --- BulkWriter callbacks (run on its executor threads) ---
+
+    def _settle(self, key: str):
+        with self._cond:
+            self.stats[key] += 1
+            self._pending -= 1
+            if key == "written" and self._first_write_ms is None:
+                self._first_write_ms = (time.perf_counter() - self._started) * 1000
+            self._cond.notify_all()
+
+    def _on_result(self, reference, result, bulk_writer):
+        self._settle("written")
+
+    def _on_error(self, failure, bulk_writer) -> bool:
+        if failure.attempts < self.max_attempts:
+            with self._cond:
+                self.stats["retries"] += 1
+            return True
+        logger.error(f"Draft write failed after {failure.attempts} attempts: {failure.code} {failure.message}")
+        self._settle("failed")
+        return False
+
+    # --- Producer side ---
+
+    def set(self, reference, data: Dict[str, Any]):
+        with self._cond:
+            if self._pending >= self.max_pending:
+                self.stats["backpressure_waits"] += 1
+                self._wait_below(self.max_pending)
+            self._pending += 1
+            self.stats["queued"] += 1
+        self._bulk.set(reference, data)
+
+    def _wait_below(self, limit: int):
+        # Called with self._cond held. BulkWriter only sends full batches on its
+        # own, so if nothing settles for a while, flush the partial batch.
+        while self._pending >= limit:
+            before = self._pending
+            self._cond.wait(timeout=1.0)
+            if self._pending >= before:
+                self._cond.release()
+                try:
+                    self._bulk.flush()
+                finally:
+                    self._cond.acquire()
+
+    def close(self) -> Dict[str, Any]:
+        """Waits for every queued write, then returns this upload's write stats."""
+        with span("catalogue.write", ops=self.stats["queued"]) as s:
+            self._bulk.close()
+            elapsed = time.perf_counter() - self._started
+            report = dict(self.stats)
+            report["elapsed_ms"] = round(elapsed * 1000, 1)
+            report["writes_per_sec"] = round(report["written"] / elapsed, 1) if elapsed else None
+            report["first_write_ms"] = round(self._first_write_ms, 1) if self._first_write_ms is not None else None
+            s.set(**report)
+
+        registry.counter("catalogue.drafts_written").inc(report["written"])
+        registry.counter("catalogue.draft_write_failures").inc(report["failed"])
+        registry.counter("catalogue.draft_write_retries").inc(report["retries"])
+        if report["writes_per_sec"] is not None:
+            registry.histogram("catalogue.draft_writes_per_sec").observe(report["writes_per_sec"])
+        if self._first_write_ms is not None:
+            registry.histogram("catalogue.first_draft_ms").observe(self._first_write_ms)
+        return report
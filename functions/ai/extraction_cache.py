@@ -0,0 +1,123 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from firebase_admin import firestore
+
+from .config import AIConfig
+from telemetry import registry, span
+
+# Catalogue Extraction Cache
+# Gemini extraction of a catalogue is by far the most expensive step of an
+# upload. The same file often arrives twice (re-upload under another name,
+# duplicate storage trigger), so results are cached in the bucket as gzip
+# JSONL, keyed by the object's content hash plus the prompt and model that
+# produced them. Changing either invalidates the cache automatically.
+
+logger = logging.getLogger(__name__)
+
+UPLOADS_COLLECTION = "catalogue_uploads"
+
+
+def content_hash(object_data) -> Optional[str]:
+    """md5 (or crc32c for composite objects, which have no md5) from the storage event."""
+    md5 = getattr(object_data, "md5_hash", None)
+    if md5:
+        return f"md5:{md5}"
+    crc = getattr(object_data, "crc32c", None)
+    if crc:
+        return f"crc32c:{crc}"
+    return None
+
+
+def cache_key(object_hash: str, content_type: str, prompt: str, model: str) -> str:
+    digest = hashlib.sha256()
+    for part in (object_hash, content_type or "", model, prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """Stores extracted product lists in Cloud Storage under extraction_cache/<key>.jsonl.gz."""
+
+    def __init__(self, bucket, prefix: str = AIConfig.EXTRACTION_CACHE_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _path(self, key: str) -> str:
+        return f"{self.prefix}{key}.jsonl.gz"
+
+    def get(self, key: str):
+        """Returns (products, metadata) or None on a miss."""
+        try:
+            with span("catalogue.cache_lookup") as s:
+                blob = self.bucket.get_blob(self._path(key))
+                s.set(hit=blob is not None)
+                if blob is None:
+                    return None
+                raw = gzip.decompress(blob.download_as_bytes())
+                products = [json.loads(line) for line in raw.decode("utf-8").splitlines() if line]
+            return products, dict(blob.metadata or {})
+        except Exception as e:
+            logger.warning(f"Extraction cache read failed for {key}: {e}")
+            return None
+
+    def writer(self, key: str) -> "CacheWriter":
+        return CacheWriter(self.bucket.blob(self._path(key)), key)
+
+    def put(self, key: str, products: Iterable[Dict[str, Any]], metadata: Dict[str, Any]):
+        writer = self.writer(key)
+        for product in products:
+            writer.add(product)
+        writer.commit(metadata)
+
+
+class CacheWriter:
+    """Compresses products as they stream past; nothing is uploaded until commit()."""
+
+    def __init__(self, blob, key: str):
+        self.blob = blob
+        self.key = key
+        self.count = 0
+        self._buffer = io.BytesIO()
+        self._gz = gzip.GzipFile(fileobj=self._buffer, mode="wb")
+
+    def add(self, product: Dict[str, Any]):
+        self._gz.write(json.dumps(product, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        self._gz.write(b"\n")
+        self.count += 1
+
+    def commit(self, metadata: Dict[str, Any]):
+        self._gz.close()
+        try:
+            with span("catalogue.cache_store", bytes=self._buffer.tell(), products=self.count):
+                # GCS custom metadata values are strings
+                self.blob.metadata = {k: str(v) for k, v in metadata.items()}
+                self.blob.upload_from_string(self._buffer.getvalue(), content_type="application/gzip")
+        except Exception as e:
+            logger.warning(f"Extraction cache write failed for {self.key}: {e}")
+
+
+def record_upload(db, file_path: str, object_hash: Optional[str], outcome: str,
+                  products: int, extraction_ms: float, saved_ms: float = 0.0):
+    """Per-upload stats in 'catalogue_uploads': cache hit/miss and extraction time saved."""
+    registry.counter(f"catalogue.extraction_cache.{outcome}").inc()
+    if saved_ms:
+        registry.counter("catalogue.extraction_cache.saved_ms").inc(saved_ms)
+    try:
+        db.collection(UPLOADS_COLLECTION).add({
+            "file": file_path,
+            "content_hash": object_hash,
+            "extraction": outcome,
+            "products": products,
+            "extraction_ms": round(extraction_ms, 1),
+            "saved_ms": round(saved_ms, 1),
+            "created_at": firestore.SERVER_TIMESTAMP,
+        })
+    except Exception as e:
+        logger.warning(f"Failed to record upload stats for {file_path}: {e}")
@@ -0,0 +1,329 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from firebase_admin import firestore, storage
+from firebase_functions import firestore_fn, options, scheduler_fn
+from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
+from google.cloud.firestore_v1.vector import Vector
+
+from .config import AIConfig
+from telemetry import registry, span, traced
+
+# Product Index Snapshots
+# In-instance retrieval would otherwise have to read every product document
+# on each cold start. A scheduled job writes one snapshot per collection to
+# Cloud Storage instead:
+#   index_snapshots/{collection}/{version}/embeddings.npy   normalised float32 matrix
+#   index_snapshots/{collection}/{version}/metadata.json.gz product fields, same row order
+#   index_snapshots/{collection}/manifest.json              current version (written last)
+# An instance downloads the files once into /tmp (shared by every worker
+# process on it) and memory-maps the matrix, so warm-up is one sequential
+# read. Changes since the snapshot come from 'index_changes', fed by the
+# Firestore trigger below, and are applied as an in-memory overlay.
+# Old versions are left for a bucket lifecycle rule to expire.
+
+logger = logging.getLogger(__name__)
+
+CHANGES_COLLECTION = "index_changes"   # index_changes/{collection}/changes/{doc_id}
+
+
+def _bucket():
+    return storage.bucket(AIConfig.INDEX_SNAPSHOT_BUCKET)
+
+
+def _prefix(collection: str) -> str:
+    return f"{AIConfig.INDEX_SNAPSHOT_PREFIX}{collection}/"
+
+
+def _normalise(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.where(norms == 0, 1.0, norms)).astype(np.float32)
+
+
+def _index_row(doc_id: str, data: Dict[str, Any]) -> Optional[Tuple[np.ndarray, Dict[str, Any]]]:
+    """(vector, metadata) for an indexable document, or None (no embedding / not active)."""
+    data = dict(data)
+    embedding = data.pop("embedding_field", None)
+    if embedding is None or data.get("status", "active") != "active":
+        return None
+    # Timestamps and other Firestore types become strings, as they would in a prompt
+    meta = json.loads(json.dumps(data, default=str, ensure_ascii=False))
+    meta["id"] = doc_id
+    return np.asarray(embedding, dtype=np.float32), meta
+
+
+# --- Build ---
+
+def write_snapshot(db, bucket, collection: str) -> Dict[str, Any]:
+    """Writes a new snapshot of `collection` and points its manifest at it."""
+    started = time.time()
+    version = time.strftime("%Y%m%dT%H%M%S", time.gmtime(started)) + f"{int(started * 1000) % 1000:03d}Z"
+    vectors: List[np.ndarray] = []
+    rows: List[Dict[str, Any]] = []
+    skipped = 0
+    with span("index_snapshot.read", collection=collection):
+        for doc in db.collection(collection).stream():
+            row = _index_row(doc.id, doc.to_dict() or {})
+            if row is None or (vectors and len(row[0]) != len(vectors[0])):
+                skipped += 1
+                continue
+            vectors.append(row[0])
+            rows.append(row[1])
+
+    dim = len(vectors[0]) if vectors else 0
+    matrix = _normalise(np.stack(vectors)) if vectors else np.zeros((0, dim), dtype=np.float32)
+    base = f"{_prefix(collection)}{version}/"
+    manifest = {
+        "version": version,
+        "collection": collection,
+        "created_at": started,
+        "count": len(rows),
+        "dim": dim,
+        "embeddings": base + "embeddings.npy",
+        "metadata": base + "metadata.json.gz",
+    }
+    with span("index_snapshot.upload", collection=collection, products=len(rows)), \
+            tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "embeddings.npy")
+        np.save(path, matrix)
+        manifest["bytes"] = os.path.getsize(path)
+        bucket.blob(manifest["embeddings"]).upload_from_filename(path, content_type="application/octet-stream")
+        bucket.blob(manifest["metadata"]).upload_from_string(
+            gzip.compress(json.dumps(rows, ensure_ascii=False).encode("utf-8")), content_type="application/gzip")
+        # Readers only see the new version once both files are in place
+        bucket.blob(_prefix(collection) + "manifest.json").upload_from_string(
+            json.dumps(manifest), content_type="application/json")
+
+    registry.gauge(f"index_snapshot.{collection}.products").set(len(rows))
+    return dict(manifest, skipped=skipped, elapsed_ms=round((time.time() - started) * 1000, 1))
+
+
+@scheduler_fn.on_schedule(
+    schedule=AIConfig.INDEX_SNAPSHOT_SCHEDULE,
+    region=AIConfig.LOCATION,
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=540,
+)
+@traced("rebuild_product_index")
+def rebuild_product_index(event: scheduler_fn.ScheduledEvent) -> None:
+    """Writes fresh index snapshots for every indexed collection."""
+    if not AIConfig.INDEX_SNAPSHOT_ENABLED:
+        print("Index snapshots disabled (INDEX_SNAPSHOT_ENABLED=false); skipping.")
+        return
+    db, bucket = firestore.client(), _bucket()
+    for collection in AIConfig.INDEX_COLLECTIONS:
+        stats = write_snapshot(db, bucket, collection)
+        print(f"Index snapshot {collection}@{stats['version']}: {stats['count']} products, "
+              f"{stats['bytes']} bytes, {stats['elapsed_ms']} ms")
+
+
+# --- Change feed ---
+
+def record_change(db, collection: str, doc_id: str, deleted: bool):
+    """One doc per product, so the feed stays as large as the catalogue."""
+    db.collection(CHANGES_COLLECTION).document(collection).collection("changes").document(doc_id).set({
+        "deleted": deleted,
+        "changed_at": time.time(),
+    })
+
+
+def _on_product_written(collection: str, event):
+    after = event.data.after if event.data else None
+    try:
+        record_change(firestore.client(), collection, event.params["productId"],
+                      deleted=after is None or not after.exists)
+    except Exception as e:
+        logger.warning(f"Could not record index change for {collection}/{event.params.get('productId')}: {e}")
+
+
+@firestore_fn.on_document_written(document="products_live/{productId}", region=AIConfig.LOCATION)
+@traced("index_live_product_change", quiet=True)
+def index_live_product_change(event: firestore_fn.Event[firestore_fn.Change]) -> None:
+    _on_product_written("products_live", event)
+
+
+# --- Serving ---
+
+class ProductIndex:
+    """
+    Memory-mapped snapshot of one collection plus the changes made since.
+    search() returns None when no snapshot exists, so callers can fall
+    back to a Firestore vector query.
+    """
+
+    def __init__(self, collection: str, db=None, bucket=None):
+        self.collection = collection
+        self._db = db
+        self._bucket = bucket
+        self._lock = threading.Lock()
+        self.manifest: Optional[Dict[str, Any]] = None
+        self._matrix: Optional[np.ndarray] = None
+        self._meta: List[Dict[str, Any]] = []
+        self._rows: Dict[str, int] = {}
+        # Changed since the snapshot: id -> (vector, metadata), or None if removed
+        self._overlay: Dict[str, Optional[Tuple[np.ndarray, Dict[str, Any]]]] = {}
+        self._synced_at = 0.0
+        self._manifest_checked = 0.0
+        self._delta_checked = 0.0
+
+    # --- Loading ---
+
+    def _local_file(self, version: str, blob_name: str) -> str:
+        """Downloads a snapshot file once per machine; concurrent workers race harmlessly via rename."""
+        directory = os.path.join(AIConfig.INDEX_SNAPSHOT_DIR, self.collection, version)
+        path = os.path.join(directory, os.path.basename(blob_name))
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            partial = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+            self._bucket.blob(blob_name).download_to_filename(partial)
+            os.replace(partial, path)
+            registry.counter("index_snapshot.downloads").inc()
+        return path
+
+    def _load(self, manifest: Dict[str, Any]):
+        with span("index_snapshot.load", collection=self.collection, version=manifest["version"]) as s:
+            matrix = np.load(self._local_file(manifest["version"], manifest["embeddings"]), mmap_mode="r")
+            with open(self._local_file(manifest["version"], manifest["metadata"]), "rb") as f:
+                meta = json.loads(gzip.decompress(f.read()))
+            if matrix.shape[0] != len(meta):
+                raise ValueError(f"Snapshot {manifest['version']} has {matrix.shape[0]} vectors for {len(meta)} products")
+            self._matrix, self._meta, self.manifest = matrix, meta, manifest
+            self._rows = {m["id"]: i for i, m in enumerate(meta)}
+            self._overlay = {}
+            self._synced_at = manifest["created_at"]
+            s.set(products=len(meta))
+        registry.histogram("index_snapshot.load_ms").observe(s.duration_ms)
+
+    def _check_manifest(self):
+        blob = self._bucket.get_blob(_prefix(self.collection) + "manifest.json")
+        if blob is None:
+            return
+        manifest = json.loads(blob.download_as_bytes())
+        if self.manifest is None or manifest["version"] != self.manifest["version"]:
+            self._load(manifest)
+
+    def _apply_changes(self):
+        since = self._synced_at - AIConfig.INDEX_DELTA_OVERLAP_SEC
+        now = time.time()
+        changes = (self._db.collection(CHANGES_COLLECTION).document(self.collection).collection("changes")
+                   .where("changed_at", ">=", since).stream())
+        applied = 0
+        for change in changes:
+            doc = self._db.collection(self.collection).document(change.id).get()
+            row = _index_row(doc.id, doc.to_dict()) if doc.exists else None
+            if row is not None and self._matrix is not None and len(row[0]) == self._matrix.shape[1]:
+                self._overlay[change.id] = (_normalise(row[0][None, :])[0], row[1])
+            else:
+                self._overlay[change.id] = None
+            applied += 1
+        self._synced_at = now
+        if applied:
+            registry.counter("index_snapshot.deltas_applied").inc(applied)
+
+    def refresh(self, force: bool = False):
+        """Picks up a newer snapshot and recent changes when their check intervals are due."""
+        now = time.time()
+        with self._lock:
+            if self._bucket is None:
+                self._bucket = _bucket()
+            if self._db is None:
+                self._db = firestore.client()
+            if force or now - self._manifest_checked >= AIConfig.INDEX_MANIFEST_CHECK_SEC:
+                self._manifest_checked = now
+                self._check_manifest()
+            if self.manifest is not None and (force or now - self._delta_checked >= AIConfig.INDEX_DELTA_SYNC_SEC):
+                self._delta_checked = now
+                self._apply_changes()
+
+    # --- Search ---
+
+    def search(self, query_vector, limit: int = 10) -> Optional[List[Dict[str, Any]]]:
+        """
+        Cosine nearest neighbours as product dicts with 'id' and
+        'vector_distance' (like a Firestore find_nearest with a distance field).
+        """
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning(f"Index refresh failed for {self.collection}, serving the loaded snapshot: {e}")
+        with self._lock:
+            matrix, meta, rows, overlay = self._matrix, self._meta, self._rows, dict(self._overlay)
+        if matrix is None:
+            return None
+
+        with span("index_snapshot.search", collection=self.collection, quiet=True):
+            q = np.asarray(query_vector, dtype=np.float32)
+            q = q / (np.linalg.norm(q) or 1.0)
+            scores = np.asarray(matrix @ q) if len(meta) else np.zeros(0, dtype=np.float32)
+            stale = [rows[i] for i in overlay if i in rows]
+            if stale:
+                scores[stale] = -np.inf
+
+            k = min(limit, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k] if k else []
+            hits = [(float(scores[i]), meta[i]) for i in top if np.isfinite(scores[i])]
+            hits += [(float(vec @ q), m) for vec, m in (v for v in overlay.values() if v is not None)]
+            hits.sort(key=lambda h: -h[0])
+
+        results = []
+        for score, m in hits[:limit]:
+            product = dict(m)
+            product["vector_distance"] = 1.0 - score
+            results.append(product)
+        return results
+
+
+_indexes: Dict[str, ProductIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(collection: str) -> ProductIndex:
+    """Process-wide index per collection."""
+    with _indexes_lock:
+        if collection not in _indexes:
+            _indexes[collection] = ProductIndex(collection)
+        return _indexes[collection]
+
+
+def reset_indexes():
+    with _indexes_lock:
+        _indexes.clear()
+
+
+def nearest_products(db, collection: str, query_vector, limit: int) -> List[Dict[str, Any]]:
+    """
+    Snapshot search when one is available, otherwise the Firestore vector
+    query. Results have 'id' and 'vector_distance' and no embedding.
+    """
+    if AIConfig.INDEX_SNAPSHOT_ENABLED:
+        try:
+            results = get_index(collection).search(query_vector, limit)
+        except Exception as e:
+            logger.warning(f"Index snapshot search failed for {collection}: {e}")
+            results = None
+        if results is not None:
+            registry.counter(f"index_snapshot.{collection}.hits").inc()
+            return results
+        registry.counter(f"index_snapshot.{collection}.fallbacks").inc()
+
+    vector_query = db.collection(collection).find_nearest(
+        vector_field="embedding_field",
+        query_vector=Vector(query_vector),
+        distance_measure=DistanceMeasure.COSINE,
+        limit=limit,
+        distance_result_field="vector_distance",
+    )
+    results = []
+    for doc in vector_query.get():
+        d = doc.to_dict()
+        d.pop("embedding_field", None)
+        d["id"] = doc.id
+        results.append(d)
+    return results
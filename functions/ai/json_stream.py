@@ -0,0 +1,110 @@
+import json
+import logging
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+# Incremental JSON Array Parser
+# Gemini extraction returns {"products": [{...}, {...}, ...]} (or a bare
+# array). Instead of buffering the whole response and calling json.loads on
+# it, ProductStreamParser scans chunks as they arrive and yields each product
+# object as soon as its closing brace is seen. Only the text of the object
+# currently being parsed is kept in memory, and a truncated response still
+# yields every product that closed before the cut.
+
+logger = logging.getLogger(__name__)
+
+# One token per match: a whole string literal (group 1 is None if it is cut
+# off at the end of the buffer) or a bracket. Everything else is skipped by
+# the regex engine, so Python only runs per string/bracket, not per character.
+_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*(")?|[{}\[\]]', re.DOTALL)
+
+
+class ProductStreamParser:
+    """
+    Yields every object that is a direct element of a top-level array or of an
+    array one level down (the "products" list). Feed text chunks in order.
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0               # next index of _buf to scan
+        self._start: Optional[int] = None  # index in _buf where the current product began
+        self._stack: List[str] = []
+        self._partial = False       # buffer ends inside a string literal
+        self.stats = {"chars": 0, "products": 0, "invalid": 0}
+
+    @property
+    def truncated(self) -> bool:
+        """True if the text fed so far stops in the middle of the document."""
+        return bool(self._stack) or self._partial
+
+    def _is_product_start(self) -> bool:
+        return bool(self._stack) and self._stack[-1] == "[" and len(self._stack) <= 2
+
+    def feed(self, chunk: str) -> Iterator[Dict[str, Any]]:
+        if not chunk:
+            return
+        self.stats["chars"] += len(chunk)
+        self._buf += chunk
+        buf = self._buf
+        pos = self._pos
+        stack = self._stack
+        self._partial = False
+
+        for m in _TOKEN.finditer(buf, pos):
+            ch = m.group()
+            if ch[0] == '"':
+                if m.group(1) is None:
+                    # String continues in the next chunk: rescan it from its opening quote
+                    self._partial = True
+                    pos = m.start()
+                    break
+            elif ch == "{" or ch == "[":
+                if ch == "{" and self._start is None and self._is_product_start():
+                    self._start = m.start()
+                stack.append(ch)
+            else:
+                if stack:
+                    stack.pop()
+                if ch == "}" and self._start is not None and self._is_product_start():
+                    product = self._decode(buf[self._start:m.end()])
+                    self._start = None
+                    if product is not None:
+                        yield product
+            pos = m.end()
+        else:
+            pos = len(buf)
+
+        # Drop everything we no longer need so memory stays bounded by one product
+        cut = self._start if self._start is not None else pos
+        self._buf = buf[cut:]
+        self._pos = pos - cut
+        if self._start is not None:
+            self._start = 0
+
+    def _decode(self, text: str) -> Optional[Dict[str, Any]]:
+        try:
+            product = json.loads(text)
+        except ValueError:
+            self.stats["invalid"] += 1
+            return None
+        if not isinstance(product, dict):
+            self.stats["invalid"] += 1
+            return None
+        self.stats["products"] += 1
+        return product
+
+    def close(self):
+        if self.truncated:
+            logger.warning(
+                f"Extraction output ended mid-document after {self.stats['chars']} chars; "
+                f"kept {self.stats['products']} complete products."
+            )
+
+
+def iter_products(chunks: Iterable[str], parser: Optional[ProductStreamParser] = None) -> Iterator[Dict[str, Any]]:
+    """Convenience wrapper: parses an iterable of text chunks."""
+    parser = parser or ProductStreamParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    parser.close()
@@ -0,0 +1,168 @@
+import logging
+import math
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .config import AIConfig
+
+# Compact prompt serialization & token accounting
+# Candidates retrieved for RAG prompts are rendered as a pipe-separated table
+# with a fixed column whitelist, so prompts are stable between requests and
+# never leak timestamps, vectors or other bookkeeping fields to the model.
+
+logger = logging.getLogger(__name__)
+
+# Columns sent to the model, in this order.
+CANDIDATE_FIELDS = ("id", "title", "price", "currency", "sku", "tags", "description")
+
+# Description lengths tried (longest first) while fitting a prompt into budget.
+_DESCRIPTION_STEPS = (AIConfig.DESCRIPTION_MAX_CHARS, 160, 80, 0)
+
+# Exact counts that still exceed the budget trigger at most this many refits
+_EXACT_REFITS = 2
+
+# Anything past Latin Extended-B (Greek, Cyrillic, CJK, ...)
+_NON_LATIN = re.compile(r"[^\u0000-\u024f]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap local token estimate: ~4 characters per token for Latin text,
+    NON_LATIN_CHARS_PER_TOKEN for other scripts (Greek product copy).
+    """
+    if not text:
+        return 0
+    if text.isascii():
+        return math.ceil(len(text) / 4)
+    non_latin = len(text) - len(_NON_LATIN.sub("", text))
+    return math.ceil((len(text) - non_latin) / 4 + non_latin / AIConfig.NON_LATIN_CHARS_PER_TOKEN)
+
+
+def _truncate(text: str, limit: int) -> str:
+    if limit <= 0:
+        return ""
+    if len(text) <= limit:
+        return text
+    cut = text[:limit].rsplit(" ", 1)[0] or text[:limit]
+    return cut + "…"
+
+
+def _cell(value: Any, description_limit: int, field: str) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        text = "{:.2f}".format(value)
+    elif isinstance(value, (list, tuple)):
+        text = ",".join(str(v) for v in value if v is not None)
+    elif isinstance(value, dict):
+        text = ",".join(f"{k}={v}" for k, v in sorted(value.items()))
+    else:
+        text = str(value)
+    # Keep one row per line and one cell per column
+    text = " ".join(text.split()).replace("|", "/")
+    if field == "description":
+        text = _truncate(text, description_limit)
+    return text
+
+
+def serialize_table(
+    rows: Iterable[Dict[str, Any]],
+    fields: Sequence[str] = CANDIDATE_FIELDS,
+    description_limit: int = AIConfig.DESCRIPTION_MAX_CHARS,
+) -> str:
+    """
+    Renders rows as a header line plus one pipe-separated line per row.
+    Only whitelisted fields are emitted, always in the same order.
+    """
+    lines = ["|".join(fields)]
+    for row in rows:
+        lines.append("|".join(_cell(row.get(f), description_limit, f) for f in fields))
+    return "\n".join(lines)
+
+
+class PromptBuilder:
+    """
+    Fits a prompt template plus a candidate table into a per-call token budget.
+    The template must contain a `{candidates}` placeholder.
+    """
+
+    def __init__(self, client=None, model: Optional[str] = None, budget: Optional[int] = None):
+        self.client = client
+        self.model = model or AIConfig.MODEL_NAME
+        self.budget = budget or AIConfig.PROMPT_TOKEN_BUDGET
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Counts prompt tokens. Uses the Vertex countTokens API when exact counting
+        is enabled (one extra round trip), otherwise the local estimate.
+        """
+        if AIConfig.EXACT_TOKEN_COUNT and self.client is not None:
+            try:
+                resp = self.client.models.count_tokens(model=self.model, contents=text)
+                return resp.total_tokens
+            except Exception as e:
+                logger.warning(f"count_tokens failed, using estimate: {e}")
+        return estimate_tokens(text)
+
+    @staticmethod
+    def _fit(template: str, rows: List[Dict[str, Any]], fields: Sequence[str], budget: int,
+             values: Dict[str, Any]) -> Tuple[str, List[Dict[str, Any]]]:
+        """Shortens descriptions, then drops the last rows, until the estimate fits `budget`."""
+        prompt = ""
+        while True:
+            for limit in _DESCRIPTION_STEPS:
+                table = serialize_table(rows, fields, description_limit=limit)
+                prompt = template.format(candidates=table, **values)
+                if estimate_tokens(prompt) <= budget:
+                    break
+            else:
+                if len(rows) > 1:
+                    rows = rows[:-1]
+                    continue
+            break
+        return prompt, rows
+
+    def build(self, template: str, candidates: Sequence[Dict[str, Any]],
+              fields: Sequence[str] = CANDIDATE_FIELDS, **values: Any) -> str:
+        """
+        Renders the template, shortening descriptions and then dropping the
+        lowest-ranked candidates until the prompt fits the budget. With exact
+        counting, a prompt the countTokens API still finds over budget is
+        fitted again against a budget scaled by how far the estimate was off.
+        """
+        rows = list(candidates)
+        budget = self.budget
+        prompt, rows = self._fit(template, rows, fields, budget, values)
+        tokens = self.count_tokens(prompt)
+        for _ in range(_EXACT_REFITS):
+            if tokens <= self.budget:
+                break
+            budget = min(budget - 1, int(self.budget * estimate_tokens(prompt) / tokens))
+            refitted, rows = self._fit(template, rows, fields, budget, values)
+            if refitted == prompt:
+                break  # nothing left to trim
+            prompt = refitted
+            tokens = self.count_tokens(prompt)
+        if tokens > self.budget:
+            logger.warning(f"Prompt for {self.model} is ~{tokens} tokens, over the {self.budget} budget")
+        if len(rows) < len(candidates):
+            logger.info(f"Prompt trimmed to {len(rows)}/{len(candidates)} candidates to fit {self.budget} tokens")
+        logger.info(f"Prompt built for {self.model}: ~{tokens} tokens, {len(rows)} candidates")
+        return prompt
+
+
+def log_usage(label: str, response: Any) -> Optional[Dict[str, int]]:
+    """Logs the token usage reported by a generate_content response."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return None
+    counts = {
+        "prompt_tokens": usage.prompt_token_count or 0,
+        "output_tokens": usage.candidates_token_count or 0,
+        "total_tokens": usage.total_token_count or 0,
+    }
+    logger.info(
+        f"[{label}] tokens prompt={counts['prompt_tokens']} "
+        f"output={counts['output_tokens']} total={counts['total_tokens']}"
+    )
+    return counts
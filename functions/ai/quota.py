@@ -0,0 +1,65 @@
+import time
+from typing import Tuple
+
+from firebase_admin import firestore
+
+from .config import AIConfig
+
+# Shared Gemini Quota
+# Vertex quotas are per project, but chat_assistant, suggest_bundles and
+# process_catalogue_upload run as separate services with their own
+# instances, so no process-wide scheduler can see what the others spend.
+# This keeps one token bucket per model in 'genai_quota'. Scheduler lanes
+# draw tokens from it in grants of QUOTA_GRANT_SEC worth of the model's rate
+# (one transaction per grant, not per call) and spend them locally.
+# Priority holds across services: interactive grants stamp the bucket, and
+# while one was taken within QUOTA_INTERACTIVE_WINDOW_SEC batch grants stop
+# at QUOTA_INTERACTIVE_RESERVE of the bucket, leaving that for shoppers
+# wherever they are served.
+
+QUOTA_COLLECTION = "genai_quota"
+BATCH_RESERVE = 0.1  # batch never drains the bucket, shoppers or not
+
+
+class SharedQuota:
+    def __init__(self, model: str, tokens_per_minute: int):
+        self.model = model
+        self.rate = tokens_per_minute / 60.0
+        self.capacity = max(self.rate * 10, 1.0)  # same burst as a lane's local bucket
+
+    def grant(self, interactive: bool, wanted: float) -> Tuple[float, float]:
+        """
+        Takes up to `wanted` tokens from the shared bucket. Returns the tokens
+        granted and how many seconds to wait before asking again if that was
+        short of `wanted`.
+        """
+        db = firestore.client()
+        ref = db.collection(QUOTA_COLLECTION).document(self.model.replace("/", "_"))
+
+        def take(transaction):
+            snapshot = ref.get(transaction=transaction)
+            bucket = snapshot.to_dict() if snapshot.exists else {}
+            now = time.time()
+            elapsed = max(now - bucket.get("refilled_at", now), 0.0)
+            tokens = min(self.capacity, bucket.get("tokens", self.capacity) + elapsed * self.rate)
+            interactive_at = now if interactive else bucket.get("interactive_at", 0.0)
+
+            if interactive:
+                floor = 0.0
+            elif now - interactive_at < AIConfig.QUOTA_INTERACTIVE_WINDOW_SEC:
+                floor = self.capacity * AIConfig.QUOTA_INTERACTIVE_RESERVE
+            else:
+                floor = self.capacity * BATCH_RESERVE
+            granted = max(min(wanted, tokens - floor), 0.0)
+            transaction.set(ref, {
+                "tokens": tokens - granted,
+                "refilled_at": now,
+                "interactive_at": interactive_at,
+                "model": self.model,
+            })
+            return granted, floor + wanted - tokens
+
+        granted, deficit = firestore.transactional(take)(db.transaction())
+        if granted >= wanted:
+            return granted, 0.0
+        return granted, min(max(deficit / self.rate, 0.05), AIConfig.QUOTA_MAX_RETRY_SEC)
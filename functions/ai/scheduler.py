@@ -0,0 +1,425 @@
+import enum
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from google.genai import errors, types
+
+from .config import AIConfig
+from .prompting import estimate_tokens
+from .quota import SharedQuota
+from telemetry import registry
+
+# Gemini Request Scheduler
+# Every Vertex AI call made from ai/ goes through one process-wide scheduler,
+# so a bulk catalogue upload cannot starve shoppers of quota. Per model it
+# keeps:
+#   - a priority queue (interactive requests are always served before batch),
+#   - a concurrency limit that halves on 429s and creeps back up on success,
+#   - a token bucket sized from the model's tokens-per-minute quota, fed by
+#     grants from the Firestore bucket all services share (ai/quota.py), so
+#     priority also holds between functions, not only within one instance,
+#   - a circuit breaker that fails fast once Vertex keeps erroring.
+# Callers wrap their client with `schedule(client, Priority.X)`; the wrapped
+# client has the same `.models` methods as genai.Client.
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+class GeminiUnavailable(Exception):
+    """Raised instead of calling Vertex when the circuit is open or the queue wait times out."""
+
+
+# Rough prompt size for a file part (we cannot see the document from here)
+FILE_PART_TOKENS = 8000
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return isinstance(error, errors.APIError) and (error.code == 429 or error.status == "RESOURCE_EXHAUSTED")
+
+
+def is_server_error(error: Exception) -> bool:
+    return isinstance(error, errors.ServerError) or isinstance(error, (TimeoutError, ConnectionError))
+
+
+def estimate_request_tokens(contents: Any) -> int:
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        return estimate_tokens(contents)
+    if isinstance(contents, types.Part):
+        if contents.file_data is not None:
+            return FILE_PART_TOKENS
+        return estimate_tokens(contents.text or "")
+    if isinstance(contents, types.Content):
+        return sum(estimate_request_tokens(p) for p in contents.parts or [])
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_request_tokens(c) for c in contents)
+    return estimate_tokens(str(contents))
+
+
+class CircuitBreaker:
+    """closed -> open after N consecutive failures -> half-open probe after a cooldown."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, threshold: int = AIConfig.CIRCUIT_FAILURE_THRESHOLD,
+                 cooldown_sec: float = AIConfig.CIRCUIT_COOLDOWN_SEC):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown_sec = cooldown_sec
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown_sec:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True  # exactly one request tests the water
+                return True
+            return False
+
+    def abandon_probe(self):
+        """The half-open probe never reached Vertex (e.g. queue timeout); let another request try."""
+        with self._lock:
+            self._probing = False
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit for {self.name} closed again")
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+        registry.gauge(f"genai.{self.name}.circuit_open").set(0)
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                if self.state != self.OPEN:
+                    logger.error(f"Circuit for {self.name} opened after {self._failures} failures")
+                    registry.counter(f"genai.{self.name}.circuit_opened").inc()
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+        if self.state == self.OPEN:
+            registry.gauge(f"genai.{self.name}.circuit_open").set(1)
+
+
+class ModelLane:
+    """Admission control for one model: priority queue, adaptive concurrency, token bucket."""
+
+    def __init__(self, model: str, concurrency: int, tokens_per_minute: int):
+        self.model = model
+        self.max_concurrency = concurrency
+        self.limit = float(concurrency)  # adaptive, between 1 and max_concurrency
+        self.rate = tokens_per_minute / 60.0
+        self.capacity = max(self.rate * 10, 1.0)  # up to 10 seconds of burst
+        self.quota = SharedQuota(model, tokens_per_minute) if AIConfig.SHARED_QUOTA_ENABLED else None
+        self.tokens = self.capacity if self.quota is None else 0.0
+        self.in_flight = 0
+        self.breaker = CircuitBreaker(model)
+        self._waiting = []
+        self._seq = itertools.count()
+        self._refilled = time.monotonic()
+        self._granting = False
+        self._next_grant = 0.0
+        self._local_until = 0.0  # refill locally until then (shared quota unreachable)
+        self._cond = threading.Condition()
+
+    def _shared(self) -> bool:
+        return self.quota is not None and time.monotonic() >= self._local_until
+
+    def _refill(self):
+        now = time.monotonic()
+        if not self._shared():
+            self.tokens = min(self.capacity, self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _draw(self, priority: Priority, needed: float):
+        """Tops the bucket up from the shared quota. Called with the condition held; releases it meanwhile."""
+        wanted = min(max(needed - self.tokens, self.rate * AIConfig.QUOTA_GRANT_SEC), self.capacity - self.tokens)
+        self._granting = True
+        self._cond.release()
+        try:
+            granted, retry_after = self.quota.grant(priority == Priority.INTERACTIVE, wanted)
+            failed = False
+        except Exception as e:
+            # Vertex still throttles us with 429s, as it did before the shared quota
+            logger.warning(f"Shared quota for {self.model} unavailable, refilling locally for "
+                           f"{AIConfig.QUOTA_FALLBACK_SEC:.0f}s: {e}")
+            registry.counter(f"genai.{self.model}.quota_errors").inc()
+            granted, retry_after, failed = 0.0, 0.0, True
+        finally:
+            self._cond.acquire()
+            self._granting = False
+        now = time.monotonic()
+        if failed:
+            self._local_until = now + AIConfig.QUOTA_FALLBACK_SEC
+        self.tokens = min(self.capacity, self.tokens + granted)
+        self._next_grant = now + retry_after
+        registry.counter(f"genai.{self.model}.quota_draws.{priority.name.lower()}").inc()
+        self._cond.notify_all()
+
+    def _slots_for(self, priority: Priority) -> int:
+        if priority == Priority.INTERACTIVE:
+            return max(1, int(self.limit))
+        return max(1, int(self.limit * AIConfig.BATCH_CONCURRENCY_SHARE))
+
+    def _tokens_needed(self, priority: Priority, tokens: int) -> float:
+        needed = min(tokens, self.capacity)
+        if priority == Priority.BATCH:
+            # Leave a reserve in the bucket for shoppers
+            needed = min(needed + self.capacity * 0.1, self.capacity)
+        return needed
+
+    def acquire(self, priority: Priority, tokens: int, timeout: float) -> float:
+        """Blocks until this request may run. Returns the time waited in ms."""
+        entry = (int(priority), next(self._seq))
+        started = time.monotonic()
+        depth = registry.gauge(f"genai.{self.model}.queue_depth.{priority.name.lower()}")
+        depth.inc()
+        try:
+            with self._cond:
+                heapq.heappush(self._waiting, entry)
+                try:
+                    while True:
+                        self._refill()
+                        needed = self._tokens_needed(priority, tokens)
+                        if self._waiting[0] == entry and self.in_flight < self._slots_for(priority):
+                            if self.tokens >= needed:
+                                heapq.heappop(self._waiting)
+                                self.in_flight += 1
+                                self.tokens -= min(tokens, self.capacity)
+                                break
+                            if self._shared() and not self._granting and time.monotonic() >= self._next_grant:
+                                self._draw(priority, needed)
+                                continue
+                        remaining = timeout - (time.monotonic() - started)
+                        if remaining <= 0:
+                            self._waiting.remove(entry)
+                            heapq.heapify(self._waiting)
+                            registry.counter(f"genai.{self.model}.queue_timeouts").inc()
+                            raise GeminiUnavailable(f"Timed out after {timeout:.0f}s waiting for {self.model}")
+                        wait = 0.5
+                        if self.tokens < needed and self._shared():
+                            wait = min(wait, self._next_grant - time.monotonic())
+                        elif self.tokens < needed and self.rate:
+                            wait = min(wait, (needed - self.tokens) / self.rate)
+                        self._cond.wait(timeout=min(max(wait, 0.005), remaining))
+                finally:
+                    self._cond.notify_all()
+        finally:
+            depth.dec()
+        waited_ms = (time.monotonic() - started) * 1000
+        registry.histogram(f"genai.wait_ms.{priority.name.lower()}").observe(waited_ms)
+        registry.gauge(f"genai.{self.model}.in_flight").set(self.in_flight)
+        return waited_ms
+
+    def release(self, estimated_tokens: int, actual_tokens: Optional[int] = None, throttled: bool = False):
+        with self._cond:
+            self.in_flight -= 1
+            if actual_tokens is not None:
+                # Settle up against the estimate; the bucket may go negative
+                self.tokens -= max(actual_tokens, 0) - min(estimated_tokens, self.capacity)
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / max(self.limit, 1.0))
+            self._cond.notify_all()
+        registry.gauge(f"genai.{self.model}.in_flight").set(self.in_flight)
+        registry.gauge(f"genai.{self.model}.concurrency_limit").set(self.limit)
+
+
+class GeminiScheduler:
+    MAX_ATTEMPTS = {Priority.INTERACTIVE: 3, Priority.BATCH: 6}
+    MAX_BACKOFF_SEC = {Priority.INTERACTIVE: 2.0, Priority.BATCH: 30.0}
+
+    def __init__(self):
+        self._lanes: Dict[str, ModelLane] = {}
+        self._lock = threading.Lock()
+
+    def lane(self, model: str) -> ModelLane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            with self._lock:
+                lane = self._lanes.get(model)
+                if lane is None:
+                    limits = AIConfig.MODEL_LIMITS.get(model, AIConfig.MODEL_LIMITS["default"])
+                    lane = ModelLane(model, int(limits["concurrency"]), int(limits["tokens_per_minute"]))
+                    self._lanes[model] = lane
+        return lane
+
+    def is_available(self, model: str) -> bool:
+        return self.lane(model).breaker.state != CircuitBreaker.OPEN
+
+    def _timeout(self, priority: Priority) -> float:
+        if priority == Priority.INTERACTIVE:
+            return AIConfig.INTERACTIVE_QUEUE_TIMEOUT_SEC
+        return AIConfig.BATCH_QUEUE_TIMEOUT_SEC
+
+    def _backoff(self, priority: Priority, attempt: int) -> float:
+        # Exponential with full jitter
+        return random.uniform(0, min(self.MAX_BACKOFF_SEC[priority], 0.25 * 2 ** attempt))
+
+    def _admit(self, lane: ModelLane, priority: Priority, tokens: int):
+        if not lane.breaker.allow():
+            registry.counter(f"genai.{lane.model}.rejected").inc()
+            raise GeminiUnavailable(f"Vertex AI circuit for {lane.model} is open")
+        try:
+            lane.acquire(priority, tokens, self._timeout(priority))
+        except GeminiUnavailable:
+            lane.breaker.abandon_probe()
+            raise
+
+    def _failed(self, lane: ModelLane, priority: Priority, tokens: int, error: Exception, attempt: int) -> bool:
+        """Releases the slot after an error. Returns True if the call should be retried."""
+        throttled = is_rate_limited(error)
+        lane.release(tokens, throttled=throttled)
+        if throttled:
+            registry.counter(f"genai.{lane.model}.throttled").inc()
+        if not (throttled or is_server_error(error)):
+            lane.breaker.success()  # the service answered; a 400 is our problem, not Vertex's
+            return False
+        lane.breaker.failure()
+        if attempt + 1 >= self.MAX_ATTEMPTS[priority] or lane.breaker.state == CircuitBreaker.OPEN:
+            return False
+        delay = self._backoff(priority, attempt)
+        logger.warning(f"{lane.model} {'throttled' if throttled else 'failed'} ({error}); retrying in {delay:.2f}s")
+        time.sleep(delay)
+        return True
+
+    def call(self, model: str, priority: Priority, tokens: int, fn: Callable[[], Any]) -> Any:
+        lane = self.lane(model)
+        attempt = 0
+        while True:
+            self._admit(lane, priority, tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                if self._failed(lane, priority, tokens, e, attempt):
+                    attempt += 1
+                    continue
+                if is_rate_limited(e) or is_server_error(e):
+                    raise GeminiUnavailable(f"{model} unavailable after {attempt + 1} attempts: {e}") from e
+                raise
+            usage = getattr(result, "usage_metadata", None)
+            lane.release(tokens, getattr(usage, "total_token_count", None) if usage else None)
+            lane.breaker.success()
+            return result
+
+    def stream(self, model: str, priority: Priority, tokens: int, fn: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        """Like call(), but holds the slot until the stream is exhausted. Retries only before the first chunk."""
+        lane = self.lane(model)
+        attempt = 0
+        while True:
+            self._admit(lane, priority, tokens)
+            try:
+                iterator = iter(fn())
+                first = next(iterator, None)
+            except Exception as e:
+                if self._failed(lane, priority, tokens, e, attempt):
+                    attempt += 1
+                    continue
+                if is_rate_limited(e) or is_server_error(e):
+                    raise GeminiUnavailable(f"{model} unavailable after {attempt + 1} attempts: {e}") from e
+                raise
+            break
+
+        used = None
+        error = None
+        try:
+            chunk = first
+            while chunk is not None:
+                usage = getattr(chunk, "usage_metadata", None)
+                if usage is not None and usage.total_token_count:
+                    used = usage.total_token_count
+                yield chunk
+                chunk = next(iterator, None)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Also runs if the consumer abandons the stream early
+            throttled = error is not None and is_rate_limited(error)
+            lane.release(tokens, used, throttled=throttled)
+            if error is None:
+                lane.breaker.success()
+            elif throttled or is_server_error(error):
+                lane.breaker.failure()
+
+
+_scheduler = GeminiScheduler()
+
+
+def get_scheduler() -> GeminiScheduler:
+    return _scheduler
+
+
+def reset_scheduler():
+    """Drops all per-model state (limits, buckets, circuits). Used between benchmark runs."""
+    global _scheduler
+    _scheduler = GeminiScheduler()
+
+
+class _ScheduledModels:
+    def __init__(self, models, priority: Priority, scheduler: GeminiScheduler):
+        self._models = models
+        self._priority = priority
+        self._scheduler = scheduler
+
+    def generate_content(self, *, model: str, contents: Any, config: Any = None):
+        return self._scheduler.call(
+            model, self._priority, estimate_request_tokens(contents),
+            lambda: self._models.generate_content(model=model, contents=contents, config=config),
+        )
+
+    def generate_content_stream(self, *, model: str, contents: Any, config: Any = None):
+        return self._scheduler.stream(
+            model, self._priority, estimate_request_tokens(contents),
+            lambda: self._models.generate_content_stream(model=model, contents=contents, config=config),
+        )
+
+    def embed_content(self, *, model: str, contents: Any, config: Any = None):
+        return self._scheduler.call(
+            model, self._priority, estimate_request_tokens(contents),
+            lambda: self._models.embed_content(model=model, contents=contents, config=config),
+        )
+
+    def __getattr__(self, name: str):
+        # count_tokens and anything else we do not meter
+        return getattr(self._models, name)
+
+
+class ScheduledClient:
+    """genai.Client whose model calls are admitted by the scheduler."""
+
+    def __init__(self, client, priority: Priority, scheduler: Optional[GeminiScheduler] = None):
+        self._client = client
+        self.priority = priority
+        self.scheduler = scheduler or get_scheduler()
+        self.models = _ScheduledModels(client.models, priority, self.scheduler)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+
+def schedule(client, priority: Priority) -> ScheduledClient:
+    return ScheduledClient(client, priority)
@@ -0,0 +1,165 @@
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Optional
+
+from firebase_admin import firestore
+from google.api_core import exceptions as gexc
+
+from .config import AIConfig
+from telemetry import registry
+
+# Request Coalescing (single-flight)
+# When a product is featured, many shoppers ask for the same thing within
+# seconds. The first caller for a key (the leader) runs the computation;
+# identical calls arriving while it is in flight wait for its result
+# instead of repeating the embedding, search and generation.
+# Within an instance this is a dict of futures. Optionally, instances also
+# coordinate through a lease document in 'singleflight_leases': the leader
+# creates it, others poll it and pick up the stored result. A lease whose
+# leader died expires after SINGLEFLIGHT_LEASE_SEC and is taken over; at
+# worst two instances compute the same thing, as they would without it.
+
+logger = logging.getLogger(__name__)
+
+LEASE_COLLECTION = "singleflight_leases"
+
+
+def request_key(*parts: Optional[str]) -> str:
+    """Case-, whitespace- and trailing-punctuation-insensitive key for request arguments."""
+    return "|".join(" ".join(str(p or "").casefold().split()).strip(" .!?") for p in parts)
+
+
+class SingleFlight:
+    def __init__(self, name: str, lease: bool = AIConfig.SINGLEFLIGHT_LEASE_ENABLED,
+                 lease_sec: float = AIConfig.SINGLEFLIGHT_LEASE_SEC,
+                 result_sec: float = AIConfig.SINGLEFLIGHT_RESULT_SEC):
+        self.name = name
+        self.lease = lease
+        self.lease_sec = lease_sec
+        self.result_sec = result_sec
+        self.stats = {"calls": 0, "leaders": 0, "coalesced": 0, "coalesced_remote": 0, "takeovers": 0}
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, kind: str):
+        with self._lock:
+            self.stats[kind] += 1
+        registry.counter(f"singleflight.{self.name}.{kind}").inc()
+
+    def do(self, key: str, fn: Callable[[], Any], shareable: Callable[[Any], bool] = lambda result: True) -> Any:
+        """
+        Runs fn() once for all concurrent callers with the same key.
+        Only results for which shareable(result) is true are handed to other
+        instances (e.g. not degraded answers); in-process waiters get whatever
+        the leader got, including its exception.
+        """
+        self._count("calls")
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            self._count("coalesced")
+            try:
+                return future.result(timeout=self.lease_sec)
+            except FutureTimeout:
+                logger.warning(f"[{self.name}] leader for '{key}' still running after {self.lease_sec}s; computing")
+                return fn()
+
+        try:
+            result = self._lead(key, fn, shareable)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    # --- Cross-instance lease ---
+
+    def _lead(self, key: str, fn: Callable[[], Any], shareable: Callable[[Any], bool]) -> Any:
+        if not self.lease:
+            self._count("leaders")
+            return fn()
+
+        ref = firestore.client().collection(LEASE_COLLECTION).document(
+            f"{self.name}:{hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]}")
+        try:
+            remote = self._acquire(ref)
+        except Exception as e:
+            # Coordination is best-effort: compute locally if Firestore is unavailable
+            logger.warning(f"[{self.name}] lease unavailable, computing locally: {e}")
+            self._count("leaders")
+            return fn()
+        if remote is not None:
+            self._count("coalesced_remote")
+            return remote["result"]
+
+        self._count("leaders")
+        try:
+            result = fn()
+        except BaseException:
+            self._release(ref)
+            raise
+        if shareable(result):
+            try:
+                now = time.time()
+                ref.set({
+                    "state": "done",
+                    "result": json.dumps(result, ensure_ascii=False),
+                    "valid_until": now + self.result_sec,
+                    "expires_at": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=10),
+                })
+            except Exception as e:
+                logger.warning(f"[{self.name}] could not publish result: {e}")
+        else:
+            self._release(ref)
+        return result
+
+    def _acquire(self, ref) -> Optional[Dict[str, Any]]:
+        """Returns None once this instance holds the lease, or {"result": ...} from another leader."""
+        deadline = time.time() + self.lease_sec
+        while True:
+            now = time.time()
+            running = {
+                "state": "running",
+                "lease_until": now + self.lease_sec,
+                # Firestore TTL policy on this field cleans old leases
+                "expires_at": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=10),
+            }
+            try:
+                ref.create(running)
+                return None
+            except gexc.AlreadyExists:
+                pass
+
+            snapshot = ref.get()
+            if not snapshot.exists:
+                continue  # released between our create and get
+            lease = snapshot.to_dict()
+            if lease.get("state") == "done" and lease.get("valid_until", 0) > now:
+                return {"result": json.loads(lease["result"])}
+            if lease.get("state") == "running" and lease.get("lease_until", 0) > now and now < deadline:
+                time.sleep(AIConfig.SINGLEFLIGHT_POLL_SEC)
+                continue
+
+            # Stale result or a leader that never finished
+            self._count("takeovers")
+            ref.set(running)
+            return None
+
+    def _release(self, ref):
+        try:
+            ref.delete()
+        except Exception as e:
+            logger.warning(f"[{self.name}] could not release lease {ref.id}: {e}")
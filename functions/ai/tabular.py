@@ -0,0 +1,284 @@
+import csv
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from firebase_admin import firestore
+from google.genai import types
+
+from .config import AIConfig
+from .extraction_cache import UPLOADS_COLLECTION
+from telemetry import registry, span
+
+# Tabular Catalogue Ingest
+# Supplier price lists (CSV/XLSX) are already structured, so we map their
+# columns onto the draft schema directly instead of asking Gemini to read
+# them. Rows are streamed one at a time; only rows we cannot map are sent
+# to Gemini afterwards, in small batches.
+
+logger = logging.getLogger(__name__)
+
+MAPPINGS_COLLECTION = "catalogue_mappings"
+
+CSV_TYPES = {"text/csv", "application/csv", "text/comma-separated-values", "text/tab-separated-values"}
+XLSX_TYPES = {"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
+
+# Header synonyms (lower-cased) per draft field, used when a supplier has no saved mapping
+HEADER_SYNONYMS = {
+    "title": ["title", "name", "product", "product name", "item", "όνομα", "προϊόν", "περιγραφή είδους", "τίτλος"],
+    "description": ["description", "details", "long description", "περιγραφή", "λεπτομέρειες"],
+    "price": ["price", "retail price", "unit price", "rrp", "τιμή", "τιμή λιανικής", "λιανική"],
+    "currency": ["currency", "νόμισμα"],
+    "sku": ["sku", "code", "item code", "product code", "ref", "κωδικός", "κωδ."],
+    "tags": ["tags", "category", "categories", "type", "κατηγορία", "κατηγορίες"],
+    "options": ["options", "variants", "size", "sizes", "colour", "color", "μέγεθος", "χρώμα"],
+}
+
+UNMAPPED_BATCH_SIZE = 100
+MAX_UNMAPPED_ROWS = 2000  # beyond this, rows are counted as dropped and not sent to Gemini
+
+FALLBACK_PROMPT = """
+    You are an expert e-commerce data entry specialist.
+    The following rows come from a supplier price list (columns separated by "|", first line is the header).
+    Our automatic column mapping could not read them. Extract a product from every row that describes one.
+    For each product, return a JSON object with: title, description, price (number or null),
+    currency, sku (or null), tags (list), options (list).
+    Return the response as a JSON object with a key "products" containing the list.
+
+    {rows}
+    """
+
+
+def tabular_kind(content_type: Optional[str], file_path: str) -> Optional[str]:
+    """Returns "csv" / "xlsx" for structured catalogues, None for documents Gemini should read."""
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    ext = os.path.splitext(file_path)[1].lower()
+    if content_type in CSV_TYPES or ext in (".csv", ".tsv"):
+        return "csv"
+    if content_type in XLSX_TYPES or ext == ".xlsx":
+        return "xlsx"
+    return None
+
+
+def supplier_from_path(file_path: str) -> str:
+    """catalogues/<supplier>/<file> -> <supplier>; files directly in catalogues/ use their stem."""
+    parts = file_path.split("/")
+    if len(parts) > 2:
+        return parts[1]
+    return os.path.splitext(parts[-1])[0]
+
+
+def parse_price(value: Any) -> Optional[float]:
+    """Parses prices like 12.5, "12,50", "1.234,50 €" or "€1,234.50"."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = re.sub(r"[^\d,.\-]", "", str(value))
+    if not text:
+        return None
+    if "," in text and "." in text:
+        # Whichever separator comes last is the decimal one
+        if text.rfind(",") > text.rfind("."):
+            text = text.replace(".", "").replace(",", ".")
+        else:
+            text = text.replace(",", "")
+    elif "," in text:
+        text = text.replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def infer_mapping(headers: Sequence[str]) -> Dict[str, str]:
+    """Maps draft fields to header names using HEADER_SYNONYMS (exact match first, then prefix)."""
+    normalized = {h.strip().lower(): h for h in headers if h}
+    mapping = {}
+    for field, synonyms in HEADER_SYNONYMS.items():
+        for synonym in synonyms:
+            if synonym in normalized and normalized[synonym] not in mapping.values():
+                mapping[field] = normalized[synonym]
+                break
+        else:
+            for key, original in normalized.items():
+                if original not in mapping.values() and any(key.startswith(s) for s in synonyms):
+                    mapping[field] = original
+                    break
+    # Many price lists only have one text column ("Description"/"Περιγραφή") naming the product
+    if "title" not in mapping and "description" in mapping:
+        mapping["title"] = mapping.pop("description")
+    return mapping
+
+
+class TabularIngest:
+    """Streams products out of a CSV/XLSX catalogue using a per-supplier column mapping."""
+
+    def __init__(self, db, supplier: str):
+        self.db = db
+        self.supplier = supplier
+        self.mapping: Dict[str, str] = {}
+        self.default_currency = "EUR"
+        self.stats = {"rows": 0, "mapped": 0, "unmapped": 0, "gemini_rows": 0, "gemini_products": 0, "dropped": 0}
+        self._unmapped: List[Dict[str, Any]] = []
+        self._headers: List[str] = []
+
+    # --- Mapping ---
+
+    def _load_mapping(self, headers: List[str]):
+        ref = self.db.collection(MAPPINGS_COLLECTION).document(self.supplier)
+        saved = ref.get()
+        if saved.exists:
+            data = saved.to_dict()
+            columns = {f: c for f, c in data.get("columns", {}).items() if c in headers}
+            self.default_currency = data.get("currency", self.default_currency)
+            if "title" in columns:
+                self.mapping = columns
+                return
+            logger.warning(f"Saved column mapping for '{self.supplier}' does not match this file; re-inferring.")
+
+        self.mapping = infer_mapping(headers)
+        if "title" in self.mapping:
+            # Persist so an operator can review/correct it for the next upload
+            ref.set({
+                "columns": self.mapping,
+                "currency": self.default_currency,
+                "source": "inferred",
+                "headers": headers,
+                "updated_at": firestore.SERVER_TIMESTAMP,
+            }, merge=True)
+        logger.info(f"Column mapping for '{self.supplier}': {self.mapping}")
+
+    # --- Row sources ---
+
+    def _csv_rows(self, blob) -> Iterator[List[Any]]:
+        with blob.open("rt", encoding="utf-8-sig", newline="") as f:
+            sample = f.read(8192)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+            except csv.Error:
+                dialect = csv.excel
+            yield from csv.reader(_chain_text(sample, f), dialect)
+
+    def _xlsx_rows(self, blob) -> Iterator[List[Any]]:
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise RuntimeError("openpyxl is required for XLSX catalogues")
+        # openpyxl needs a seekable file; read_only mode then streams rows
+        with tempfile.NamedTemporaryFile(suffix=".xlsx") as tmp:
+            blob.download_to_filename(tmp.name)
+            workbook = load_workbook(tmp.name, read_only=True, data_only=True)
+            try:
+                for row in workbook.worksheets[0].iter_rows(values_only=True):
+                    yield list(row)
+            finally:
+                workbook.close()
+
+    # --- Conversion ---
+
+    def _to_product(self, row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        def cell(field):
+            column = self.mapping.get(field)
+            value = row.get(column) if column else None
+            return value.strip() if isinstance(value, str) else value
+
+        title = cell("title")
+        if not title:
+            return None
+        raw_price = cell("price")
+        price = parse_price(raw_price)
+        if raw_price not in (None, "") and price is None:
+            return None
+
+        tags = cell("tags")
+        options = cell("options")
+        return {
+            "title": str(title),
+            "description": str(cell("description") or ""),
+            "price": price,
+            "currency": str(cell("currency") or self.default_currency),
+            "sku": str(cell("sku")) if cell("sku") not in (None, "") else None,
+            "tags": [t.strip() for t in re.split(r"[,;/>]", str(tags)) if t.strip()] if tags else [],
+            "options": [o.strip() for o in re.split(r"[,;/]", str(options)) if o.strip()] if options else [],
+            "ai_confidence": 1.0,
+        }
+
+    def products(self, blob, kind: str, client=None) -> Iterator[Dict[str, Any]]:
+        """Yields products row by row, then Gemini-extracted products for unmapped rows."""
+        rows = self._csv_rows(blob) if kind == "csv" else self._xlsx_rows(blob)
+        header_row = next(rows, None)
+        if not header_row:
+            return
+        self._headers = [str(h).strip() if h is not None else "" for h in header_row]
+        self._load_mapping(self._headers)
+
+        for values in rows:
+            if not any(v not in (None, "") for v in values):
+                continue
+            self.stats["rows"] += 1
+            row = dict(zip(self._headers, values))
+            product = self._to_product(row) if "title" in self.mapping else None
+            if product:
+                self.stats["mapped"] += 1
+                yield product
+            else:
+                self.stats["unmapped"] += 1
+                if len(self._unmapped) < MAX_UNMAPPED_ROWS:
+                    self._unmapped.append(row)
+                else:
+                    self.stats["dropped"] += 1
+
+        if self._unmapped and client is not None:
+            yield from self._extract_unmapped(client)
+        if self.stats["dropped"]:
+            registry.counter("catalogue.tabular.dropped_rows").inc(self.stats["dropped"])
+            logger.warning(f"Tabular ingest for '{self.supplier}': {self.stats['dropped']} unmapped rows beyond "
+                           f"{MAX_UNMAPPED_ROWS} were not extracted; fix the column mapping and re-upload")
+        logger.info(f"Tabular ingest for '{self.supplier}': {self.stats}")
+
+    def record(self, file_path: str, written: int):
+        """Per-upload stats in 'catalogue_uploads', including rows that were dropped."""
+        try:
+            self.db.collection(UPLOADS_COLLECTION).add({
+                "file": file_path,
+                "extraction": "tabular",
+                "supplier": self.supplier,
+                "products": written,
+                **self.stats,
+                "created_at": firestore.SERVER_TIMESTAMP,
+            })
+        except Exception as e:
+            logger.warning(f"Failed to record upload stats for {file_path}: {e}")
+
+    def _extract_unmapped(self, client) -> Iterator[Dict[str, Any]]:
+        for start in range(0, len(self._unmapped), UNMAPPED_BATCH_SIZE):
+            batch = self._unmapped[start:start + UNMAPPED_BATCH_SIZE]
+            lines = ["|".join(self._headers)]
+            lines += ["|".join("" if row.get(h) is None else str(row.get(h)).replace("|", "/") for h in self._headers)
+                      for row in batch]
+            self.stats["gemini_rows"] += len(batch)
+            try:
+                with span("catalogue.extract_unmapped", rows=len(batch)):
+                    response = client.models.generate_content(
+                        model=AIConfig.MODEL_NAME,
+                        contents=FALLBACK_PROMPT.format(rows="\n".join(lines)),
+                        config=types.GenerateContentConfig(response_mime_type="application/json", temperature=0.1)
+                    )
+                data = json.loads(response.text)
+                products = data.get("products", []) if isinstance(data, dict) else data
+            except Exception as e:
+                logger.error(f"Gemini fallback failed for {len(batch)} unmapped rows: {e}")
+                continue
+            self.stats["gemini_products"] += len(products)
+            yield from products
+
+
+def _chain_text(prefix: str, f) -> Iterator[str]:
+    """Re-joins the sniffed sample with the rest of the stream, line by line."""
+    yield from io.StringIO(prefix + f.readline())
+    yield from f
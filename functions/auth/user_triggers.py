@@ -1,8 +1,10 @@
 from firebase_functions import identity_fn
 from firebase_admin import firestore
 import time
+from telemetry import span, traced
 
 @identity_fn.before_user_created(region="europe-west1")
+@traced("create_user_document")
 def create_user_document(event: identity_fn.AuthBlockingEvent) -> identity_fn.BeforeCreateResponse | None:
     """
     Triggered before a new user is created in Firebase Auth (Blocking Function).
@@ -13,7 +15,8 @@ def create_user_document(event: identity_fn.AuthBlockingEvent) -> identity_fn.Be
     
     # Check if document already exists (edge case)
     doc_ref = db.collection("users").document(user.uid)
-    doc = doc_ref.get()
+    with span("user.lookup"):
+        doc = doc_ref.get()
     
     if doc.exists:
         print(f"User document for {user.uid} already exists. Skipping.")
@@ -32,7 +35,8 @@ def create_user_document(event: identity_fn.AuthBlockingEvent) -> identity_fn.Be
         }
     }
     
-    doc_ref.set(user_data)
+    with span("user.create_profile"):
+        doc_ref.set(user_data)
     print(f"Created user profile for {user.email} ({user.uid})")
 
     # --- Shopify Sync ---
@@ -47,11 +51,12 @@ def create_user_document(event: identity_fn.AuthBlockingEvent) -> identity_fn.Be
             first_name = parts[0]
             last_name = parts[1] if len(parts) > 1 else ""
             
-        shopify_customer = shopify.get_or_create_customer(
-            email=user.email,
-            first_name=first_name,
-            last_name=last_name
-        )
+        with span("user.shopify_sync"):
+            shopify_customer = shopify.get_or_create_customer(
+                email=user.email,
+                first_name=first_name,
+                last_name=last_name
+            )
         
         if shopify_customer:
             # Update Firestore with Shopify ID and enhanced data
@@ -0,0 +1,176 @@
+"""
+Benchmark for AADE transmission throughput (aade/runtime.py).
+
+Starts a local mock myDATA server (HTTP/1.1 keep-alive on 127.0.0.1) and
+sends invoices through InvoiceTransmitter from a pool of request threads,
+comparing the previous behaviour (a new event loop and AsyncClient per
+invoice) with the shared runtime, through submit_invoice_sync and through
+submit_invoice futures. Reports invoices per second, latency and how many
+TCP connections the server saw. Usage (from functions/):
+
+    python -m bench.aade_transmit --invoices 2000 --threads 16 --server-latency-ms 20
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+import httpx
+
+from bench import payloads
+from bench.stats import format_table, percentile
+
+RESPONSE = ('<?xml version="1.0" encoding="utf-8"?><ResponseDoc><response><index>1</index>'
+            '<invoiceUid>{uid}</invoiceUid><invoiceMark>{mark}</invoiceMark><statusCode>Success</statusCode>'
+            '</response></ResponseDoc>')
+
+
+class MockMyDataServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, latency_ms: float):
+        self.latency_ms = latency_ms
+        self.connections = set()
+        self.requests = 0
+        self.marks = 400000000000000
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), MockMyDataHandler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/myDATA/SendInvoices"
+
+
+class MockMyDataHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.requests += 1
+            server.marks += 1
+            mark = server.marks
+        if server.latency_ms:
+            time.sleep(server.latency_ms / 1000.0)
+        body = RESPONSE.format(uid=f"bench-{mark}", mark=mark).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def legacy_submit(transmitter, invoice) -> Dict[str, Any]:
+    """What submit_invoice_sync used to do: a new loop and a new client per invoice."""
+    async def transmit():
+        from aade.invoice_generator import InvoiceGenerator
+        xml_content = InvoiceGenerator.generate_xml(invoice)
+        async with httpx.AsyncClient() as client:
+            response = await client.post(transmitter.url, content=xml_content, headers=transmitter._headers())
+            return transmitter.parse_response(response.text)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop.run_until_complete(transmit())
+
+
+def run_mode(mode: str, server: MockMyDataServer, invoices: List[Any], threads: int) -> Dict[str, Any]:
+    from aade.invoice_transmitter import InvoiceTransmitter
+    from aade.runtime import shutdown_runtime
+    transmitter = InvoiceTransmitter()
+    transmitter.url = server.url
+    with server.lock:
+        server.connections.clear()
+        server.requests = 0
+
+    latencies: List[float] = []
+    failures = 0
+    started = time.perf_counter()
+    if mode == "futures":
+        # One thread keeps `threads` invoices in flight through submit_invoice
+        sent = {}
+        queue = list(invoices)
+        while queue or sent:
+            while queue and len(sent) < threads:
+                sent[transmitter.submit_invoice(queue.pop())] = time.perf_counter()
+            done, _ = concurrent.futures.wait(list(sent), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                latencies.append((time.perf_counter() - sent.pop(future)) * 1000)
+                failures += not future.result().get("success")
+    else:
+        submit = (lambda inv: legacy_submit(transmitter, inv)) if mode == "legacy" else transmitter.submit_invoice_sync
+
+        def one(invoice):
+            t0 = time.perf_counter()
+            result = submit(invoice)
+            return (time.perf_counter() - t0) * 1000, result.get("success")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            for latency, success in pool.map(one, invoices):
+                latencies.append(latency)
+                failures += not success
+    elapsed = time.perf_counter() - started
+    shutdown_runtime()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "invoices": len(invoices),
+        "failed": failures,
+        "invoices_per_sec": round(len(invoices) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "connections": len(server.connections),
+        "threads_alive": threading.active_count(),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="AADE transmission: per-call loops vs the shared async runtime")
+    parser.add_argument("--invoices", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=16, help="concurrent requests")
+    parser.add_argument("--server-latency-ms", type=float, default=20.0)
+    parser.add_argument("--modes", default="legacy,sync,futures")
+    parser.add_argument("--seed", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    os.environ.update({"AADE_USER_ID": "bench-user", "AADE_SUBSCRIPTION_KEY": "bench-key"})
+    from webhooks.shopify import map_shopify_to_aade
+    rng = random.Random(args.seed)
+    invoices = []
+    for i in range(args.invoices):
+        invoice = map_shopify_to_aade(payloads.make_order(9_000_000 + i, rng))
+        invoice.series, invoice.aa = "A", str(i + 1)
+        invoices.append(invoice)
+
+    server = MockMyDataServer(args.server_latency_ms)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        rows = [run_mode(mode.strip(), server, invoices, args.threads) for mode in args.modes.split(",") if mode.strip()]
+    finally:
+        server.shutdown()
+
+    print(format_table(rows, ["mode", "invoices", "failed", "invoices_per_sec", "p50_ms", "p95_ms",
+                              "connections", "threads_alive"]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    return 0 if all(r["failed"] == 0 for r in rows) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
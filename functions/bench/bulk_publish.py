@@ -0,0 +1,159 @@
+"""
+Benchmark for bulk draft publishing (shopify/bulk_publish.py).
+
+Seeds product_drafts with approved drafts (a few without a title, which
+Shopify rejects) and publishes them through staged JSONL uploads and bulk
+mutations against the mock Shopify API. Runs the job uninterrupted, then
+again with the callable timing out while an operation runs and with the
+instance crashing part way through applying results, and checks every
+draft ends published or failed exactly once with one products_live
+document per created product. Usage (from functions/):
+
+    python -m bench.bulk_publish --drafts 3000 --chunk-bytes 200000
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from typing import Any, Dict
+
+from bench import fakes
+from bench.stats import format_table
+
+TAGS = ["summer", "linen", "cotton", "gift", "kids", "sale", "outdoor", "home", "handmade"]
+
+
+class Crash(Exception):
+    pass
+
+
+def seed_drafts(db: fakes.FakeFirestore, count: int, rng: random.Random, untitled_ratio: float):
+    for i in range(count):
+        title = "" if rng.random() < untitled_ratio else f"Bench product {i}"
+        text = f"{title} {rng.choice(TAGS)}"
+        db.docs[f"product_drafts/draft-{i:06d}"] = {
+            "title": title,
+            "description": f"Generated description for {title or 'an untitled product'}.",
+            "price": round(rng.uniform(3, 250), 2),
+            "currency": "EUR",
+            "sku": f"BENCH-{i:06d}",
+            "tags": rng.sample(TAGS, 3),
+            "status": "approved",
+            "embedding_field": fakes.fake_embedding(text, dim=8),
+        }
+
+
+def crash_on_commit(db: fakes.FakeFirestore, after: int):
+    """Makes the `after`-th batch commit from now raise, like an instance dying mid-job."""
+    real_batch = db.batch
+    commits = {"n": 0}
+
+    def batch():
+        b = real_batch()
+        real_commit = b.commit
+
+        def commit():
+            commits["n"] += 1
+            if commits["n"] == after:
+                db.batch = real_batch
+                raise Crash()
+            return real_commit()
+        b.commit = commit
+        return b
+    db.batch = batch
+
+
+def run_scenario(args, scenario: str) -> Dict[str, Any]:
+    from shopify import bulk_publish
+    from shopify.bulk_publish import BulkPublisher
+
+    services = fakes.FakeServices(
+        db=fakes.FakeFirestore(args.read_latency_ms, args.read_latency_ms, args.commit_latency_ms),
+        http=fakes.MockHttpServices(latency_ms=args.api_latency_ms),
+    )
+    db, http = services.db, services.http
+    seed_drafts(db, args.drafts, random.Random(args.seed), args.untitled_ratio)
+    bulk_publish.MAX_CHUNK_BYTES = args.chunk_bytes
+    bulk_publish.POLL_SEC = 0.0
+    http.bulk_mutation_polls = 3
+
+    runs = 0
+    started = time.perf_counter()
+    with fakes.install(services):
+        publisher = BulkPublisher(db, owner="bench")
+        job_id = publisher.create_job()
+        if scenario == "timeout":
+            # The first call runs out of budget while Shopify is still working
+            report = publisher.run(job_id, budget_sec=0.0)
+            runs += 1
+            assert report["state"] == "running", report
+        elif scenario == "crash":
+            crash_on_commit(db, after=4)
+            try:
+                publisher.run(job_id)
+            except Crash:
+                pass
+            runs += 1
+            # The dead instance's lease has to lapse (or be cleared) before another can run the job
+            db.docs[f"publish_jobs/{job_id}"].update(lease_owner=None, lease_until=None)
+        while True:
+            report = publisher.run(job_id)
+            runs += 1
+            if report["state"] == "completed" or runs > 50:
+                break
+    elapsed = time.perf_counter() - started
+
+    drafts = [d for p, d in db.docs.items() if p.startswith("product_drafts/")]
+    mirrored = [d for p, d in db.docs.items() if p.startswith("products_live/")]
+    statuses: Dict[str, int] = {}
+    for d in drafts:
+        statuses[d["status"]] = statuses.get(d["status"], 0) + 1
+    shopify_ids = [d.get("shopifyId") for d in drafts if d.get("shopifyId")]
+    return {
+        "scenario": scenario,
+        "drafts": len(drafts),
+        "published": statuses.get("published", 0),
+        "failed": statuses.get("publish_failed", 0),
+        "stuck": len(drafts) - statuses.get("published", 0) - statuses.get("publish_failed", 0),
+        "mirrored": len(mirrored),
+        "duplicates": len(shopify_ids) - len(set(shopify_ids)) + max(0, len(mirrored) - len(shopify_ids)),
+        "embedded": sum(1 for d in mirrored if d.get("embedding_field") is not None),
+        "chunks": report.get("chunks_done"),
+        "runs": runs,
+        "api_calls": sum(v for k, v in http.requests.items() if k.startswith("shopify.")),
+        "bulk_mutations": http.requests.get("shopify.bulk_mutation", 0),
+        "batch_commits": db.stats["commits"],
+        "elapsed_ms": round(elapsed * 1000, 1),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk draft publishing: API calls, writes, resumability")
+    parser.add_argument("--drafts", type=int, default=3000)
+    parser.add_argument("--untitled-ratio", type=float, default=0.01, help="drafts Shopify will reject")
+    parser.add_argument("--chunk-bytes", type=int, default=200_000, help="staged file size per bulk mutation")
+    parser.add_argument("--api-latency-ms", type=float, default=50.0)
+    parser.add_argument("--commit-latency-ms", type=float, default=20.0)
+    parser.add_argument("--read-latency-ms", type=float, default=5.0)
+    parser.add_argument("--scenarios", default="clean,timeout,crash")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    rows = [run_scenario(args, s.strip()) for s in args.scenarios.split(",") if s.strip()]
+    print(format_table(rows, ["scenario", "drafts", "published", "failed", "stuck", "mirrored", "duplicates",
+                              "embedded", "chunks", "runs", "api_calls", "bulk_mutations", "batch_commits",
+                              "elapsed_ms"]))
+    # One at a time, the publish action makes a REST call plus two Firestore writes per draft
+    print(f"one-at-a-time publishing: {args.drafts} API calls, {2 * args.drafts} document writes, "
+          f"~{args.drafts * args.api_latency_ms / 1000:.0f}s of API latency alone", file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    ok = all(r["stuck"] == 0 and r["duplicates"] == 0 and r["mirrored"] == r["published"] for r in rows)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
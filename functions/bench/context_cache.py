@@ -0,0 +1,171 @@
+"""
+Benchmark for Gemini context caching (ContextCacheManager in ai/config.py).
+
+Catalogue extraction: the fake model stops after --max-output-products
+products per answer (cut off mid-object, like hitting the output token
+limit), so a large catalogue takes several passes over the same file.
+Compares sending the file with every pass against reading it from a
+context cache, by prompt tokens processed, billed-equivalent input tokens
+and wall time (prefill modelled at --prefill-ms-per-1k per uncached token).
+
+Static context: repeated calls with a large system instruction, with the
+cache expiring part way through, to check the fallback and recreation.
+Also reports whether the chat and bundle static parts reach the minimum
+cache size. Usage (from functions/):
+
+    python -m bench.context_cache --products 1500 --max-output-products 400 --file-tokens 60000
+"""
+import argparse
+import json
+import re
+import sys
+import time
+from typing import Any, Dict, List
+
+from bench import fakes, payloads
+from bench.stats import format_table
+
+_LAST = re.compile(r"the last one was: (\{.*\})")
+
+
+def extraction_responder(products: List[Dict[str, Any]], max_products: int):
+    """Answers the extraction prompt and its follow-ups, cut off after max_products."""
+    def responder(model, contents, config):
+        prompt = fakes._contents_text(contents)
+        start = 0
+        match = _LAST.search(prompt)
+        if match:
+            last = json.loads(match.group(1))
+            start = next((i + 1 for i, p in enumerate(products) if p["title"] == last["title"]), len(products))
+        page = products[start:start + max_products]
+        text = json.dumps({"products": page})
+        if start + max_products < len(products):
+            text = text[:-2] + ', {"title": "Cut off mid-obj'
+        return fakes.text_response(text)
+    return responder
+
+
+def run_extraction(args, cached: bool) -> Dict[str, Any]:
+    import random
+    from ai import catalogue
+    from ai.config import ContextCacheManager, ROUTES
+    from telemetry import registry
+
+    rng = random.Random(args.seed)
+    products = [payloads.make_product(i, rng) for i in range(args.products)]
+    client = fakes.FakeGenaiClient()
+    client.responder = extraction_responder(products, args.max_output_products)
+    client.file_tokens = args.file_tokens
+    client.cache_min_tokens = args.min_tokens
+    client.prefill_ms_per_1k_tokens = args.prefill_ms_per_1k
+    catalogue.context_caches = ContextCacheManager(enabled=cached, min_tokens=args.min_tokens)
+
+    registry.reset()
+    run = catalogue.ExtractionRun()
+    started = time.perf_counter()
+    extracted = list(catalogue.extract_with_gemini(
+        client, "gs://bench-bucket/catalogues/bench/catalogue.pdf", "application/pdf", run,
+        object_hash="bench-hash", size=args.file_bytes))
+    elapsed = time.perf_counter() - started
+    snapshot = registry.snapshot()
+    value = lambda name: snapshot.get(f"context_cache.catalogue_extraction.{name}", {}).get("value", 0)
+    prompt_tokens, cached_tokens = value("prompt_tokens"), value("cached_tokens")
+    # Creating a cache bills its tokens once at the normal rate
+    created = client.calls["cache_create"] * args.file_tokens
+    billed = prompt_tokens - cached_tokens + cached_tokens * 0.25 + created
+    return {
+        "case": "extraction_cached" if cached else "extraction_inline",
+        "products": len(extracted),
+        "unique": len({p["title"] for p in extracted}),
+        "passes": run.passes,
+        "truncated": run.truncated,
+        "prompt_tokens": int(prompt_tokens),
+        "cached_tokens": int(cached_tokens),
+        "billed_input_tokens": int(billed),
+        "cost_usd": round(billed * ROUTES["reasoning"].input_price / 1e6, 4),
+        "caches_created": client.calls["cache_create"],
+        "elapsed_ms": round(elapsed * 1000, 1),
+    }
+
+
+def run_static(args) -> Dict[str, Any]:
+    from ai.config import ContextCacheManager, StaticContext
+    from telemetry import registry
+
+    client = fakes.FakeGenaiClient()
+    client.cache_min_tokens = args.min_tokens
+    client.prefill_ms_per_1k_tokens = args.prefill_ms_per_1k
+    manager = ContextCacheManager(min_tokens=args.min_tokens)
+    # e.g. store policies, tone of voice and category guides sent with every question
+    context = StaticContext(name="bench_static", system_instruction="Store policy. " * (args.static_tokens // 3))
+
+    registry.reset()
+    failures = 0
+    started = time.perf_counter()
+    for i in range(args.calls):
+        if i == args.calls // 2:
+            client.caches.expire_all()
+        try:
+            manager.generate_content(client, "gemini-bench", context, f"Question {i}: is this in stock?")
+        except Exception:
+            failures += 1
+    elapsed = time.perf_counter() - started
+    snapshot = registry.snapshot()
+    value = lambda name: snapshot.get(f"context_cache.bench_static.{name}", {}).get("value", 0)
+    return {
+        "case": "static_context",
+        "calls": args.calls,
+        "failed": failures,
+        "hits": int(value("hits")),
+        "expired_fallbacks": int(value("expired")),
+        "caches_created": client.calls["cache_create"],
+        "prompt_tokens": int(value("prompt_tokens")),
+        "cached_tokens": int(value("cached_tokens")),
+        "elapsed_ms": round(elapsed * 1000, 1),
+    }
+
+
+def static_sizes(args) -> List[str]:
+    from ai.agent import BUNDLE_CONTEXT
+    from ai.chat import CHAT_CONTEXT
+    lines = []
+    for context in (CHAT_CONTEXT, BUNDLE_CONTEXT):
+        tokens = context.estimated_tokens()
+        verdict = "cached" if tokens >= args.min_tokens else "inline (below minimum)"
+        lines.append(f"{context.name}: ~{tokens} static tokens -> {verdict}")
+    return lines
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Gemini context caching: tokens and latency saved")
+    parser.add_argument("--products", type=int, default=1500)
+    parser.add_argument("--max-output-products", type=int, default=400, help="products per answer before it is cut off")
+    parser.add_argument("--file-tokens", type=int, default=60000, help="prompt tokens of the catalogue file")
+    parser.add_argument("--file-bytes", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=20.0)
+    parser.add_argument("--min-tokens", type=int, default=2048)
+    parser.add_argument("--static-tokens", type=int, default=8000)
+    parser.add_argument("--calls", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=9)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    extraction = [run_extraction(args, cached=False), run_extraction(args, cached=True)]
+    static = run_static(args)
+    print(format_table(extraction, ["case", "products", "unique", "passes", "truncated", "prompt_tokens",
+                                    "cached_tokens", "billed_input_tokens", "cost_usd", "caches_created",
+                                    "elapsed_ms"]))
+    print(format_table([static], ["case", "calls", "failed", "hits", "expired_fallbacks", "caches_created",
+                                  "prompt_tokens", "cached_tokens", "elapsed_ms"]))
+    for line in static_sizes(args):
+        print(line, file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"extraction": extraction, "static": static}, f, indent=2)
+    ok = all(r["products"] == args.products == r["unique"] and not r["truncated"] for r in extraction) \
+        and static["failed"] == 0 and static["expired_fallbacks"] == 1
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
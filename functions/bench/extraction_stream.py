@@ -0,0 +1,145 @@
+"""
+Benchmark for streamed catalogue extraction.
+
+Compares the old buffered path (join the whole Gemini response, json.loads)
+with ai.json_stream.ProductStreamParser on a large synthetic response:
+peak Python memory (tracemalloc), time to first product, total parse time
+and how many products survive a truncated response. Then runs
+process_catalogue_upload end to end against the fakes to report time to
+first draft. Usage (from functions/):
+
+    python -m bench.extraction_stream --products 20000 --chunk-chars 2048
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List
+
+from bench import fakes, payloads
+from bench.run import handler_of
+from bench.stats import format_table
+
+
+def chunked(text: str, size: int, latency_ms: float) -> Iterator[str]:
+    for i in range(0, len(text), size):
+        if i and latency_ms:
+            time.sleep(latency_ms / 1000.0)
+        yield text[i:i + size]
+
+
+def buffered(chunks: Iterator[str]) -> Iterator[Dict[str, Any]]:
+    data = json.loads("".join(chunks))
+    yield from data.get("products", []) if isinstance(data, dict) else data
+
+
+def streamed(chunks: Iterator[str]) -> Iterator[Dict[str, Any]]:
+    from ai.json_stream import iter_products
+    yield from iter_products(chunks)
+
+
+def measure(name: str, parse: Callable, make_chunks: Callable) -> Dict[str, Any]:
+    """Consumes products one at a time (as the draft writer does) and drops them."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    first_ms = None
+    count = 0
+    try:
+        for _ in parse(make_chunks()):
+            if first_ms is None:
+                first_ms = (time.perf_counter() - started) * 1000
+            count += 1
+    except ValueError as e:
+        print(f"{name}: {type(e).__name__}: {e}", file=sys.stderr)
+    total_ms = (time.perf_counter() - started) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "case": name,
+        "products": count,
+        "first_product_ms": round(first_ms, 1) if first_ms is not None else None,
+        "total_ms": round(total_ms, 1),
+        "peak_mib": round(peak / 2**20, 2),
+    }
+
+
+def end_to_end(text: str, args) -> Dict[str, Any]:
+    from google.genai import types
+    services = fakes.FakeServices(
+        genai_client=fakes.FakeGenaiClient(args.genai_latency_ms, args.embed_latency_ms,
+                                           stream_chunk_chars=args.chunk_chars,
+                                           stream_chunk_latency_ms=args.chunk_latency_ms),
+        db=fakes.FakeFirestore(args.firestore_latency_ms, args.firestore_latency_ms, args.firestore_latency_ms),
+    )
+
+    def responder(model, contents, config):
+        return fakes.text_response(text)
+
+    services.genai.responder = responder
+    event = SimpleNamespace(data=SimpleNamespace(
+        bucket=services.bucket.name,
+        name="catalogues/bench-supplier/stream.pdf",
+        content_type="application/pdf",
+        size=len(text),
+        md5_hash=None,
+        crc32c=None,
+    ))
+    with fakes.install(services):
+        import main
+        from telemetry import registry
+        registry.reset()
+        started = time.perf_counter()
+        handler_of(main.process_catalogue_upload)(event)
+        total_ms = (time.perf_counter() - started) * 1000
+        snapshot = registry.snapshot()
+    return {
+        "drafts": services.db.count("product_drafts"),
+        "first_product_ms": snapshot.get("catalogue.first_product_ms", {}).get("p50"),
+        "first_draft_ms": snapshot.get("catalogue.first_draft_ms", {}).get("p50"),
+        "total_ms": round(total_ms, 1),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Buffered vs streamed parsing of catalogue extraction output")
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--chunk-chars", type=int, default=2048)
+    parser.add_argument("--chunk-latency-ms", type=float, default=0.0, help="simulated delay between stream chunks")
+    parser.add_argument("--truncate-at", type=float, default=0.9, help="fraction of the response kept in the truncated case")
+    parser.add_argument("--e2e-products", type=int, default=2000, help="products for the end-to-end run (0 to skip)")
+    parser.add_argument("--genai-latency-ms", type=float, default=40.0)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--firestore-latency-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    text = json.dumps({"products": [payloads.make_product(i, rng) for i in range(args.products)]}, ensure_ascii=False)
+    cut = text[:int(len(text) * args.truncate_at)]
+    print(f"Synthetic response: {args.products} products, {len(text) / 2**20:.1f} MiB", file=sys.stderr)
+
+    rows: List[Dict[str, Any]] = []
+    for label, body in (("full", text), ("truncated", cut)):
+        make_chunks = lambda body=body: chunked(body, args.chunk_chars, args.chunk_latency_ms)
+        rows.append(measure(f"buffered/{label}", buffered, make_chunks))
+        rows.append(measure(f"streamed/{label}", streamed, make_chunks))
+    print(format_table(rows, ["case", "products", "first_product_ms", "total_ms", "peak_mib"]))
+
+    results: Dict[str, Any] = {"parse": rows}
+    if args.e2e_products:
+        e2e_text = json.dumps({"products": [payloads.make_product(i, rng) for i in range(args.e2e_products)]})
+        results["end_to_end"] = end_to_end(e2e_text, args)
+        print(f"\nprocess_catalogue_upload ({args.e2e_products} products): {results['end_to_end']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,980 @@
+import asyncio
+import contextlib
+import datetime
+import email
+import hashlib
+import io
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import httpx
+import numpy as np
+from google.api_core import exceptions as gexc
+from google.genai import types
+
+# In-process fakes for the services our Cloud Functions talk to.
+# They are deliberately small: enough surface for the handlers in main.py,
+# with configurable latency so benchmarks model real round trips.
+
+EMBEDDING_DIM = 768
+
+
+def _sleep_ms(ms: float):
+    if ms > 0:
+        time.sleep(ms / 1000.0)
+
+
+# --- Gemini / Vertex AI ---
+
+def text_response(text: str, prompt_tokens: int = 0) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part.from_text(text=text)]))],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=len(text) // 4,
+            total_token_count=prompt_tokens + len(text) // 4,
+        ),
+    )
+
+
+def function_call_response(name: str, args: Dict[str, Any]) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part.from_function_call(name=name, args=args)]))],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(prompt_token_count=0, candidates_token_count=8, total_token_count=8),
+    )
+
+
+def _contents_text(contents: Any) -> str:
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, types.Part):
+        return contents.text or ""
+    if isinstance(contents, types.Content):
+        return " ".join(_contents_text(p) for p in contents.parts or [])
+    if isinstance(contents, (list, tuple)):
+        return " ".join(_contents_text(c) for c in contents)
+    return ""
+
+
+def default_responder(model: str, contents: Any, config: Any) -> types.GenerateContentResponse:
+    """
+    Mimics the three prompt shapes we send:
+    tool-enabled chat turns, tool-result follow-ups and JSON generation.
+    """
+    prompt_tokens = len(_contents_text(contents)) // 4
+    if isinstance(contents, list) and any(isinstance(c, types.Content) and c.role == "tool" for c in contents):
+        return text_response("Based on our catalogue, I recommend the first two products.", prompt_tokens)
+    if config is not None and getattr(config, "tools", None):
+        last = contents[-1] if isinstance(contents, list) and contents else contents
+        return function_call_response("search_products", {"query": _contents_text(last)[:200]})
+    return text_response(json.dumps({
+        "bundle_title": "Starter Set",
+        "items": [{"title": "Item", "price": 10.0}],
+        "total_price": 10.0,
+        "reason": "Synthetic benchmark answer",
+    }), prompt_tokens)
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM, as_array: bool = False):
+    """Deterministic unit vector derived from the text."""
+    seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=4).digest(), "little")
+    vec = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    vec /= np.linalg.norm(vec)
+    return vec if as_array else vec.tolist()
+
+
+def _prompt_tokens(owner: "FakeGenaiClient", contents: Any, system_instruction: Any = None, tools: Any = None) -> int:
+    """Text at ~4 characters per token, plus `file_tokens` per file part."""
+    items = contents if isinstance(contents, (list, tuple)) else [contents]
+    files = sum(1 for c in items for p in (getattr(c, "parts", None) or [c]) if getattr(p, "file_data", None))
+    tools_text = " ".join(t.model_dump_json(exclude_none=True) for t in tools or [] if hasattr(t, "model_dump_json"))
+    return (len(_contents_text(contents)) + len(str(system_instruction or "")) + len(tools_text)) // 4 \
+        + files * owner.file_tokens
+
+
+class FakeCaches:
+    """client.caches: cached content with a TTL; FakeModels resolves requests that reference it."""
+
+    def __init__(self, owner: "FakeGenaiClient"):
+        self._owner = owner
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _cached_content(self, name: str, item: Dict[str, Any]) -> types.CachedContent:
+        return types.CachedContent(
+            name=name, display_name=item["display_name"], model=item["model"],
+            expire_time=datetime.datetime.fromtimestamp(item["expire_at"], datetime.timezone.utc),
+            usage_metadata=types.CachedContentUsageMetadata(total_token_count=item["tokens"]),
+        )
+
+    @staticmethod
+    def _ttl(config: Any) -> float:
+        return float(str(config.ttl).rstrip("s"))
+
+    def create(self, *, model: str, config: Any):
+        from google.genai import errors
+        self._owner.calls["cache_create"] += 1
+        _sleep_ms(self._owner.generate_latency_ms)
+        tokens = _prompt_tokens(self._owner, config.contents or [], config.system_instruction, config.tools)
+        if tokens < self._owner.cache_min_tokens:
+            raise errors.ClientError(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                                     "message": f"Cached content is too small: {tokens} tokens"}})
+        item = {
+            "display_name": config.display_name, "model": model, "tokens": tokens,
+            "contents": list(config.contents or []), "system_instruction": config.system_instruction,
+            "tools": config.tools, "tool_config": config.tool_config,
+            "expire_at": time.time() + self._ttl(config),
+        }
+        name = f"projects/bench/locations/europe-west1/cachedContents/{next(self._ids)}"
+        with self._lock:
+            self.items[name] = item
+        return self._cached_content(name, item)
+
+    def _live(self, name: str) -> Dict[str, Any]:
+        from google.genai import errors
+        with self._lock:
+            item = self.items.get(name)
+        if item is None or item["expire_at"] <= time.time():
+            raise errors.ClientError(404, {"error": {"code": 404, "status": "NOT_FOUND",
+                                                     "message": f"Cached content {name} not found or expired"}})
+        return item
+
+    def get(self, *, name: str, config: Any = None):
+        return self._cached_content(name, self._live(name))
+
+    def update(self, *, name: str, config: Any):
+        self._owner.calls["cache_update"] += 1
+        item = self._live(name)
+        item["expire_at"] = time.time() + self._ttl(config)
+        return self._cached_content(name, item)
+
+    def list(self, *, config: Any = None):
+        self._owner.calls["cache_list"] += 1
+        with self._lock:
+            items = [(n, i) for n, i in self.items.items() if i["expire_at"] > time.time()]
+        return [self._cached_content(n, i) for n, i in items]
+
+    def delete(self, *, name: str, config: Any = None):
+        with self._lock:
+            self.items.pop(name, None)
+
+    def expire_all(self):
+        """Lets every cache lapse, as if its TTL ran out between two calls."""
+        with self._lock:
+            for item in self.items.values():
+                item["expire_at"] = 0.0
+
+    def resolve(self, contents: Any, config: Any):
+        """(contents, config, cached tokens) with a referenced cache put back in front of the request."""
+        name = getattr(config, "cached_content", None) if config is not None else None
+        if not name:
+            return contents, config, 0
+        item = self._live(name)
+        items = contents if isinstance(contents, list) else [contents]
+        config = config.model_copy(update={
+            "cached_content": None, "system_instruction": item["system_instruction"],
+            "tools": item["tools"], "tool_config": item["tool_config"],
+        })
+        return item["contents"] + items, config, item["tokens"]
+
+
+class FakeModels:
+    def __init__(self, owner: "FakeGenaiClient"):
+        self._owner = owner
+
+    def _respond(self, model: str, contents: Any, config: Any) -> types.GenerateContentResponse:
+        """Responder output with usage: prompt tokens (cached ones included) and their prefill time."""
+        contents, config, cached = self._owner.caches.resolve(contents, config)
+        prompt = _prompt_tokens(self._owner, contents, getattr(config, "system_instruction", None),
+                                getattr(config, "tools", None))
+        _sleep_ms(self._owner.generate_latency_ms + self._owner.prefill_ms_per_1k_tokens * (prompt - cached) / 1000)
+        response = self._owner.responder(model, contents, config)
+        usage = response.usage_metadata or types.GenerateContentResponseUsageMetadata()
+        response.usage_metadata = usage.model_copy(update={
+            "prompt_token_count": prompt, "cached_content_token_count": cached or None,
+            "total_token_count": prompt + (usage.candidates_token_count or 0),
+        })
+        return response
+
+    def generate_content(self, *, model: str, contents: Any, config: Any = None):
+        self._owner.calls["generate_content"] += 1
+        with self._owner.quota(model, len(_contents_text(contents)) // 4):
+            return self._respond(model, contents, config)
+
+    def generate_content_stream(self, *, model: str, contents: Any, config: Any = None) -> Iterator:
+        self._owner.calls["generate_content_stream"] += 1
+        with self._owner.quota(model, len(_contents_text(contents)) // 4):
+            response = self._respond(model, contents, config)
+            text = response.text or ""
+            size = self._owner.stream_chunk_chars
+            for i in range(0, len(text), size):
+                if i:
+                    _sleep_ms(self._owner.stream_chunk_latency_ms)
+                chunk = text_response(text[i:i + size])
+                if i + size >= len(text):
+                    # Like Gemini, the last chunk carries the usage of the whole call
+                    chunk.usage_metadata = response.usage_metadata
+                yield chunk
+
+    def embed_content(self, *, model: str, contents: Any, config: Any = None):
+        self._owner.calls["embed_content"] += 1
+        with self._owner.quota(model, len(_contents_text(contents)) // 4):
+            _sleep_ms(self._owner.embed_latency_ms)
+            items = contents if isinstance(contents, list) else [contents]
+            return types.EmbedContentResponse(
+                embeddings=[types.ContentEmbedding(values=fake_embedding(_contents_text(c))) for c in items]
+            )
+
+    def count_tokens(self, *, model: str, contents: Any, config: Any = None):
+        self._owner.calls["count_tokens"] += 1
+        return types.CountTokensResponse(total_tokens=len(_contents_text(contents)) // 4)
+
+
+class FakeGenaiClient:
+    """Stand-in for google.genai.Client with configurable latency."""
+
+    def __init__(self, generate_latency_ms: float = 0.0, embed_latency_ms: float = 0.0,
+                 responder: Callable = default_responder, stream_chunk_chars: int = 512,
+                 stream_chunk_latency_ms: float = 0.0):
+        self.generate_latency_ms = generate_latency_ms
+        self.embed_latency_ms = embed_latency_ms
+        self.responder = responder
+        self.stream_chunk_chars = stream_chunk_chars
+        self.stream_chunk_latency_ms = stream_chunk_latency_ms
+        # Quota simulation: more than max_concurrent calls per model in flight, or
+        # more than tokens_per_minute prompt tokens per model (a bucket holding
+        # 10 seconds of it) -> 429, plus a random failure_rate of failure_code errors (e.g. 503)
+        self.max_concurrent: Optional[int] = None
+        self.tokens_per_minute: Optional[int] = None
+        self._buckets: Dict[str, List[float]] = {}
+        self.failure_rate = 0.0
+        self.failure_code = 503
+        self.errors: Dict[int, int] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        # Context caching: tokens counted per file part, caches below cache_min_tokens
+        # are rejected, and uncached prompt tokens add prefill latency
+        self.file_tokens = 0
+        self.cache_min_tokens = 0
+        self.prefill_ms_per_1k_tokens = 0.0
+        self.calls: Dict[str, int] = {"generate_content": 0, "generate_content_stream": 0,
+                                      "embed_content": 0, "count_tokens": 0,
+                                      "cache_create": 0, "cache_update": 0, "cache_list": 0}
+        self.models = FakeModels(self)
+        self.caches = FakeCaches(self)
+
+    def __call__(self, *args, **kwargs) -> "FakeGenaiClient":
+        # Lets the instance replace the genai.Client constructor
+        return self
+
+    def _fail(self, code: int):
+        from google.genai import errors
+        with self._lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+        status = "RESOURCE_EXHAUSTED" if code == 429 else "UNAVAILABLE"
+        body = {"error": {"code": code, "message": f"Simulated {status}", "status": status}}
+        raise (errors.ClientError if code < 500 else errors.ServerError)(code, body)
+
+    def _spend(self, model: str, tokens: int) -> bool:
+        """Takes tokens from the model's per-minute bucket; False if it does not hold that many."""
+        rate = self.tokens_per_minute / 60.0
+        now = time.monotonic()
+        bucket = self._buckets.setdefault(model, [rate * 10, now])
+        bucket[0] = min(rate * 10, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < min(tokens, rate * 10):
+            return False
+        bucket[0] -= tokens
+        return True
+
+    @contextlib.contextmanager
+    def quota(self, model: str, tokens: int = 0):
+        with self._lock:
+            in_flight = self._in_flight.get(model, 0)
+            over = self.max_concurrent is not None and in_flight >= self.max_concurrent
+            if not over and self.tokens_per_minute is not None:
+                over = not self._spend(model, tokens)
+            failed = self.failure_rate and self._rng.random() < self.failure_rate
+            if not over and not failed:
+                self._in_flight[model] = in_flight + 1
+        if over:
+            self._fail(429)
+        if failed:
+            self._fail(self.failure_code)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[model] -= 1
+
+
+# --- Firestore ---
+
+def _resolve(value: Any) -> Any:
+    from firebase_admin import firestore
+    if value is firestore.SERVER_TIMESTAMP:
+        return time.time()
+    return value
+
+
+class FakeSnapshot:
+    def __init__(self, reference: "FakeDocument", data: Optional[dict]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[dict]:
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field: str) -> Any:
+        return (self._data or {}).get(field)
+
+
+class FakeDocument:
+    def __init__(self, db: "FakeFirestore", path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "FakeCollection":
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def get(self, *args, **kwargs) -> FakeSnapshot:
+        self._db._op(self._db.read_latency_ms, "reads")
+        with self._db._lock:
+            return FakeSnapshot(self, self._db.docs.get(self.path))
+
+    def set(self, data: dict, merge: bool = False):
+        self._db._op(self._db.write_latency_ms, "writes")
+        self._db._apply_set(self.path, data, merge)
+
+    def create(self, data: dict):
+        self._db._op(self._db.write_latency_ms, "writes")
+        with self._db._lock:
+            if self.path in self._db.docs:
+                raise gexc.AlreadyExists(f"Document already exists: {self.path}")
+            self._db.docs[self.path] = {k: _resolve(v) for k, v in data.items()}
+
+    def update(self, data: dict):
+        self._db._op(self._db.write_latency_ms, "writes")
+        with self._db._lock:
+            if self.path not in self._db.docs:
+                raise gexc.NotFound(f"No document to update: {self.path}")
+        self._db._apply_set(self.path, data, merge=True)
+
+    def delete(self):
+        self._db._op(self._db.write_latency_ms, "writes")
+        with self._db._lock:
+            self._db.docs.pop(self.path, None)
+
+
+class FakeQuery:
+    def __init__(self, collection: "FakeCollection", filters=None, order=None, limit_n=None, nearest=None,
+                 fields=None):
+        self._collection = collection
+        self._filters = filters or []
+        self._order = order
+        self._limit = limit_n
+        self._nearest = nearest
+        self._fields = fields
+
+    def _copy(self, **changes) -> "FakeQuery":
+        q = FakeQuery(self._collection, list(self._filters), self._order, self._limit, self._nearest, self._fields)
+        for k, v in changes.items():
+            setattr(q, k, v)
+        return q
+
+    def where(self, field_path: str = None, op_string: str = None, value: Any = None, filter=None) -> "FakeQuery":
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(_filters=self._filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING") -> "FakeQuery":
+        return self._copy(_order=(field_path, direction))
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(_limit=count)
+
+    def select(self, field_paths) -> "FakeQuery":
+        return self._copy(_fields=list(field_paths))
+
+    def find_nearest(self, vector_field: str, query_vector, distance_measure, limit: int,
+                     distance_result_field: Optional[str] = None, **kwargs) -> "FakeQuery":
+        return self._copy(_nearest=(vector_field, list(query_vector), distance_measure, distance_result_field), _limit=limit)
+
+    @staticmethod
+    def _match(data: dict, field: str, op: str, value: Any) -> bool:
+        actual = data.get(field)
+        if op == "==":
+            return actual == value
+        if op == "in":
+            return actual in value
+        if op == "array_contains":
+            return isinstance(actual, list) and value in actual
+        if actual is None:
+            return False
+        return {"<": actual < value, "<=": actual <= value, ">": actual > value, ">=": actual >= value}.get(op, False)
+
+    def get(self, *args, **kwargs) -> List[FakeSnapshot]:
+        return list(self.stream())
+
+    def stream(self, *args, **kwargs) -> Iterator[FakeSnapshot]:
+        db = self._collection._db
+        db._op(db.read_latency_ms, "queries")
+        prefix = self._collection.path + "/"
+        with db._lock:
+            rows = [(p, dict(d)) for p, d in db.docs.items()
+                    if p.startswith(prefix) and "/" not in p[len(prefix):]]
+        for field, op, value in self._filters:
+            rows = [r for r in rows if self._match(r[1], field, op, value)]
+        if self._nearest:
+            rows = self._rank(rows)
+        elif self._order:
+            field, direction = self._order
+            rows.sort(key=lambda r: (r[1].get(field) is None, r[1].get(field)), reverse=direction == "DESCENDING")
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for path, data in rows:
+            if self._fields is not None:
+                data = {k: v for k, v in data.items() if k in self._fields}
+            yield FakeSnapshot(FakeDocument(db, path), data)
+
+    def _rank(self, rows):
+        field, query, measure, result_field = self._nearest
+        rows = [r for r in rows if r[1].get(field) is not None]
+        if not rows:
+            return []
+        matrix = np.stack([np.asarray(r[1][field], dtype=np.float32) for r in rows])
+        q = np.asarray(query, dtype=np.float32)
+        name = getattr(measure, "name", str(measure))
+        if name == "EUCLIDEAN":
+            dist = np.linalg.norm(matrix - q, axis=1)
+        elif name == "DOT_PRODUCT":
+            dist = -(matrix @ q)
+        else:
+            norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(q) or 1.0)
+            dist = 1.0 - (matrix @ q) / np.where(norms == 0, 1.0, norms)
+        order = np.argsort(dist)[: self._limit or len(rows)]
+        ranked = []
+        for i in order:
+            path, data = rows[i]
+            if result_field:
+                data[result_field] = float(dist[i])
+            ranked.append((path, data))
+        return ranked
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db: "FakeFirestore", path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+        super().__init__(self)
+
+    def document(self, doc_id: Optional[str] = None) -> FakeDocument:
+        return FakeDocument(self._db, f"{self.path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data: dict):
+        ref = self.document()
+        ref.set(data)
+        return time.time(), ref
+
+
+class FakeWriteBatch:
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._ops: List[Callable[[], None]] = []
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def set(self, ref: FakeDocument, data: dict, merge: bool = False):
+        self._ops.append(lambda: self._db._apply_set(ref.path, data, merge))
+
+    def update(self, ref: FakeDocument, data: dict):
+        self._ops.append(lambda: self._db._apply_set(ref.path, data, True))
+
+    def delete(self, ref: FakeDocument):
+        self._ops.append(lambda: self._db.docs.pop(ref.path, None))
+
+    def commit(self):
+        self._db._op(self._db.commit_latency_ms, "commits")
+        with self._db._lock:
+            for op in self._ops:
+                op()
+        self._ops = []
+
+
+class FakeTransaction:
+    """Buffers writes like FakeWriteBatch; fake_transactional runs transactions one at a time."""
+
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._ops: List[Callable[[], None]] = []
+
+    def set(self, ref: FakeDocument, data: dict, merge: bool = False):
+        self._ops.append(lambda: self._db._apply_set(ref.path, data, merge))
+
+    def update(self, ref: FakeDocument, data: dict):
+        self._ops.append(lambda: self._db._apply_set(ref.path, data, True))
+
+    def create(self, ref: FakeDocument, data: dict):
+        self._ops.append(lambda: self._db._apply_set(ref.path, data, False))
+
+    def delete(self, ref: FakeDocument):
+        self._ops.append(lambda: self._db.docs.pop(ref.path, None))
+
+    def _commit(self):
+        self._db._op(self._db.commit_latency_ms, "commits")
+        with self._db._lock:
+            for op in self._ops:
+                op()
+        self._ops = []
+
+
+def fake_transactional(fn: Callable) -> Callable:
+    """
+    Stand-in for firestore.transactional. Transactions are serialised, as
+    contending transactions on one document effectively are in Firestore.
+    """
+    def run(transaction: FakeTransaction, *args, **kwargs):
+        with transaction._db._transaction_lock:
+            result = fn(transaction, *args, **kwargs)
+            transaction._commit()
+        return result
+    return run
+
+
+class FakeBulkWriter:
+    """
+    BulkWriter stand-in: batches of 20 committed on a thread pool, with
+    optional per-write failures so retry callbacks get exercised.
+    """
+
+    BATCH_SIZE = 20
+
+    def __init__(self, db: "FakeFirestore", max_workers: int = 8):
+        self._db = db
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fake-bulk-writer")
+        self._ops: List[tuple] = []
+        self._futures: List = []
+        self._lock = threading.Lock()
+        self._on_result = lambda ref, result, bw: None
+        self._on_error = lambda failure, bw: failure.attempts < 15
+
+    def on_write_result(self, callback):
+        self._on_result = callback
+
+    def on_write_error(self, callback):
+        self._on_error = callback
+
+    def set(self, reference: FakeDocument, document_data: dict, merge: bool = False, attempts: int = 0):
+        with self._lock:
+            self._ops.append((reference, document_data, merge, attempts))
+            if len(self._ops) >= self.BATCH_SIZE:
+                self._send_locked()
+
+    def _send_locked(self):
+        ops, self._ops = self._ops, []
+        self._futures.append(self._executor.submit(self._commit, ops))
+
+    def _commit(self, ops):
+        from google.cloud.firestore_v1.bulk_writer import BulkWriteFailure, BulkWriterSetOperation
+        self._db._op(self._db.commit_latency_ms, "commits")
+        for reference, data, merge, attempts in ops:
+            if self._db.write_error_rate and self._db._rng.random() < self._db.write_error_rate:
+                operation = BulkWriterSetOperation(reference=reference, document_data=data, merge=merge,
+                                                   attempts=attempts + 1)
+                failure = BulkWriteFailure(operation=operation, code=10, message="ABORTED (simulated contention)")
+                if self._on_error(failure, self):
+                    self.set(reference, data, merge, attempts + 1)
+                continue
+            self._db._apply_set(reference.path, data, merge)
+            self._on_result(reference, None, self)
+
+    def flush(self):
+        while True:
+            with self._lock:
+                if self._ops:
+                    self._send_locked()
+                futures, self._futures = self._futures, []
+            if not futures:
+                return
+            for future in futures:
+                future.result()
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
+
+
+class FakeFirestore:
+    """In-memory Firestore with the subset of the client API our functions use."""
+
+    def __init__(self, read_latency_ms: float = 0.0, write_latency_ms: float = 0.0, commit_latency_ms: float = 0.0):
+        self.read_latency_ms = read_latency_ms
+        self.write_latency_ms = write_latency_ms
+        self.commit_latency_ms = commit_latency_ms
+        self.docs: Dict[str, dict] = {}
+        self.stats: Dict[str, int] = {"reads": 0, "writes": 0, "queries": 0, "commits": 0}
+        self.write_error_rate = 0.0  # fraction of BulkWriter writes that fail (and get retried)
+        self._rng = random.Random(0)
+        self._lock = threading.RLock()
+        self._transaction_lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs) -> "FakeFirestore":
+        # Lets the instance replace firestore.client()
+        return self
+
+    def _op(self, latency_ms: float, kind: str):
+        with self._lock:
+            self.stats[kind] += 1
+        _sleep_ms(latency_ms)
+
+    def _apply_set(self, path: str, data: dict, merge: bool):
+        resolved = {k: _resolve(v) for k, v in data.items()}
+        with self._lock:
+            if merge and path in self.docs:
+                self.docs[path].update(resolved)
+            else:
+                self.docs[path] = resolved
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, name)
+
+    def document(self, path: str) -> FakeDocument:
+        return FakeDocument(self, path)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def get_all(self, references: Iterable[FakeDocument], field_paths: Any = None,
+                transaction: Any = None) -> Iterator[FakeSnapshot]:
+        """One batched read for all references (a single round trip, like BatchGetDocuments)."""
+        self._op(self.read_latency_ms, "reads")
+        with self._lock:
+            snapshots = [FakeSnapshot(ref, self.docs.get(ref.path)) for ref in references]
+        return iter(snapshots)
+
+    def bulk_writer(self, options: Any = None) -> FakeBulkWriter:
+        return FakeBulkWriter(self)
+
+    def count(self, collection: str) -> int:
+        prefix = collection + "/"
+        return sum(1 for p in self.docs if p.startswith(prefix) and "/" not in p[len(prefix):])
+
+
+# --- Cloud Storage ---
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.metadata: Optional[dict] = None
+        self.content_type: Optional[str] = None
+
+    def exists(self) -> bool:
+        return self.name in self.bucket.objects
+
+    def upload_from_string(self, data, content_type: Optional[str] = None):
+        self.bucket.objects[self.name] = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        self.bucket.metadata[self.name] = dict(self.metadata or {})
+        self.content_type = content_type
+
+    def upload_from_filename(self, filename: str, content_type: Optional[str] = None):
+        with open(filename, "rb") as f:
+            self.upload_from_string(f.read(), content_type)
+
+    def download_as_bytes(self) -> bytes:
+        return self.bucket.objects[self.name]
+
+    def download_to_filename(self, filename: str):
+        with open(filename, "wb") as f:
+            f.write(self.bucket.objects[self.name])
+
+    def open(self, mode: str = "rb", encoding: str = "utf-8", newline: Optional[str] = None, **kwargs):
+        raw = io.BytesIO(self.bucket.objects[self.name])
+        return raw if "b" in mode else io.TextIOWrapper(raw, encoding=encoding, newline=newline)
+
+
+class FakeBucket:
+    def __init__(self, name: str = "bench-bucket"):
+        self.name = name
+        self.objects: Dict[str, bytes] = {}
+        self.metadata: Dict[str, dict] = {}
+
+    def __call__(self, name: Optional[str] = None, *args, **kwargs) -> "FakeBucket":
+        # Lets the instance replace firebase_admin.storage.bucket()
+        return self
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str) -> Optional[FakeBlob]:
+        if name not in self.objects:
+            return None
+        blob = FakeBlob(self, name)
+        blob.metadata = dict(self.metadata.get(name) or {}) or None
+        return blob
+
+
+# --- Shopify & myDATA over httpx.MockTransport ---
+
+BULK_OPERATION_ID = "gid://shopify/BulkOperation/1"
+BULK_RESULT_HOST = "bench-storage.test"
+BULK_MUTATION_ID_PREFIX = "gid://shopify/BulkOperation/"
+STAGED_UPLOAD_HOST = "bench-staged-uploads.test"
+
+class MockHttpServices:
+    """Routes Shopify Admin and AADE myDATA requests to canned responses."""
+
+    def __init__(self, latency_ms: float = 0.0, aade_error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.aade_error_rate = aade_error_rate
+        self.requests: Dict[str, int] = {}
+        self.bulk_jsonl = b""   # result file of the next Shopify bulk query over products
+        self.bulk_inventory_jsonl = b""   # ... and of one rooted at inventoryItems
+        self._bulk_root = "products"
+        # Bulk mutations: staged JSONL files by key, and the latest operation
+        # (reported RUNNING for `bulk_mutation_polls` polls before completing)
+        self.staged: Dict[str, bytes] = {}
+        self.bulk_mutation: Optional[Dict[str, Any]] = None
+        self.bulk_mutation_polls = 0
+        self._bulk_ids = itertools.count(2)
+        self._product_ids = itertools.count(8_000_000_000)
+        self._marks = itertools.count(400000000000000)
+        self._lock = threading.Lock()
+
+    def _count(self, key: str):
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def route(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if "customers/search.json" in path:
+            self._count("shopify.customers.search")
+            return httpx.Response(200, json={"customers": []})
+        if path.endswith("/customers.json"):
+            self._count("shopify.customers.create")
+            body = json.loads(request.content or b"{}").get("customer", {})
+            return httpx.Response(201, json={"customer": {"id": abs(hash(body.get("email"))) % 10**12, **body}})
+        if path.endswith("/graphql.json"):
+            self._count("shopify.graphql")
+            body = json.loads(request.content or b"{}")
+            return httpx.Response(200, json={"data": self._graphql(body.get("query", ""), body.get("variables") or {})})
+        if request.url.host == STAGED_UPLOAD_HOST:
+            self._count("shopify.staged_upload")
+            return self._staged_upload(request)
+        if request.url.host == BULK_RESULT_HOST:
+            self._count("shopify.bulk_download")
+            if path.endswith("/mutation.jsonl"):
+                return httpx.Response(200, content=self.bulk_mutation["result"])
+            if path.endswith("/inventory.jsonl"):
+                return httpx.Response(200, content=self.bulk_inventory_jsonl)
+            return httpx.Response(200, content=self.bulk_jsonl)
+        if "SendInvoices" in path:
+            self._count("aade.send_invoices")
+            with self._lock:
+                mark = next(self._marks)
+                fail = self.aade_error_rate and (mark % int(1 / self.aade_error_rate) == 0)
+            if fail:
+                return httpx.Response(500, text="<error>Simulated myDATA failure</error>")
+            return httpx.Response(200, text=(
+                "<ResponseDoc><response><index>1</index><statusCode>Success</statusCode>"
+                f"<invoiceUid>{uuid.uuid4().hex.upper()}</invoiceUid><invoiceMark>{mark}</invoiceMark>"
+                "</response></ResponseDoc>"
+            ))
+        if "CancelInvoice" in path:
+            self._count("aade.cancel_invoice")
+            return httpx.Response(200, text=(
+                "<ResponseDoc><response><statusCode>Success</statusCode>"
+                f"<cancellationMark>{next(self._marks)}</cancellationMark></response></ResponseDoc>"
+            ))
+        self._count("unrouted")
+        return httpx.Response(404, text=f"No fake route for {path}")
+
+    def _staged_upload(self, request: httpx.Request) -> httpx.Response:
+        message = email.message_from_bytes(
+            b"Content-Type: " + request.headers["content-type"].encode() + b"\r\n\r\n" + request.read())
+        fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                  for part in message.get_payload()}
+        self.staged[fields["key"].decode()] = fields["file"]
+        return httpx.Response(201)
+
+    def _run_bulk_mutation(self, staged_path: str) -> Dict[str, Any]:
+        """productCreate over every staged line; drafts without a title get a userError."""
+        results = []
+        for line_number, line in enumerate(self.staged[staged_path].splitlines()):
+            product_input = json.loads(line)["input"]
+            if not product_input.get("title"):
+                result = {"product": None, "userErrors": [{"field": ["title"], "message": "Title can't be blank"}]}
+            else:
+                product_id = next(self._product_ids)
+                result = {"product": {
+                    "id": f"gid://shopify/Product/{product_id}",
+                    "title": product_input["title"],
+                    "handle": "-".join(product_input["title"].lower().split()),
+                    "status": product_input.get("status", "ACTIVE"),
+                    "productType": product_input.get("productType"),
+                    "vendor": product_input.get("vendor"),
+                    "tags": product_input.get("tags") or [],
+                    "description": product_input.get("descriptionHtml") or "",
+                    "updatedAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    "variants": {"edges": [{"node": {
+                        "id": f"gid://shopify/ProductVariant/{product_id}{i}",
+                        "sku": variant.get("sku"),
+                        "price": variant.get("price"),
+                        "inventoryQuantity": 0,
+                        "inventoryItem": {"id": f"gid://shopify/InventoryItem/{product_id}{i}"},
+                    }} for i, variant in enumerate(product_input.get("variants") or [])]},
+                }, "userErrors": []}
+            results.append(json.dumps({"data": {"productCreate": result}, "__lineNumber": line_number}))
+        self.bulk_mutation = {
+            "id": f"{BULK_MUTATION_ID_PREFIX}{next(self._bulk_ids)}",
+            "createdAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "result": ("\n".join(results) + "\n").encode("utf-8"),
+            "objects": len(results),
+            "polls_left": self.bulk_mutation_polls,
+        }
+        return self.bulk_mutation
+
+    def _current_bulk_mutation(self) -> Optional[Dict[str, Any]]:
+        operation = self.bulk_mutation
+        if operation is None:
+            return None
+        running = operation["polls_left"] > 0
+        done = operation["objects"] // (operation["polls_left"] + 1) if running else operation["objects"]
+        operation["polls_left"] -= 1
+        return {
+            "id": operation["id"], "status": "RUNNING" if running else "COMPLETED", "errorCode": None,
+            "createdAt": operation["createdAt"], "objectCount": str(done),
+            "url": None if running else f"https://{BULK_RESULT_HOST}/bulk/mutation.jsonl",
+            "partialDataUrl": None,
+        }
+
+    def _graphql(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        variables = variables or {}
+        if "stagedUploadsCreate" in query:
+            key = f"tmp/bench/bulk/{uuid.uuid4().hex}/{variables['input'][0]['filename']}"
+            return {"stagedUploadsCreate": {"stagedTargets": [{
+                "url": f"https://{STAGED_UPLOAD_HOST}/", "resourceUrl": None,
+                "parameters": [{"name": "key", "value": key}, {"name": "Content-Type", "value": "text/jsonl"}],
+            }], "userErrors": []}}
+        if "bulkOperationRunMutation" in query:
+            self._count("shopify.bulk_mutation")
+            operation = self._run_bulk_mutation(variables["path"])
+            return {"bulkOperationRunMutation": {"bulkOperation": {"id": operation["id"], "status": "CREATED"},
+                                                 "userErrors": []}}
+        if "currentBulkOperation(type: MUTATION)" in query:
+            return {"currentBulkOperation": self._current_bulk_mutation()}
+        # Bulk queries complete immediately and serve `bulk_jsonl` (or `bulk_inventory_jsonl`)
+        if "bulkOperationRunQuery" in query:
+            self._count("shopify.bulk_operation")
+            self._bulk_root = "inventory" if "inventoryItems" in variables.get("query", "") else "products"
+            return {"bulkOperationRunQuery": {"bulkOperation": {"id": BULK_OPERATION_ID, "status": "CREATED"},
+                                              "userErrors": []}}
+        if "currentBulkOperation" in query:
+            result = self.bulk_inventory_jsonl if self._bulk_root == "inventory" else self.bulk_jsonl
+            return {"currentBulkOperation": {
+                "id": BULK_OPERATION_ID, "status": "COMPLETED", "errorCode": None,
+                "objectCount": str(result.count(b"\n")),
+                "url": f"https://{BULK_RESULT_HOST}/bulk/{self._bulk_root}.jsonl" if result else None,
+                "partialDataUrl": None,
+            }}
+        return {}
+
+    def sync_transport(self) -> httpx.MockTransport:
+        def handler(request: httpx.Request) -> httpx.Response:
+            _sleep_ms(self.latency_ms)
+            return self.route(request)
+        return httpx.MockTransport(handler)
+
+    def async_transport(self) -> httpx.MockTransport:
+        async def handler(request: httpx.Request) -> httpx.Response:
+            if self.latency_ms > 0:
+                await asyncio.sleep(self.latency_ms / 1000.0)
+            return self.route(request)
+        return httpx.MockTransport(handler)
+
+
+# --- Wiring ---
+
+class FakeServices:
+    """Bundle of fakes installed together by `install`."""
+
+    def __init__(self, genai_client: Optional[FakeGenaiClient] = None, db: Optional[FakeFirestore] = None,
+                 bucket: Optional[FakeBucket] = None, http: Optional[MockHttpServices] = None):
+        self.genai = genai_client or FakeGenaiClient()
+        self.db = db or FakeFirestore()
+        self.bucket = bucket or FakeBucket()
+        self.http = http or MockHttpServices()
+
+
+BENCH_ENV = {
+    "SHOPIFY_WEBHOOK_SECRET": "bench-secret",
+    "SHOPIFY_STORE_DOMAIN": "bench-shop.myshopify.com",
+    "SHOPIFY_ADMIN_ACCESS_TOKEN": "bench-token",
+    "AADE_USER_ID": "bench-user",
+    "AADE_SUBSCRIPTION_KEY": "bench-key",
+    "AADE_ENVIRONMENT": "development",
+    "FIREBASE_STORAGE_BUCKET": "bench-bucket",
+    "GOOGLE_CLOUD_PROJECT": "bench-project",
+    "TELEMETRY_EXPORTERS": "none",
+}
+
+
+@contextlib.contextmanager
+def install(services: FakeServices):
+    """
+    Points genai.Client, firestore.client(), storage.bucket() and every
+    httpx client at the given fakes for the duration of the block.
+    """
+    import os
+    from unittest import mock
+    import firebase_admin.firestore
+    import firebase_admin.storage
+    import google.genai
+    import aade.numbering
+
+    sync_transport = services.http.sync_transport()
+    async_transport = services.http.async_transport()
+    real_client, real_async_client = httpx.Client, httpx.AsyncClient
+
+    class _Client(real_client):
+        def __init__(self, *args, **kwargs):
+            kwargs["transport"] = sync_transport
+            kwargs.pop("http2", None)
+            super().__init__(*args, **kwargs)
+
+    class _AsyncClient(real_async_client):
+        def __init__(self, *args, **kwargs):
+            kwargs["transport"] = async_transport
+            kwargs.pop("http2", None)
+            super().__init__(*args, **kwargs)
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.dict(os.environ, BENCH_ENV))
+        stack.enter_context(mock.patch.object(google.genai, "Client", services.genai))
+        stack.enter_context(mock.patch.object(firebase_admin.firestore, "client", services.db))
+        stack.enter_context(mock.patch.object(firebase_admin.firestore, "transactional", fake_transactional))
+        stack.enter_context(mock.patch.object(firebase_admin.storage, "bucket", services.bucket))
+        stack.enter_context(mock.patch.object(httpx, "Client", _Client))
+        stack.enter_context(mock.patch.object(httpx, "AsyncClient", _AsyncClient))
+        # Blocks leased from the fakes must not be released into the real Firestore at exit
+        stack.enter_context(mock.patch.object(aade.numbering, "_allocator", None))
+        yield services
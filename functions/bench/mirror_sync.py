@@ -0,0 +1,170 @@
+"""
+Benchmark for the Shopify -> products_live mirror.
+
+Bootstraps the mirror from the products and inventoryItems bulk operation
+results (synthetic, or the recorded fixtures in bench/fixtures/shopify), bootstraps again to show that
+an unchanged catalogue costs no writes, then replays products/update and
+inventory_levels/update webhooks through shopify_webhook and reports write
+volume and sync lag per event kind. Usage (from functions/):
+
+    python -m bench.mirror_sync --products 2000 --updates 2000
+    python -m bench.mirror_sync --fixtures
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from bench import fakes, payloads
+from bench.run import handler_of, webhook_request
+from bench.stats import format_table
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "shopify")
+
+
+def now_iso(delay_ms: float = 0.0) -> str:
+    moment = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(milliseconds=delay_ms)
+    return moment.isoformat(timespec="milliseconds")
+
+
+def load_fixture(name: str):
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as f:
+        return f.read() if name.endswith(".jsonl") else json.loads(f.read())
+
+
+def bootstrap(services: fakes.FakeServices, label: str) -> Dict[str, Any]:
+    from shopify.client import ShopifyClient
+    from shopify.mirror import ProductMirror
+    before = dict(services.db.stats)
+    report = ProductMirror(services.db, ShopifyClient()).bootstrap()
+    return {
+        "phase": label,
+        "products": report["seen"],
+        "docs_written": report["written"],
+        "fields_written": report["fields_written"],
+        "embedded": report["embedded"],
+        "firestore_commits": services.db.stats.get("commits", 0) - before.get("commits", 0),
+        "elapsed_ms": report["elapsed_ms"],
+    }
+
+
+def replay(services: fakes.FakeServices, label: str, topic: str, bodies: List[Dict[str, Any]],
+           delivery_delay_ms: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Sends webhooks one by one through the real endpoint; returns write volume
+    and lag. With delivery_delay_ms, each body's updated_at is stamped that
+    long before it is sent, so lag measures our processing plus that delay.
+    """
+    import main
+    from telemetry import registry
+    handler = handler_of(main.shopify_webhook)
+    secret = fakes.BENCH_ENV["SHOPIFY_WEBHOOK_SECRET"]
+    registry.reset()
+    started = time.perf_counter()
+    failures = 0
+    for i, body in enumerate(bodies):
+        if delivery_delay_ms is not None:
+            body = dict(body, updated_at=now_iso(delivery_delay_ms))
+        response = handler(webhook_request(payloads.encode(body), secret, topic=topic, webhook_id=f"{label}-{i}"))
+        failures += response.status_code != 200
+    elapsed = time.perf_counter() - started
+    snapshot = registry.snapshot()
+    writes = int(registry.counter("mirror.writes").value)
+    lag = snapshot.get("mirror.lag_ms", {})
+    return {
+        "phase": label,
+        "events": len(bodies),
+        "failed": failures,
+        "docs_written": writes,
+        "fields_written": int(registry.counter("mirror.fields_written").value),
+        "writes_per_event": round(writes / len(bodies), 3) if bodies else None,
+        "lag_p50_ms": lag.get("p50"),
+        "lag_p95_ms": lag.get("p95"),
+        "events_per_sec": round(len(bodies) / elapsed, 1) if elapsed else None,
+    }
+
+
+def run_fixtures(services: fakes.FakeServices) -> List[Dict[str, Any]]:
+    services.http.bulk_jsonl = load_fixture("products_bulk.jsonl")
+    services.http.bulk_inventory_jsonl = load_fixture("inventory_bulk.jsonl")
+    rows = [bootstrap(services, "bootstrap"), bootstrap(services, "bootstrap_again")]
+    update = load_fixture("products_update.json")
+    rows.append(replay(services, "products/update", "products/update", [update]))
+    rows.append(replay(services, "products/update (redelivered)", "products/update", [update]))
+    rows.append(replay(services, "inventory_levels/update", "inventory_levels/update",
+                       [load_fixture("inventory_levels_update.json")]))
+    doc = services.db.docs.get(f"products_live/{update['id']}")
+    print(f"products_live/{update['id']}: price={doc.get('price')} variants={len(doc.get('variants', []))}",
+          file=sys.stderr)
+    return rows
+
+
+def run_synthetic(services: fakes.FakeServices, args) -> List[Dict[str, Any]]:
+    rng = random.Random(args.seed)
+    products = [payloads.make_shopify_product(8_000_000_000 + i, rng, updated_at=now_iso(60_000))
+                for i in range(args.products)]
+    services.http.bulk_jsonl = "".join(
+        json.dumps(line) + "\n" for p in products for line in payloads.bulk_lines(p)).encode("utf-8")
+    services.http.bulk_inventory_jsonl = "".join(
+        json.dumps(line) + "\n" for p in products for line in payloads.inventory_bulk_lines(p)).encode("utf-8")
+    rows = [bootstrap(services, "bootstrap"), bootstrap(services, "bootstrap_again")]
+
+    # products/update: most carry no mirrored change (Shopify sends one per inventory tick)
+    updates = []
+    for _ in range(args.updates):
+        product = dict(rng.choice(products))
+        product["variants"] = [dict(v) for v in product["variants"]]
+        roll = rng.random()
+        if roll < args.price_ratio:
+            product["variants"][0]["price"] = "{:.2f}".format(rng.uniform(2, 180))
+        elif roll < args.price_ratio + args.title_ratio:
+            product["title"] = product["title"] + " (new)"
+        updates.append(product)
+    rows.append(replay(services, "products/update", "products/update", updates, args.delivery_delay_ms))
+
+    levels = []
+    for _ in range(args.inventory_updates):
+        variant = rng.choice(rng.choice(products)["variants"])
+        levels.append(payloads.make_inventory_level(variant["inventory_item_id"], rng.randint(0, 60), ""))
+    rows.append(replay(services, "inventory_levels/update", "inventory_levels/update", levels, args.delivery_delay_ms))
+    return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Shopify product mirror: bootstrap cost, write volume, sync lag")
+    parser.add_argument("--fixtures", action="store_true", help="replay the recorded fixtures instead")
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--inventory-updates", type=int, default=1000)
+    parser.add_argument("--price-ratio", type=float, default=0.2, help="share of updates that change a price")
+    parser.add_argument("--title-ratio", type=float, default=0.05, help="share of updates that change the title")
+    parser.add_argument("--delivery-delay-ms", type=float, default=0.0, help="simulated Shopify -> webhook delay")
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--firestore-latency-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    services = fakes.FakeServices(
+        genai_client=fakes.FakeGenaiClient(0.0, args.embed_latency_ms),
+        db=fakes.FakeFirestore(args.firestore_latency_ms, args.firestore_latency_ms, args.firestore_latency_ms),
+    )
+    with fakes.install(services):
+        from ai.scheduler import reset_scheduler
+        reset_scheduler()
+        rows = run_fixtures(services) if args.fixtures else run_synthetic(services, args)
+
+    print(format_table(rows, ["phase", "products", "events", "failed", "docs_written", "fields_written",
+                              "writes_per_event", "embedded", "lag_p50_ms", "lag_p95_ms", "elapsed_ms"]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
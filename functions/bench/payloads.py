@@ -0,0 +1,157 @@
+import base64
+import hashlib
+import hmac
+import json
+import random
+from typing import Any, Dict, List, Optional
+
+# Synthetic Shopify payloads for benchmarks and load tests.
+
+PRODUCT_WORDS = ["Wall Paint", "Primer", "Roller", "Brush", "Masking Tape", "Drop Cloth", "Sandpaper",
+                 "Varnish", "Wood Stain", "Spray Paint", "Paint Tray", "Filler", "Putty Knife", "Sealant"]
+COLOURS = ["White", "Ivory", "Red", "Navy", "Olive", "Grey", "Black", "Teal"]
+
+
+def sign(body: bytes, secret: str) -> str:
+    """Shopify-style base64 HMAC-SHA256 of the raw body."""
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("utf-8")
+
+
+def make_order(order_id: int, rng: random.Random, b2b_ratio: float = 0.2,
+               max_lines: int = 8, currencies: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Builds an orders/paid payload with a random number of lines."""
+    lines = []
+    for i in range(rng.randint(1, max_lines)):
+        lines.append({
+            "id": order_id * 100 + i,
+            "title": f"{rng.choice(COLOURS)} {rng.choice(PRODUCT_WORDS)}",
+            "price": "{:.2f}".format(rng.uniform(2, 180)),
+            "quantity": rng.randint(1, 4),
+            "sku": f"SKU-{rng.randint(1000, 9999)}",
+        })
+    order = {
+        "id": order_id,
+        "name": f"#B{order_id}",
+        "order_number": order_id,
+        "currency": rng.choice(currencies or ["EUR"]),
+        "taxes_included": False,
+        "billing_address": {
+            "first_name": "Bench",
+            "last_name": f"Customer{order_id}",
+            "address1": "Leoforos Kifisias 100",
+            "city": "Athens",
+            "zip": "11526",
+            "country_code": "GR",
+        },
+        "note_attributes": [],
+        "line_items": lines,
+    }
+    if rng.random() < b2b_ratio:
+        order["billing_address"]["company"] = f"Bench Trading {order_id} SA"
+        order["note_attributes"].append({"name": "VAT Number", "value": f"EL{rng.randint(10**8, 10**9 - 1)}"})
+    return order
+
+
+def make_product(i: int, rng: random.Random) -> Dict[str, Any]:
+    """Product shape returned by catalogue extraction / stored in the live mirror."""
+    title = f"{rng.choice(COLOURS)} {rng.choice(PRODUCT_WORDS)} {i}"
+    return {
+        "title": title,
+        "description": f"{title}. " + " ".join(rng.choice(PRODUCT_WORDS).lower() for _ in range(30)),
+        "price": round(rng.uniform(2, 180), 2),
+        "currency": "EUR",
+        "sku": f"SKU-{i:06d}",
+        "tags": rng.sample(["Paint", "Tools", "Interior", "Exterior", "Wood", "Metal", "Prep"], 3),
+        "options": [{"name": "Size", "values": ["750ml", "2.5L"]}],
+    }
+
+
+def encode(payload: Dict[str, Any]) -> bytes:
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+BENCH_LOCATION_ID = 70000000001
+
+
+def make_shopify_product(product_id: int, rng: random.Random, updated_at: str = "2024-05-01T10:00:00Z",
+                         max_variants: int = 3) -> Dict[str, Any]:
+    """A product as the REST Admin API sends it in products/create|update webhooks."""
+    word = rng.choice(PRODUCT_WORDS)
+    title = f"{rng.choice(COLOURS)} {word} {product_id}"
+    variants = []
+    for i in range(rng.randint(1, max_variants)):
+        variant_id = product_id * 10 + i
+        variants.append({
+            "id": variant_id,
+            "product_id": product_id,
+            "title": ["750ml", "2.5L", "5L"][i % 3],
+            "sku": f"SKU-{variant_id}",
+            "price": "{:.2f}".format(rng.uniform(2, 180)),
+            "inventory_item_id": 40000000000 + variant_id,
+            "inventory_quantity": rng.randint(0, 60),
+        })
+    return {
+        "id": product_id,
+        "title": title,
+        "body_html": f"<p><strong>{title}</strong> for interior and exterior jobs.</p>",
+        "vendor": "Bench Supplies",
+        "product_type": word,
+        "handle": title.lower().replace(" ", "-"),
+        "status": "active",
+        "tags": ", ".join(rng.sample(["Paint", "Tools", "Interior", "Exterior", "Wood", "Metal", "Prep"], 2)),
+        "updated_at": updated_at,
+        "variants": variants,
+    }
+
+
+def bulk_lines(product: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The same product as lines of the products bulk operation result."""
+    product_gid = f"gid://shopify/Product/{product['id']}"
+    lines: List[Dict[str, Any]] = [{
+        "id": product_gid,
+        "title": product["title"],
+        "handle": product["handle"],
+        "status": product["status"].upper(),
+        "productType": product["product_type"],
+        "vendor": product["vendor"],
+        "tags": [t.strip() for t in product["tags"].split(",")],
+        "description": f"{product['title']} for interior and exterior jobs.",
+        "updatedAt": product["updated_at"],
+    }]
+    for v in product["variants"]:
+        variant_gid = f"gid://shopify/ProductVariant/{v['id']}"
+        item_gid = f"gid://shopify/InventoryItem/{v['inventory_item_id']}"
+        lines.append({
+            "id": variant_gid,
+            "sku": v["sku"],
+            "price": v["price"],
+            "inventoryQuantity": v["inventory_quantity"],
+            "inventoryItem": {"id": item_gid},
+            "__parentId": product_gid,
+        })
+    return lines
+
+
+def inventory_bulk_lines(product: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The product's inventory items as lines of the inventoryItems bulk operation result (single location)."""
+    lines: List[Dict[str, Any]] = []
+    for v in product["variants"]:
+        item_gid = f"gid://shopify/InventoryItem/{v['inventory_item_id']}"
+        lines.append({"id": item_gid})
+        lines.append({
+            "id": f"gid://shopify/InventoryLevel/{v['inventory_item_id']}?inventory_item_id={v['inventory_item_id']}",
+            "location": {"id": f"gid://shopify/Location/{BENCH_LOCATION_ID}"},
+            "quantities": [{"name": "available", "quantity": v["inventory_quantity"]}],
+            "__parentId": item_gid,
+        })
+    return lines
+
+
+def make_inventory_level(inventory_item_id: int, available: int, updated_at: str) -> Dict[str, Any]:
+    """inventory_levels/update webhook payload."""
+    return {
+        "inventory_item_id": inventory_item_id,
+        "location_id": BENCH_LOCATION_ID,
+        "available": available,
+        "updated_at": updated_at,
+    }
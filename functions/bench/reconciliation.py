@@ -0,0 +1,118 @@
+"""
+Benchmark for the month-end AADE reconciliation (aade/reconciliation.py).
+
+Writes a paid-orders export and a matching invoice-ledger export, with a
+known number of missing, duplicate, mismatched and orphaned invoices
+injected, then reconciles them and checks that exactly those were found.
+Ledger totals come from webhooks.shopify.map_shopify_to_aade, as in
+production. Usage (from functions/):
+
+    python -m bench.reconciliation --orders 100000
+    python -m bench.reconciliation --orders 100000 --keep /tmp/recon
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from typing import Any, Dict
+
+from bench import payloads
+from bench.stats import format_table
+
+
+def ledger_entry(invoice, order: Dict[str, Any], status: str = "transmitted", mark: Any = None) -> Dict[str, Any]:
+    """Same fields InvoiceLedger.record writes."""
+    return {
+        "uid": invoice.uid,
+        "order_id": str(order["id"]),
+        "order_name": order.get("name"),
+        "source_topic": "orders/paid",
+        "invoice_type": invoice.invoice_type.value,
+        "series": invoice.series,
+        "aa": invoice.aa,
+        "issue_date": invoice.issue_date.isoformat() if invoice.issue_date else None,
+        "currency": invoice.currency,
+        "total_net_value": round(invoice.summary.total_net_value, 2),
+        "total_vat_amount": round(invoice.summary.total_vat_amount, 2),
+        "total_gross_value": round(invoice.summary.total_gross_value, 2),
+        "status": status,
+        "mark": mark,
+        "error": None if status == "transmitted" else "bench: AADE rejected the document",
+        "created_at": "2024-05-31T23:59:59+00:00",
+    }
+
+
+def write_exports(directory: str, args) -> Dict[str, int]:
+    """Writes orders.jsonl and invoices.jsonl; returns the injected fault counts."""
+    from webhooks.shopify import map_shopify_to_aade
+    rng = random.Random(args.seed)
+    injected = {"missing": 0, "duplicates": 0, "mismatched": 0, "orphaned": 0}
+    mark = 400000000000000
+    with open(os.path.join(directory, "orders.jsonl"), "w") as orders_f, \
+            open(os.path.join(directory, "invoices.jsonl"), "w") as invoices_f:
+        for i in range(args.orders):
+            order = payloads.make_order(args.first_order_id + i, rng, max_lines=args.max_lines)
+            order["financial_status"] = "paid"
+            orders_f.write(json.dumps(order) + "\n")
+            invoice = map_shopify_to_aade(order)
+            invoice.uid = f"{order['id']}-{i}"
+
+            roll = rng.random()
+            if roll < args.fault_ratio:
+                injected["missing"] += 1
+                if rng.random() < 0.5:   # a failed attempt is in the ledger
+                    invoices_f.write(json.dumps(ledger_entry(invoice, order, status="failed")) + "\n")
+                continue
+            mark += 1
+            entry = ledger_entry(invoice, order, mark=mark)
+            if roll < 2 * args.fault_ratio:
+                injected["mismatched"] += 1
+                entry["total_vat_amount"] = round(entry["total_vat_amount"] + rng.choice([-1, 1]) * 0.05, 2)
+            invoices_f.write(json.dumps(entry) + "\n")
+            if 2 * args.fault_ratio <= roll < 3 * args.fault_ratio:
+                injected["duplicates"] += 1
+                mark += 1
+                entry = dict(entry, uid=f"{entry['uid']}-retry", mark=mark)
+                invoices_f.write(json.dumps(entry) + "\n")
+
+        # Invoices for orders that are not in the paid export
+        for i in range(int(args.orders * args.fault_ratio)):
+            order = payloads.make_order(args.first_order_id + args.orders + i, rng, max_lines=1)
+            mark += 1
+            invoices_f.write(json.dumps(ledger_entry(map_shopify_to_aade(order), order, mark=mark)) + "\n")
+            injected["orphaned"] += 1
+    return injected
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="AADE reconciliation: throughput and detection accuracy")
+    parser.add_argument("--orders", type=int, default=100_000)
+    parser.add_argument("--max-lines", type=int, default=6)
+    parser.add_argument("--fault-ratio", type=float, default=0.002, help="share of orders per fault kind")
+    parser.add_argument("--first-order-id", type=int, default=5_000_000_000_000)
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--keep", help="write the exports to this directory instead of a temporary one")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    from aade.reconciliation import reconcile_files
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.keep or tmp
+        os.makedirs(directory, exist_ok=True)
+        injected = write_exports(directory, args)
+        report = reconcile_files(os.path.join(directory, "orders.jsonl"), os.path.join(directory, "invoices.jsonl"))
+
+    rows = [{"kind": kind, "injected": count, "found": report["summary"][kind]} for kind, count in injected.items()]
+    print(format_table(rows, ["kind", "injected", "found"]))
+    print(f"{report['orders']} orders, {report['invoices']} ledger entries: " +
+          ", ".join(f"{k}={v}" for k, v in report["timings"].items()), file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"injected": injected, "summary": report["summary"], "timings": report["timings"]}, f, indent=2)
+    return 0 if all(report["summary"][kind] == count for kind, count in injected.items()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+"""
+Offline benchmark for the Cloud Functions in main.py.
+
+Runs the real handlers against in-process fakes (Gemini, Firestore, Storage,
+Shopify and myDATA) under three load profiles and reports latency percentiles
+and throughput. Usage (from functions/):
+
+    python -m bench.run --profile all --json bench_output.json
+    python -m bench.run --profile order_burst --max-p95 order_burst=250
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from werkzeug.test import EnvironBuilder
+
+from bench import fakes, payloads
+from bench.stats import LoadResult, format_table, run_closed_loop
+
+PROFILES = ("order_burst", "chat_surge", "catalogue_upload", "shared_quota")
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def handler_of(fn):
+    """Strips the firebase_functions/CORS wrappers, keeping our own decorators (tracing etc.)."""
+    while hasattr(fn, "__wrapped__") and not fn.__code__.co_filename.startswith(FUNCTIONS_DIR):
+        fn = fn.__wrapped__
+    return fn
+
+
+def webhook_request(body: bytes, secret: str, topic: str = "orders/paid", webhook_id: str = ""):
+    from firebase_functions import https_fn
+    headers = {
+        "Content-Type": "application/json",
+        "X-Shopify-Hmac-Sha256": payloads.sign(body, secret),
+        "X-Shopify-Topic": topic,
+        "X-Shopify-Webhook-Id": webhook_id,
+    }
+    return https_fn.Request(EnvironBuilder(method="POST", data=body, headers=headers).get_environ())
+
+
+def callable_request(data: Dict[str, Any]):
+    from firebase_functions import https_fn
+    return https_fn.CallableRequest(data=data, raw_request=None)
+
+
+def stage_summary() -> Dict[str, Dict[str, Any]]:
+    """p50/p95 per traced stage, from the telemetry histograms."""
+    from telemetry import registry
+    stages = {}
+    for name, snap in registry.snapshot().items():
+        if snap["type"] == "histogram" and name.startswith("span."):
+            stages[name[5:]] = {"count": snap["count"], "p50_ms": snap["p50"], "p95_ms": snap["p95"]}
+    return stages
+
+
+def seed_products(db: fakes.FakeFirestore, collection: str, count: int, rng: random.Random):
+    for i in range(count):
+        product = payloads.make_product(i, rng)
+        product["embedding_field"] = fakes.fake_embedding(product["title"], as_array=True)
+        db.docs[f"{collection}/p{i}"] = product
+
+
+def order_burst(services: fakes.FakeServices, args) -> LoadResult:
+    import main
+    handler = handler_of(main.shopify_order_paid)
+    rng = random.Random(args.seed)
+    secret = fakes.BENCH_ENV["SHOPIFY_WEBHOOK_SECRET"]
+    bodies = [payloads.encode(payloads.make_order(10_000 + i, rng)) for i in range(args.orders)]
+    items = [(i, body) for i, body in enumerate(bodies)]
+
+    result = run_closed_loop(
+        "order_burst",
+        lambda item: handler(webhook_request(item[1], secret, webhook_id=f"bench-{item[0]}")).status_code,
+        items,
+        args.concurrency,
+        check=lambda status: None if status == 200 else f"HTTP {status}",
+    )
+    result.extra["aade_requests"] = services.http.requests.get("aade.send_invoices", 0)
+    return result
+
+
+def chat_surge(services: fakes.FakeServices, args) -> LoadResult:
+    import main
+    handler = handler_of(main.chat_assistant)
+    rng = random.Random(args.seed)
+    seed_products(services.db, "products_live", args.catalogue_size, rng)
+    questions = ["Which primer works on bare wood?", "I need a roller for ceilings",
+                 "Do you sell exterior varnish?", "What tape should I use for trim?"]
+    items = [{"message": rng.choice(questions), "sessionId": f"bench-session-{i % 50}"} for i in range(args.chats)]
+
+    from ai.config import AIConfig
+    from telemetry import registry
+    AIConfig.CHAT_SPECULATIVE_RETRIEVAL = not args.no_speculative
+    result = run_closed_loop("chat_surge", lambda data: handler(callable_request(data)), items, args.concurrency,
+                             check=lambda resp: None if resp.get("response") else "EmptyResponse")
+    result.extra["genai_calls"] = dict(services.genai.calls)
+    counts = {k: registry.counter(f"chat.prefetch.{k}").value for k in ("started", "hit", "miss", "unused")}
+    if counts["started"]:
+        result.extra["prefetch_hit_rate"] = round(counts["hit"] / counts["started"], 3)
+        result.extra["round_trips_saved"] = int(registry.counter("chat.round_trips_saved").value)
+    return result
+
+
+def catalogue_upload(services: fakes.FakeServices, args) -> LoadResult:
+    import main
+    from google.genai import types
+    handler = handler_of(main.process_catalogue_upload)
+    rng = random.Random(args.seed)
+    catalogue = json.dumps({"products": [payloads.make_product(i, rng) for i in range(args.products)]})
+
+    def responder(model, contents, config):
+        has_file = any(p.file_data for c in contents if isinstance(c, types.Content) for p in c.parts or [])
+        if has_file:
+            return fakes.text_response(catalogue)
+        return fakes.default_responder(model, contents, config)
+
+    services.genai.responder = responder
+    event = SimpleNamespace(data=SimpleNamespace(
+        bucket=services.bucket.name,
+        name="catalogues/bench-supplier/catalogue.pdf",
+        content_type="application/pdf",
+        md5_hash="YmVuY2gtY2F0YWxvZ3Vl",
+        crc32c="AAAAAA==",
+        size=len(catalogue),
+    ))
+
+    result = run_closed_loop("catalogue_upload", handler, [event] * args.catalogue_runs, 1)
+    drafts = services.db.count("product_drafts")
+    result.extra["drafts_written"] = drafts
+    result.extra["products_per_sec"] = round(drafts / result.wall_sec, 1) if result.wall_sec else None
+    return result
+
+
+def shared_quota(services: fakes.FakeServices, args) -> LoadResult:
+    """
+    chat_surge while a catalogue upload runs in the background, against a
+    Vertex quota of --genai-max-concurrent calls and --genai-tpm prompt
+    tokens per minute. The upload gets a scheduler of its own, as
+    process_catalogue_upload runs on other instances than chat_assistant in
+    production, so only the shared quota (ai/quota.py) arbitrates between
+    them; --no-shared-quota shows what happens without it.
+    """
+    import threading
+    from ai import catalogue
+    from ai.config import AIConfig
+    from ai.scheduler import GeminiScheduler, ScheduledClient, schedule
+    from telemetry import registry
+    if services.genai.max_concurrent is None:
+        services.genai.max_concurrent = 8
+    limits = AIConfig.MODEL_LIMITS
+    if args.genai_tpm:
+        services.genai.tokens_per_minute = args.genai_tpm
+        AIConfig.MODEL_LIMITS = {m: dict(limit, tokens_per_minute=args.genai_tpm) for m, limit in limits.items()}
+    upload_scheduler = GeminiScheduler()
+    catalogue.schedule = lambda client, priority: ScheduledClient(client, priority, upload_scheduler)
+    try:
+        upload = threading.Thread(target=catalogue_upload, args=(services, args), daemon=True)
+        upload.start()
+        time.sleep(0.2)  # let the upload reach its embedding phase
+        result = chat_surge(services, args)
+        result.name = "shared_quota"
+        upload.join()
+    finally:
+        catalogue.schedule = schedule
+        AIConfig.MODEL_LIMITS = limits
+
+    snapshot = registry.snapshot()
+    result.extra["vertex_errors"] = dict(services.genai.errors)
+    result.extra["drafts_written"] = services.db.count("product_drafts")
+    for priority in ("interactive", "batch"):
+        wait = snapshot.get(f"genai.wait_ms.{priority}", {})
+        result.extra[f"{priority}_wait_p95_ms"] = wait.get("p95")
+    return result
+
+
+def parse_budgets(values: List[str]) -> Dict[str, float]:
+    budgets = {}
+    for value in values or []:
+        name, _, ms = value.partition("=")
+        budgets[name] = float(ms)
+    return budgets
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark for functions/main.py handlers")
+    parser.add_argument("--profile", choices=PROFILES + ("all",), default="all")
+    parser.add_argument("--orders", type=int, default=500, help="order_burst: webhooks to send")
+    parser.add_argument("--chats", type=int, default=200, help="chat_surge: chat requests")
+    parser.add_argument("--catalogue-size", type=int, default=1000, help="chat_surge: products in the index")
+    parser.add_argument("--no-speculative", action="store_true",
+                        help="chat_surge: disable speculative retrieval (baseline)")
+    parser.add_argument("--products", type=int, default=5000, help="catalogue_upload: products in the file")
+    parser.add_argument("--catalogue-runs", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--genai-latency-ms", type=float, default=40.0)
+    parser.add_argument("--embed-latency-ms", type=float, default=2.0)
+    parser.add_argument("--firestore-latency-ms", type=float, default=1.0)
+    parser.add_argument("--http-latency-ms", type=float, default=20.0)
+    parser.add_argument("--write-error-rate", type=float, default=0.0,
+                        help="fraction of BulkWriter writes that fail and must be retried")
+    parser.add_argument("--genai-max-concurrent", type=int, default=None,
+                        help="simulated Vertex quota: concurrent calls beyond this get 429")
+    parser.add_argument("--genai-tpm", type=int, default=None,
+                        help="shared_quota: simulated Vertex prompt tokens per minute per model")
+    parser.add_argument("--no-shared-quota", action="store_true",
+                        help="schedule Gemini calls per instance only (baseline for shared_quota)")
+    parser.add_argument("--genai-failure-rate", type=float, default=0.0,
+                        help="fraction of Vertex calls failing with 503")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="write the summaries to this file")
+    parser.add_argument("--max-p95", action="append", metavar="PROFILE=MS",
+                        help="fail (exit 1) when a profile's p95 exceeds MS")
+    args = parser.parse_args(argv)
+
+    profiles = PROFILES if args.profile == "all" else (args.profile,)
+    from ai.config import AIConfig
+    AIConfig.SHARED_QUOTA_ENABLED = not args.no_shared_quota
+    summaries = []
+    for name in profiles:
+        services = fakes.FakeServices(
+            genai_client=fakes.FakeGenaiClient(args.genai_latency_ms, args.embed_latency_ms),
+            db=fakes.FakeFirestore(args.firestore_latency_ms, args.firestore_latency_ms, args.firestore_latency_ms),
+            http=fakes.MockHttpServices(args.http_latency_ms),
+        )
+        services.db.write_error_rate = args.write_error_rate
+        services.genai.max_concurrent = args.genai_max_concurrent
+        services.genai.failure_rate = args.genai_failure_rate
+        with fakes.install(services):
+            from telemetry import registry
+            from aade.runtime import shutdown_runtime
+            from ai.index_snapshot import reset_indexes
+            from ai.scheduler import reset_scheduler
+            registry.reset()
+            reset_scheduler()
+            reset_indexes()
+            result = globals()[name](services, args)
+            shutdown_runtime()  # its HTTP client is bound to this profile's fake transport
+            summary = result.summary()
+            summary["stages"] = stage_summary()
+            summary["firestore_ops"] = dict(services.db.stats)
+            summaries.append(summary)
+
+    print(format_table(summaries))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"generated_at": time.time(), "results": summaries}, f, indent=2)
+
+    failed = False
+    for name, limit in parse_budgets(args.max_p95).items():
+        for s in summaries:
+            if s["profile"] == name and s["p95_ms"] is not None and s["p95_ms"] > limit:
+                print(f"FAIL {name}: p95 {s['p95_ms']}ms > {limit}ms")
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import collections
+import concurrent.futures
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Linear-interpolated percentile of an already sorted list."""
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    pos = (len(values) - 1) * q / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+@dataclass
+class LoadResult:
+    """Latencies and error classes collected while driving one load profile."""
+    name: str
+    latencies_ms: List[float] = field(default_factory=list)
+    errors: collections.Counter = field(default_factory=collections.Counter)
+    wall_sec: float = 0.0
+    extra: Dict[str, Any] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, latency_ms: float, error: Optional[str] = None):
+        with self._lock:
+            self.latencies_ms.append(latency_ms)
+            if error:
+                self.errors[error] += 1
+
+    @property
+    def count(self) -> int:
+        return len(self.latencies_ms)
+
+    def summary(self) -> Dict[str, Any]:
+        ordered = sorted(self.latencies_ms)
+        ok = self.count - sum(self.errors.values())
+        return {
+            "profile": self.name,
+            "requests": self.count,
+            "ok": ok,
+            "errors": dict(self.errors),
+            "wall_sec": round(self.wall_sec, 3),
+            "throughput_rps": round(self.count / self.wall_sec, 2) if self.wall_sec else None,
+            "p50_ms": _round(percentile(ordered, 50)),
+            "p95_ms": _round(percentile(ordered, 95)),
+            "p99_ms": _round(percentile(ordered, 99)),
+            "max_ms": _round(ordered[-1] if ordered else None),
+            **self.extra,
+        }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 3) if value is not None else None
+
+
+def classify_error(exc: BaseException) -> str:
+    return type(exc).__name__
+
+
+def run_closed_loop(name: str, fn: Callable[[Any], Any], items: Iterable[Any], concurrency: int,
+                    check: Optional[Callable[[Any], Optional[str]]] = None) -> LoadResult:
+    """
+    Calls fn(item) for every item with `concurrency` workers, back to back.
+    `check` maps a return value to an error class (or None when it succeeded).
+    """
+    result = LoadResult(name)
+
+    def call(item):
+        start = time.perf_counter()
+        error = None
+        try:
+            value = fn(item)
+            if check is not None:
+                error = check(value)
+        except Exception as e:
+            error = classify_error(e)
+        result.record((time.perf_counter() - start) * 1000.0, error)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, items))
+    result.wall_sec = time.perf_counter() - start
+    return result
+
+
+def run_open_loop(name: str, fn: Callable[[Any], Any], items: List[Any], rate: float, workers: int,
+                  check: Optional[Callable[[Any], Optional[str]]] = None) -> LoadResult:
+    """
+    Starts fn(item) at a fixed arrival rate regardless of how fast earlier calls
+    finish. Latency is measured from the scheduled start, so time spent queued
+    behind saturated workers is counted (no coordinated omission).
+    """
+    result = LoadResult(name)
+    interval = 1.0 / rate
+    late = 0
+
+    def call(item, scheduled):
+        error = None
+        try:
+            value = fn(item)
+            if check is not None:
+                error = check(value)
+        except Exception as e:
+            error = classify_error(e)
+        result.record((time.perf_counter() - scheduled) * 1000.0, error)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for i, item in enumerate(items):
+            scheduled = start + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -interval:
+                late += 1
+            pool.submit(call, item, scheduled)
+    result.wall_sec = time.perf_counter() - start
+    result.extra["target_rps"] = rate
+    result.extra["late_dispatches"] = late
+    return result
+
+
+DEFAULT_COLUMNS = ["profile", "requests", "ok", "throughput_rps", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+
+
+def format_table(summaries: List[Dict[str, Any]], cols: Optional[List[str]] = None) -> str:
+    cols = cols or DEFAULT_COLUMNS
+    rows = [[str(s.get(c, "")) for c in cols] for s in summaries]
+    widths = [max(len(c), *(len(r[i]) for r in rows)) for i, c in enumerate(cols)] if rows else [len(c) for c in cols]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(cols, widths))]
+    lines += ["  ".join(v.ljust(w) for v, w in zip(r, widths)) for r in rows]
+    for s in summaries:
+        if s.get("errors"):
+            lines.append(f"  {s.get('profile')} errors: {s['errors']}")
+    return "\n".join(lines)
@@ -0,0 +1,149 @@
+"""
+Load generator for the shopify_order_paid webhook.
+
+Builds signed orders/paid payloads (varying line counts, B2B orders with VAT
+attributes, several currencies) and replays them at a fixed arrival rate,
+either against the local handler wired to in-process fakes or against a
+deployed URL. Usage (from functions/):
+
+    python -m bench.webhook_load --rate 200 --duration 10
+    python -m bench.webhook_load --url https://.../shopify_order_paid --rate 20 --duration 30
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import uuid
+from typing import Any, Dict, List, Tuple
+
+import httpx
+from werkzeug.test import EnvironBuilder
+
+from bench import fakes, payloads
+from bench.run import handler_of
+from bench.stats import format_table, run_open_loop
+
+
+def build_deliveries(args, secret: str) -> List[Tuple[bytes, Dict[str, str]]]:
+    """Pre-generates (body, headers) so payload construction is not timed."""
+    rng = random.Random(args.seed)
+    currencies = [c.strip() for c in args.currencies.split(",") if c.strip()]
+    deliveries = []
+    for i in range(int(args.rate * args.duration)):
+        order = payloads.make_order(args.first_order_id + i, rng, b2b_ratio=args.b2b_ratio,
+                                    max_lines=args.max_lines, currencies=currencies)
+        body = payloads.encode(order)
+        signature = payloads.sign(body, secret)
+        if rng.random() < args.bad_signature_ratio:
+            signature = payloads.sign(body, secret + "-wrong")
+        deliveries.append((body, {
+            "Content-Type": "application/json",
+            "X-Shopify-Hmac-Sha256": signature,
+            "X-Shopify-Topic": "orders/paid",
+            "X-Shopify-Shop-Domain": "bench-shop.myshopify.com",
+            "X-Shopify-Webhook-Id": str(uuid.UUID(int=rng.getrandbits(128))),
+        }))
+    return deliveries
+
+
+def _status_check(status: int):
+    return None if status == 200 else f"HTTP {status}"
+
+
+def run_remote(args, deliveries) -> Dict[str, Any]:
+    client = httpx.Client(timeout=args.timeout, limits=httpx.Limits(max_connections=args.workers))
+
+    def send(delivery):
+        body, headers = delivery
+        return client.post(args.url, content=body, headers=headers).status_code
+
+    try:
+        result = run_open_loop("webhook_remote", send, deliveries, args.rate, args.workers, check=_status_check)
+    finally:
+        client.close()
+    return result.summary()
+
+
+def run_local(args, deliveries) -> Dict[str, Any]:
+    services = fakes.FakeServices(
+        db=fakes.FakeFirestore(args.firestore_latency_ms, args.firestore_latency_ms, args.firestore_latency_ms),
+        http=fakes.MockHttpServices(args.aade_latency_ms, aade_error_rate=args.aade_error_rate),
+    )
+    with fakes.install(services):
+        import main
+        from firebase_functions import https_fn
+        from telemetry import InMemoryExporter, set_exporters
+        exporter = InMemoryExporter()
+        set_exporters([exporter])
+        handler = handler_of(main.shopify_order_paid)
+
+        def send(delivery):
+            body, headers = delivery
+            req = https_fn.Request(EnvironBuilder(method="POST", data=body, headers=headers).get_environ())
+            return handler(req).status_code
+
+        result = run_open_loop("webhook_local", send, deliveries, args.rate, args.workers, check=_status_check)
+
+    # Classify downstream failures from the recorded spans: AADE rejections
+    # answer 500 (so Shopify retries), others (ledger, basket) still answer 200.
+    downstream = collections.Counter()
+    for span in exporter.spans:
+        if span.status == "error":
+            downstream[f"{span.name}: {span.error.split(':')[0]}"] += 1
+        elif span.name == "webhook.transmit_aade" and not span.attributes.get("success", True):
+            downstream["aade_rejected"] += 1
+    summary = result.summary()
+    summary["downstream_errors"] = dict(downstream)
+    summary["aade_requests"] = services.http.requests.get("aade.send_invoices", 0)
+    stages = {}
+    for name in ("shopify_order_paid", "webhook.admission", "webhook.map_invoice", "webhook.transmit_aade"):
+        spans = sorted(s.duration_ms for s in exporter.find(name))
+        if spans:
+            stages[name] = {"count": len(spans), "p50_ms": round(spans[len(spans) // 2], 3),
+                            "p99_ms": round(spans[min(len(spans) - 1, int(len(spans) * 0.99))], 3)}
+    summary["stages"] = stages
+    return summary
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay signed orders/paid webhooks at a fixed rate")
+    parser.add_argument("--url", help="deployed function URL (default: local handler with fakes)")
+    parser.add_argument("--secret", default=os.environ.get("SHOPIFY_WEBHOOK_SECRET"),
+                        help="signing secret for --url runs (default: $SHOPIFY_WEBHOOK_SECRET)")
+    parser.add_argument("--rate", type=float, default=200.0, help="orders per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of traffic")
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--currencies", default="EUR,EUR,EUR,USD,GBP")
+    parser.add_argument("--b2b-ratio", type=float, default=0.2)
+    parser.add_argument("--max-lines", type=int, default=12)
+    parser.add_argument("--bad-signature-ratio", type=float, default=0.0)
+    parser.add_argument("--first-order-id", type=int, default=5_000_000)
+    parser.add_argument("--aade-latency-ms", type=float, default=80.0, help="local: mock myDATA latency")
+    parser.add_argument("--aade-error-rate", type=float, default=0.0, help="local: share of myDATA 500s")
+    parser.add_argument("--firestore-latency-ms", type=float, default=2.0, help="local: fake Firestore latency")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--json", help="write the summary to this file")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        if not args.secret:
+            parser.error("--secret (or SHOPIFY_WEBHOOK_SECRET) is required with --url")
+        summary = run_remote(args, build_deliveries(args, args.secret))
+    else:
+        summary = run_local(args, build_deliveries(args, fakes.BENCH_ENV["SHOPIFY_WEBHOOK_SECRET"]))
+
+    print(format_table([summary]))
+    for key in ("downstream_errors", "stages"):
+        if summary.get(key):
+            print(f"{key}: {json.dumps(summary[key])}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Benchmark for myDATA XSD pre-validation (aade/validation.py).
+
+Generates invoices from synthetic orders, then measures schema compilation
+(once per process), XML generation, validation of valid documents and
+rejection of documents with injected schema errors. Uses the stand-in
+schema in bench/fixtures/aade unless --xsd points at AADE's published
+InvoicesDoc XSD. Usage (from functions/):
+
+    python -m bench.xml_validation --invoices 5000
+    python -m bench.xml_validation --xsd /path/to/InvoicesDoc-v1.0.10.xsd
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+from bench import payloads
+from bench.stats import format_table, percentile
+
+FIXTURE_XSD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "aade", "InvoicesDoc-bench.xsd")
+
+# Faults a mapping bug could introduce
+FAULTS = {
+    "missing_aa": lambda xml: re.sub(r"<aa>[^<]*</aa>", "", xml, count=1),
+    "bad_invoice_type": lambda xml: xml.replace("<invoiceType>", "<invoiceType>9", 1),
+    "bad_date": lambda xml: xml.replace("<issueDate>", "<issueDate>31/", 1),
+    "three_decimals": lambda xml: re.sub(r"(<totalVatAmount>[0-9.]+)(</totalVatAmount>)", r"\g<1>1\g<2>", xml, count=1),
+    "negative_net": lambda xml: xml.replace("<netValue>", "<netValue>-", 1),
+    "undeclared_prefix": lambda xml: xml.replace(' xmlns:icls="https://www.aade.gr/myDATA/incomeClassificaton/v1.0"', "", 1),
+}
+
+
+def timed_us(fn: Callable[[], Any], samples: List[float]) -> Any:
+    started = time.perf_counter()
+    result = fn()
+    samples.append((time.perf_counter() - started) * 1e6)
+    return result
+
+
+def summarise(name: str, samples: List[float], **extra) -> Dict[str, Any]:
+    ordered = sorted(samples)
+    return dict({
+        "stage": name,
+        "count": len(ordered),
+        "p50_us": round(percentile(ordered, 50), 1) if ordered else None,
+        "p95_us": round(percentile(ordered, 95), 1) if ordered else None,
+        "max_us": round(ordered[-1], 1) if ordered else None,
+    }, **extra)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="myDATA XSD pre-validation cost per invoice")
+    parser.add_argument("--invoices", type=int, default=5000)
+    parser.add_argument("--max-lines", type=int, default=8)
+    parser.add_argument("--xsd", default=FIXTURE_XSD, help="InvoicesDoc schema to validate against")
+    parser.add_argument("--seed", type=int, default=3)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    from aade.invoice_generator import InvoiceGenerator
+    from aade.validation import InvoiceSchemaValidator
+    from webhooks.shopify import map_shopify_to_aade
+
+    compile_us: List[float] = []
+    validator = timed_us(lambda: InvoiceSchemaValidator(args.xsd), compile_us)
+
+    rng = random.Random(args.seed)
+    invoices = []
+    for i in range(args.invoices):
+        invoice = map_shopify_to_aade(payloads.make_order(7_000_000 + i, rng, max_lines=args.max_lines))
+        invoice.series, invoice.aa = "A", str(i + 1)
+        invoices.append(invoice)
+
+    generate_us: List[float] = []
+    documents = [timed_us(lambda: InvoiceGenerator.generate_xml(inv), generate_us) for inv in invoices]
+
+    validate_us: List[float] = []
+    invalid = sum(1 for doc in documents if timed_us(lambda: validator.validate(doc), validate_us))
+
+    rows = [
+        summarise("compile_schema", compile_us),
+        summarise("generate_xml", generate_us),
+        summarise("validate_valid", validate_us, rejected=invalid),
+    ]
+    examples = {}
+    for name, fault in FAULTS.items():
+        reject_us: List[float] = []
+        rejected = 0
+        for doc in documents[:max(1, len(documents) // 10)]:
+            broken = fault(doc)
+            errors = timed_us(lambda: validator.validate(broken), reject_us)
+            rejected += bool(errors)
+            examples.setdefault(name, errors[:1])
+        rows.append(summarise(f"reject_{name}", reject_us, rejected=rejected))
+
+    print(format_table(rows, ["stage", "count", "rejected", "p50_us", "p95_us", "max_us"]))
+    for name, errors in examples.items():
+        print(f"{name}: {errors[0] if errors else '(accepted)'}", file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"rows": rows, "examples": examples}, f, indent=2)
+    return 0 if invalid == 0 and all(r.get("rejected") == r["count"] for r in rows[3:]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
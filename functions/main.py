@@ -2,6 +2,7 @@ from firebase_functions import https_fn, options
 from firebase_admin import initialize_app
 import os
 import json
+from telemetry import span, traced
 
 # Initialize app first
 try:
@@ -19,6 +20,8 @@ except ImportError:
 try:
     from ai.catalogue import process_catalogue_upload
     from ai.agent import suggest_bundles
+    from ai.bundle_graph import rebuild_bundle_graph
+    from ai.index_snapshot import rebuild_product_index, index_live_product_change
     AI_AVAILABLE = True
 except ImportError as e:
     AI_AVAILABLE = False
@@ -30,6 +33,19 @@ try:
 except ImportError:
     CHAT_AVAILABLE = False
 
+# Webhooks (topic handlers are imported lazily by the router)
+from webhooks.admission import admit_shopify_webhook
+from webhooks.router import router as webhook_router
+
+# Shopify -> products_live mirror (webhook topics are registered in the router)
+from shopify.mirror import bootstrap_product_mirror
+
+# Bulk publishing of approved catalogue drafts (and resumption of unfinished jobs)
+from shopify.bulk_publish import bulk_publish_drafts, resume_publish_jobs
+
+# AADE invoice numbering (nightly audit of number leases abandoned by dead instances)
+from aade.numbering import audit_invoice_number_gaps
+
 # Payment Modules (REMOVED)
 # User opted for Shopify Native Checkout + AADE Webhook
 
@@ -38,6 +54,7 @@ except ImportError:
     region="europe-west1",
     memory=options.MemoryOption.MB_256,
 )
+@traced("health_check", quiet=True)
 def health_check(req: https_fn.CallableRequest) -> dict:
     return {
         "status": "ok",
@@ -46,49 +63,53 @@ def health_check(req: https_fn.CallableRequest) -> dict:
         "features": {
             "ai": AI_AVAILABLE,
             "payments": False # Disabled
-        }
+        },
+        # Webhook and coalescing counters live on the instances that do the work;
+        # they are exported as webhook.<topic>.* and singleflight.<name>.* in the
+        # periodic metrics log entries
+        "webhook_topics": webhook_router.topics,
     }
 
+def _handle_shopify_webhook(req: https_fn.Request) -> https_fn.Response:
+    # 1. Admission: HMAC over the raw body, redelivery dedup, JSON parse
+    with span("webhook.admission") as s:
+        admission = admit_shopify_webhook(req)
+        s.set(reason=admission.reason, admission_us=round(admission.elapsed_us, 1))
+    if not admission.accepted:
+        return https_fn.Response(admission.reason, status=admission.status)
+    if not admission.topic:
+        admission.release()
+        return https_fn.Response("Missing X-Shopify-Topic header", status=400)
+    
+    # 2. Route on topic
+    try:
+        handled = webhook_router.dispatch(admission.topic, admission.payload)
+    except Exception as e:
+        # Let Shopify's retry through the dedup check
+        admission.release()
+        print(f"Error in Shopify webhook ({admission.topic}): {e}")
+        return https_fn.Response("Internal Error", status=500)
+
+    admission.complete()
+    if not handled:
+        return https_fn.Response(f"Ignored topic {admission.topic}", status=200)
+    return https_fn.Response("OK", status=200)
+
 @https_fn.on_request(region="europe-west1")
+@traced("shopify_webhook")
+def shopify_webhook(req: https_fn.Request) -> https_fn.Response:
+    """
+    Webhook for all subscribed Shopify topics (orders/create, orders/paid,
+    orders/cancelled, refunds/create). Routed on X-Shopify-Topic.
+    """
+    return _handle_shopify_webhook(req)
+
+@https_fn.on_request(region="europe-west1")
+@traced("shopify_order_paid")
 def shopify_order_paid(req: https_fn.Request) -> https_fn.Response:
     """
     Webhook for Shopify 'orders/paid' event.
-    Triggers AADE invoice transmission.
+    Triggers AADE invoice transmission. Kept for the existing subscription;
+    goes through the same admission and router as shopify_webhook.
     """
-    # 1. Verify HMAC (Security)
-    # We should verify X-Shopify-Hmac-Sha256 header using SHOPIFY_WEBHOOK_SECRET
-    # For MVP/Dev, we'll skip strict verification but print a warning if secret missing.
-    
-    import hmac
-    import hashlib
-    import base64
-    
-    secret = os.environ.get('SHOPIFY_WEBHOOK_SECRET')
-    if not secret:
-        print("Warning: SHOPIFY_WEBHOOK_SECRET not set. Skipping verification.")
-    else:
-        hmac_header = req.headers.get('X-Shopify-Hmac-Sha256')
-        if not hmac_header:
-            return https_fn.Response("Missing HMAC header", status=401)
-            
-        digest = hmac.new(
-            secret.encode('utf-8'),
-            req.get_data(),
-            hashlib.sha256
-        ).digest()
-        computed_hmac = base64.b64encode(digest).decode('utf-8')
-        
-        if not hmac.compare_digest(computed_hmac, hmac_header):
-            return https_fn.Response("Invalid HMAC signature", status=401)
-    
-    try:
-        from webhooks.shopify import handle_order_paid
-        data = req.get_json()
-        
-        # Run logic (sync for now, or use background task if supported)
-        handle_order_paid(data)
-        
-        return https_fn.Response("OK", status=200)
-    except Exception as e:
-        print(f"Error in shopify_order_paid: {e}")
-        return https_fn.Response("Internal Error", status=500)
+    return _handle_shopify_webhook(req)
@@ -0,0 +1,469 @@
+import datetime
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional
+
+from firebase_admin import firestore
+from firebase_functions import https_fn, options, scheduler_fn
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from telemetry import registry, span, traced
+from .client import BulkOperationFailed, ShopifyClient
+from .mirror import MIRROR_COLLECTION, ProductMirror, _price, numeric_id, parse_time, product_document
+
+# Bulk Draft Publishing
+# Approved product_drafts are published to Shopify as bulk mutations
+# instead of one REST call per draft:
+#   1. create: approved drafts are claimed by a job ('publish_jobs/{id}')
+#      and split into chunks ('.../chunks/{n}') that fit one staged upload
+#   2. per chunk: the productCreate variables are written as JSONL, staged,
+#      run as one bulkOperationRunMutation and polled to completion
+#   3. the result JSONL is streamed back; each line (matched to its draft by
+#      __lineNumber) updates the draft and writes the products_live document
+#      in batches of WRITE_BATCH_SIZE, with the draft's embedding (the
+#      products/create webhooks that arrive first leave embedding to it)
+# Every step is recorded on the chunk before the next one starts, and the
+# chunk's applied_lines cursor is committed in the same batch as the writes
+# it covers, so a job interrupted anywhere (function timeout, crash) resumes
+# where it stopped without creating a product twice. Shopify runs one bulk
+# mutation per shop at a time, so chunks run in order and only one runner
+# holds a job (lease on the job document). resume_publish_jobs picks up
+# jobs still running after their callable returned.
+
+logger = logging.getLogger(__name__)
+
+DRAFTS_COLLECTION = "product_drafts"
+JOBS_COLLECTION = "publish_jobs"
+WRITE_BATCH_SIZE = 400
+# Staged uploads for bulk mutations are limited to 20 MB
+MAX_CHUNK_BYTES = 16 * 1024 * 1024
+# Keeps a chunk's draft_ids list well inside the 1 MB document limit
+MAX_CHUNK_DRAFTS = 10000
+JOB_LEASE_SEC = 600
+# Leaves the callable time to record progress before its 540s timeout
+RUN_BUDGET_SEC = float(os.environ.get("BULK_PUBLISH_RUN_BUDGET_SEC", "480"))
+POLL_SEC = 3.0
+
+# Same product the single-draft publish action creates (vendor, type, one variant)
+DRAFT_VENDOR = "AI Catalogue"
+DRAFT_PRODUCT_TYPE = "Generated"
+
+# ProductInput.variants is accepted up to API version 2024-04 (ShopifyClient uses 2024-01)
+PRODUCT_CREATE_MUTATION = """
+mutation call($input: ProductInput!) {
+  productCreate(input: $input) {
+    product {
+      id title handle status productType vendor tags description updatedAt
+      variants(first: 50) {
+        edges { node { id sku price inventoryQuantity inventoryItem { id } } }
+      }
+    }
+    userErrors { field message }
+  }
+}
+"""
+
+APPROVABLE = ("pending_review", "publish_failed")
+
+
+def product_input(draft: Dict[str, Any]) -> Dict[str, Any]:
+    """productCreate variables for one draft."""
+    price = _price(draft.get("price"))
+    variant = {"price": f"{price:.2f}" if price is not None else "0.00"}
+    if draft.get("sku"):
+        variant["sku"] = draft["sku"]
+    return {"input": {
+        "title": draft.get("title") or "",
+        "descriptionHtml": draft.get("description") or "",
+        "vendor": DRAFT_VENDOR,
+        "productType": DRAFT_PRODUCT_TYPE,
+        "tags": draft.get("tags") or [],
+        "status": "ACTIVE",
+        "variants": [variant],
+    }}
+
+
+def mirror_document(product: Dict[str, Any]) -> Dict[str, Any]:
+    """productCreate result -> mirror-owned products_live fields."""
+    variants = []
+    for edge in (product.get("variants") or {}).get("edges") or []:
+        node = edge["node"]
+        item = node.get("inventoryItem") or {}
+        variants.append({
+            "id": numeric_id(node["id"]),
+            "sku": node.get("sku") or None,
+            "price": _price(node.get("price")),
+            "inventory_item_id": int(numeric_id(item["id"])) if item.get("id") else None,
+            "inventory": node.get("inventoryQuantity"),
+        })
+    return product_document(
+        numeric_id(product["id"]), product.get("title"), product.get("description") or "",
+        product.get("handle"), product.get("status"), product.get("productType"), product.get("vendor"),
+        product.get("tags") or [], variants, product.get("updatedAt"),
+    )
+
+
+def is_being_published(db, product: Dict[str, Any]) -> bool:
+    """
+    Whether a products/create webhook is for a draft a publish job has not
+    applied yet. _apply_results writes its products_live document with the
+    draft's embedding, so the webhook need not embed it (at interactive
+    priority) first.
+    """
+    if product.get("vendor") != DRAFT_VENDOR or not product.get("title"):
+        return False
+    drafts = (db.collection(DRAFTS_COLLECTION)
+              .where(filter=FieldFilter("status", "==", "publishing"))
+              .where(filter=FieldFilter("title", "==", product["title"]))
+              .limit(1).get())
+    return bool(drafts)
+
+
+def _claim(transaction, job_ref, owner: str, now: float) -> Optional[Dict[str, Any]]:
+    snapshot = job_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    job = snapshot.to_dict()
+    if job.get("lease_owner") not in (None, owner) and (job.get("lease_until") or 0) > now:
+        return None
+    transaction.update(job_ref, {"lease_owner": owner, "lease_until": now + JOB_LEASE_SEC})
+    return job
+
+
+class BulkPublisher:
+    """Creates and runs bulk publish jobs; one instance per request."""
+
+    def __init__(self, db, client: Optional[ShopifyClient] = None, owner: Optional[str] = None):
+        self.db = db
+        self.client = client or ShopifyClient()
+        self.owner = owner or f"{os.environ.get('K_REVISION', 'local')}-{uuid.uuid4().hex[:8]}"
+        self.mirror = ProductMirror(db, self.client)
+
+    def _job_ref(self, job_id: str):
+        return self.db.collection(JOBS_COLLECTION).document(job_id)
+
+    def _drafts(self):
+        return self.db.collection(DRAFTS_COLLECTION)
+
+    def _commit_in_batches(self, writes: Iterable):
+        """writes: (ref, data) pairs, merged."""
+        batch, pending = self.db.batch(), 0
+        for ref, data in writes:
+            batch.set(ref, data, merge=True)
+            pending += 1
+            if pending >= WRITE_BATCH_SIZE:
+                batch.commit()
+                batch, pending = self.db.batch(), 0
+        if pending:
+            batch.commit()
+
+    # --- Approval ---
+
+    def approve(self, draft_ids: List[str]) -> int:
+        """Marks the given drafts approved (those awaiting review or that failed to publish)."""
+        refs = [self._drafts().document(draft_id) for draft_id in dict.fromkeys(draft_ids)]
+        approvable = [
+            doc.reference for doc in self.db.get_all(refs, field_paths=["status"])
+            if doc.exists and doc.get("status") in APPROVABLE
+        ]
+        self._commit_in_batches((ref, {"status": "approved", "approved_at": firestore.SERVER_TIMESTAMP,
+                                       "publish_error": None}) for ref in approvable)
+        return len(approvable)
+
+    # --- Jobs ---
+
+    def active_job(self) -> Optional[str]:
+        jobs = self.db.collection(JOBS_COLLECTION).where(filter=FieldFilter("state", "==", "running")).limit(1).get()
+        return jobs[0].id if jobs else None
+
+    def create_job(self, limit: Optional[int] = None, created_by: Optional[str] = None) -> Optional[str]:
+        """Claims approved drafts for a new job; None when nothing is approved."""
+        query = self._drafts().where(filter=FieldFilter("status", "==", "approved")) \
+            .select(["title", "description", "price", "sku", "tags"])
+        if limit:
+            query = query.limit(limit)
+
+        job_id = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S") + f"-{uuid.uuid4().hex[:6]}"
+        job_ref = self._job_ref(job_id)
+        chunks: List[List[str]] = [[]]
+        size = 0
+        claims = []
+        for doc in query.stream():
+            line_bytes = len(json.dumps(product_input(doc.to_dict()))) + 1
+            if chunks[-1] and (size + line_bytes > MAX_CHUNK_BYTES or len(chunks[-1]) >= MAX_CHUNK_DRAFTS):
+                chunks.append([])
+                size = 0
+            chunks[-1].append(doc.id)
+            size += line_bytes
+            claims.append((doc.reference, {"status": "publishing", "publish_job": job_id,
+                                           "publish_chunk": len(chunks) - 1}))
+        if not claims:
+            return None
+
+        job_ref.set({
+            "state": "running",
+            "total": len(claims),
+            "chunks": len(chunks),
+            "chunks_done": 0,
+            "published": 0,
+            "failed": 0,
+            "created_by": created_by,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        })
+        self._commit_in_batches(
+            [(job_ref.collection("chunks").document(f"{n:04d}"),
+              {"index": n, "state": "pending", "draft_ids": ids, "applied_lines": 0, "published": 0, "failed": 0})
+             for n, ids in enumerate(chunks)] + claims
+        )
+        registry.counter("bulk_publish.drafts_claimed").inc(len(claims))
+        logger.info(f"Publish job {job_id}: {len(claims)} drafts in {len(chunks)} chunks")
+        return job_id
+
+    def run(self, job_id: str, budget_sec: float = RUN_BUDGET_SEC) -> Dict[str, Any]:
+        """Advances the job as far as the budget allows. Returns its progress."""
+        job_ref = self._job_ref(job_id)
+        job = firestore.transactional(_claim)(self.db.transaction(), job_ref, self.owner, time.time())
+        if job is None:
+            return {"jobId": job_id, "error": "Job not found or being run by another instance"}
+        deadline = time.time() + budget_sec
+        try:
+            with span("bulk_publish.run", job=job_id) as s:
+                chunks = [doc for doc in job_ref.collection("chunks").order_by("index").stream()]
+                totals = {doc.id: doc.to_dict() for doc in chunks}
+                for doc in chunks:
+                    chunk = totals[doc.id]
+                    if chunk["state"] == "applied":
+                        continue
+                    if not self._run_chunk(job_ref, doc.reference, chunk, totals, deadline):
+                        break
+                progress = self._progress(totals)
+                if progress["chunks_done"] == len(chunks):
+                    progress["state"] = "completed"
+                    progress["completed_at"] = firestore.SERVER_TIMESTAMP
+                job_ref.set(dict(progress, lease_owner=None, lease_until=None), merge=True)
+                s.set(**{k: v for k, v in progress.items() if isinstance(v, (int, str))})
+        except Exception:
+            job_ref.set({"lease_owner": None, "lease_until": None}, merge=True)
+            raise
+        progress.pop("completed_at", None)
+        return dict(progress, jobId=job_id, state=progress.get("state", "running"))
+
+    @staticmethod
+    def _progress(totals: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        return {
+            "chunks_done": sum(1 for c in totals.values() if c["state"] == "applied"),
+            "published": sum(c.get("published", 0) for c in totals.values()),
+            "failed": sum(c.get("failed", 0) for c in totals.values()),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }
+
+    def _advance(self, chunk_ref, chunk: Dict[str, Any], **fields):
+        chunk.update(fields)
+        chunk_ref.set(fields, merge=True)
+
+    def _run_chunk(self, job_ref, chunk_ref, chunk: Dict[str, Any], totals, deadline: float) -> bool:
+        """Takes the chunk as far as it goes; False when the job has to stop for now."""
+        index = chunk["index"]
+        if chunk["state"] == "pending":
+            with span("bulk_publish.upload", chunk=index) as s:
+                drafts = {doc.id: doc.to_dict() for doc in self._drafts()
+                          .where(filter=FieldFilter("publish_job", "==", job_ref.id))
+                          .where(filter=FieldFilter("publish_chunk", "==", index))
+                          .select(["title", "description", "price", "sku", "tags", "status"]).stream()}
+                # Drafts deleted or re-reviewed since the job was created are left out
+                draft_ids = [d for d in chunk["draft_ids"] if drafts.get(d, {}).get("status") == "publishing"]
+                content = "".join(json.dumps(product_input(drafts[d])) + "\n" for d in draft_ids).encode("utf-8")
+                s.set(lines=len(draft_ids), bytes=len(content))
+                if not draft_ids:
+                    self._advance(chunk_ref, chunk, state="applied", draft_ids=[])
+                    return True
+                staged_path = self.client.staged_upload(f"publish-{job_ref.id}-{index:04d}.jsonl", content)
+            self._advance(chunk_ref, chunk, state="uploaded", draft_ids=draft_ids, staged_path=staged_path,
+                          uploaded_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
+
+        if chunk["state"] == "uploaded":
+            operation = self.client.current_bulk_operation("MUTATION") or {}
+            created_at = parse_time(operation.get("createdAt"))
+            if created_at and created_at >= parse_time(chunk["uploaded_at"]):
+                # Started before an interruption; the staged file is ours alone
+                operation_id = operation["id"]
+            else:
+                operation_id = self.client.run_bulk_mutation(PRODUCT_CREATE_MUTATION, chunk["staged_path"])
+            self._advance(chunk_ref, chunk, state="running", operation_id=operation_id)
+            logger.info(f"Publish job {job_ref.id} chunk {index}: bulk mutation {operation_id} started "
+                        f"({len(chunk['draft_ids'])} drafts)")
+
+        if chunk["state"] == "running":
+            def on_progress(operation: Dict[str, Any]):
+                count = int(operation.get("objectCount") or 0)
+                if count != chunk.get("object_count"):
+                    chunk["object_count"] = count
+                    job_ref.set({"current_chunk": index, "object_count": count,
+                                 "updated_at": firestore.SERVER_TIMESTAMP}, merge=True)
+
+            error = None
+            try:
+                with span("bulk_publish.wait", chunk=index):
+                    operation = self.client.wait_for_bulk_operation(
+                        chunk["operation_id"], poll_sec=POLL_SEC, timeout_sec=max(0.0, deadline - time.time()),
+                        kind="MUTATION", on_progress=on_progress)
+                url = operation.get("url")
+            except TimeoutError:
+                logger.info(f"Publish job {job_ref.id} chunk {index} still running; will resume")
+                return False
+            except BulkOperationFailed as e:
+                # Lines Shopify got through before failing are in the partial file
+                error = f"Bulk operation {e.operation.get('status')}: {e.operation.get('errorCode')}"
+                url = e.operation.get("partialDataUrl")
+                registry.counter("bulk_publish.operations_failed").inc()
+                logger.error(f"Publish job {job_ref.id} chunk {index}: {error}")
+            self._advance(chunk_ref, chunk, state="completed", result_url=url, operation_error=error)
+
+        if chunk["state"] == "completed":
+            if chunk.get("result_url") and time.time() > deadline:
+                return False
+            self._apply_results(job_ref, chunk_ref, chunk, totals)
+            self._advance(chunk_ref, chunk, state="applied")
+            logger.info(f"Publish job {job_ref.id} chunk {index}: {chunk.get('published', 0)} published, "
+                        f"{chunk.get('failed', 0)} failed")
+        return True
+
+    def _apply_results(self, job_ref, chunk_ref, chunk: Dict[str, Any], totals):
+        """Streams the result file into draft and products_live writes, resuming at applied_lines."""
+        draft_ids = chunk["draft_ids"]
+        drafts = self._drafts()
+        embeddings = {doc.id: doc.get("embedding_field") for doc in drafts
+                      .where(filter=FieldFilter("publish_job", "==", job_ref.id))
+                      .where(filter=FieldFilter("publish_chunk", "==", chunk["index"]))
+                      .select(["embedding_field"]).stream()}
+        lines = self.client.iter_bulk_results(chunk["result_url"]) if chunk.get("result_url") else []
+        seen = set()
+        batch, pending = self.db.batch(), 0
+
+        def commit(applied_lines: int):
+            nonlocal batch, pending
+            cursor = {"applied_lines": applied_lines, "published": chunk["published"], "failed": chunk["failed"]}
+            chunk.update(cursor)
+            batch.set(chunk_ref, cursor, merge=True)
+            batch.set(job_ref, self._progress(totals), merge=True)
+            batch.commit()
+            batch, pending = self.db.batch(), 0
+
+        with span("bulk_publish.apply", chunk=chunk["index"]) as s:
+            n = 0
+            for n, line in enumerate(lines, 1):
+                line_number = line.get("__lineNumber")
+                if not isinstance(line_number, int) or not 0 <= line_number < len(draft_ids):
+                    registry.counter("bulk_publish.orphan_lines").inc()
+                    continue
+                seen.add(line_number)
+                if n <= chunk["applied_lines"]:
+                    continue
+                draft_id = draft_ids[line_number]
+                result = (line.get("data") or {}).get("productCreate") or {}
+                product = result.get("product")
+                if product:
+                    incoming = mirror_document(product)
+                    batch.set(drafts.document(draft_id), {
+                        "status": "published",
+                        "shopifyId": incoming["shopifyId"],
+                        "handle": incoming["handle"],
+                        "published_at": firestore.SERVER_TIMESTAMP,
+                        "publish_error": None,
+                    }, merge=True)
+                    changes = self.mirror._changes(None, incoming)
+                    changes["source_draft"] = draft_id
+                    if embeddings.get(draft_id) is not None:
+                        # Same text the draft was embedded from (title, description, tags)
+                        changes["embedding_field"] = embeddings[draft_id]
+                        changes["embedding_reindex_needed"] = False
+                    batch.set(self.db.collection(MIRROR_COLLECTION).document(incoming["shopifyId"]),
+                              changes, merge=True)
+                    pending += 2
+                    chunk["published"] += 1
+                    registry.counter("bulk_publish.published").inc()
+                else:
+                    errors = result.get("userErrors") or line.get("errors") or [{"message": "No product returned"}]
+                    batch.set(drafts.document(draft_id), {
+                        "status": "publish_failed",
+                        "publish_error": "; ".join(str(e.get("message", e)) for e in errors),
+                    }, merge=True)
+                    pending += 1
+                    chunk["failed"] += 1
+                    registry.counter("bulk_publish.failed").inc()
+                if pending >= WRITE_BATCH_SIZE:
+                    commit(n)
+            # Drafts Shopify never reported on (operation failed part way)
+            for line_number, draft_id in enumerate(draft_ids):
+                if line_number not in seen:
+                    batch.set(drafts.document(draft_id), {
+                        "status": "publish_failed",
+                        "publish_error": chunk.get("operation_error") or "No result from Shopify",
+                    }, merge=True)
+                    pending += 1
+                    chunk["failed"] += 1
+                    seen.add(line_number)
+                    if pending >= WRITE_BATCH_SIZE:
+                        commit(n)
+            commit(n)
+            s.set(published=chunk["published"], failed=chunk["failed"])
+
+
+# --- Admin callable and resumer ---
+
+@https_fn.on_call(
+    region="europe-west1",
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=540,
+)
+@traced("bulk_publish_drafts")
+def bulk_publish_drafts(req: https_fn.CallableRequest) -> dict:
+    """
+    Publishes approved drafts to Shopify. Admins only.
+    data: draftIds (approve these first), jobId (resume), limit.
+    """
+    if req.auth is None:
+        return {"error": "Sign in required"}
+    db = firestore.client()
+    profile = db.collection("users").document(req.auth.uid).get()
+    if not profile.exists or profile.get("role") != "admin":
+        return {"error": "Admin role required"}
+
+    client = ShopifyClient()
+    if not client.configured:
+        return {"error": "Shopify credentials are not configured"}
+    data = req.data or {}
+    publisher = BulkPublisher(db, client)
+    approved = publisher.approve(data["draftIds"]) if data.get("draftIds") else 0
+
+    # One bulk mutation runs per shop at a time, so an unfinished job goes first
+    job_id = data.get("jobId") or publisher.active_job() or publisher.create_job(data.get("limit"), req.auth.uid)
+    if job_id is None:
+        return {"approved": approved, "error": "No approved drafts to publish"}
+    report = publisher.run(job_id)
+    print(f"Bulk publish {job_id}: {report}")
+    return dict(report, approved=approved)
+
+
+@scheduler_fn.on_schedule(
+    schedule="every 10 minutes",
+    timezone=scheduler_fn.Timezone("Europe/Athens"),
+    region="europe-west1",
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=540,
+)
+@traced("resume_publish_jobs")
+def resume_publish_jobs(event: scheduler_fn.ScheduledEvent) -> None:
+    """Continues publish jobs whose callable ran out of time."""
+    db = firestore.client()
+    client = ShopifyClient()
+    if not client.configured:
+        return
+    publisher = BulkPublisher(db, client)
+    job_id = publisher.active_job()
+    if job_id:
+        print(f"Resumed publish job {job_id}: {publisher.run(job_id)}")
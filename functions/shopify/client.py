@@ -1,12 +1,23 @@
 import os
+import json
+import time
 import httpx
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator, Callable
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class BulkOperationFailed(RuntimeError):
+    """A bulk operation that ended in anything but COMPLETED; `operation` is its final state."""
+
+    def __init__(self, operation: Dict[str, Any]):
+        self.operation = operation
+        super().__init__(f"Bulk operation {operation.get('id')} ended {operation.get('status')}: "
+                         f"{operation.get('errorCode')}")
+
+
 class ShopifyClient:
     """Client for interacting with Shopify Admin API."""
     
@@ -21,19 +32,137 @@ class ShopifyClient:
 
         self.base_url = f"https://{self.domain}/admin/api/{self.API_VERSION}"
 
+    @property
+    def configured(self) -> bool:
+        return bool(self.domain and self.token)
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "X-Shopify-Access-Token": self.token,
+            "Content-Type": "application/json"
+        }
+
+    # --- GraphQL Admin API ---
+
+    def graphql(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Runs a GraphQL Admin query and returns its 'data'. Raises on transport or GraphQL errors."""
+        with httpx.Client(timeout=30.0) as client:
+            response = client.post(
+                f"{self.base_url}/graphql.json",
+                headers=self._headers(),
+                json={"query": query, "variables": variables or {}}
+            )
+            response.raise_for_status()
+            body = response.json()
+        if body.get("errors"):
+            raise RuntimeError(f"Shopify GraphQL error: {body['errors']}")
+        return body.get("data") or {}
+
+    def run_bulk_query(self, query: str) -> str:
+        """Starts a bulk operation for `query` (one per shop at a time). Returns its ID."""
+        data = self.graphql(
+            """
+            mutation RunBulk($query: String!) {
+              bulkOperationRunQuery(query: $query) {
+                bulkOperation { id status }
+                userErrors { field message }
+              }
+            }
+            """,
+            {"query": query}
+        )["bulkOperationRunQuery"]
+        if data.get("userErrors"):
+            raise RuntimeError(f"Bulk operation rejected: {data['userErrors']}")
+        return data["bulkOperation"]["id"]
+
+    def run_bulk_mutation(self, mutation: str, staged_upload_path: str) -> str:
+        """Starts a bulk mutation over the staged JSONL variables file. Returns its ID."""
+        data = self.graphql(
+            """
+            mutation RunBulkMutation($mutation: String!, $path: String!) {
+              bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $path) {
+                bulkOperation { id status }
+                userErrors { field message }
+              }
+            }
+            """,
+            {"mutation": mutation, "path": staged_upload_path}
+        )["bulkOperationRunMutation"]
+        if data.get("userErrors"):
+            raise RuntimeError(f"Bulk mutation rejected: {data['userErrors']}")
+        return data["bulkOperation"]["id"]
+
+    def staged_upload(self, filename: str, content: bytes, resource: str = "BULK_MUTATION_VARIABLES",
+                      mime_type: str = "text/jsonl") -> str:
+        """Uploads a file to Shopify's staged storage. Returns the path mutations refer to it by."""
+        data = self.graphql(
+            """
+            mutation Stage($input: [StagedUploadInput!]!) {
+              stagedUploadsCreate(input: $input) {
+                stagedTargets { url resourceUrl parameters { name value } }
+                userErrors { field message }
+              }
+            }
+            """,
+            {"input": [{"resource": resource, "filename": filename, "mimeType": mime_type, "httpMethod": "POST"}]}
+        )["stagedUploadsCreate"]
+        if data.get("userErrors"):
+            raise RuntimeError(f"Staged upload rejected: {data['userErrors']}")
+        target = data["stagedTargets"][0]
+        parameters = {p["name"]: p["value"] for p in target["parameters"]}
+        with httpx.Client(timeout=httpx.Timeout(30.0, write=120.0)) as client:
+            response = client.post(target["url"], data=parameters, files={"file": (filename, content, mime_type)})
+            response.raise_for_status()
+        return parameters["key"]
+
+    def current_bulk_operation(self, kind: str = "QUERY") -> Optional[Dict[str, Any]]:
+        """The shop's latest bulk operation of `kind` (QUERY or MUTATION)."""
+        return self.graphql(
+            """
+            {
+              currentBulkOperation(type: %s) {
+                id status errorCode createdAt objectCount url partialDataUrl
+              }
+            }
+            """ % kind
+        ).get("currentBulkOperation")
+
+    def wait_for_bulk_operation(self, operation_id: str, poll_sec: float = 2.0,
+                                timeout_sec: float = 480.0, kind: str = "QUERY",
+                                on_progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """Polls until the bulk operation finishes. Returns its final state."""
+        deadline = time.time() + timeout_sec
+        while True:
+            operation = self.current_bulk_operation(kind) or {}
+            if operation.get("id") == operation_id and operation.get("status") not in ("CREATED", "RUNNING"):
+                if operation.get("status") != "COMPLETED":
+                    raise BulkOperationFailed(operation)
+                return operation
+            if on_progress is not None and operation.get("id") == operation_id:
+                on_progress(operation)
+            if time.time() > deadline:
+                raise TimeoutError(f"Bulk operation {operation_id} still running after {timeout_sec}s")
+            time.sleep(poll_sec)
+
+    def iter_bulk_results(self, url: str) -> Iterator[Dict[str, Any]]:
+        """Streams a bulk operation's JSONL result, one object per line, without buffering the file."""
+        with httpx.Client(timeout=httpx.Timeout(30.0, read=120.0)) as client:
+            with client.stream("GET", url) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line.strip():
+                        yield json.loads(line)
+
     def get_or_create_customer(self, email: str, first_name: str = "", last_name: str = "") -> Optional[Dict[str, Any]]:
         """
         Syncs a Firebase user to Shopify.
         Checks if customer exists by email. If yes, returns it.
         If no, creates a new customer.
         """
-        if not self.domain or not self.token:
+        if not self.configured:
             return None
         
-        headers = {
-            "X-Shopify-Access-Token": self.token,
-            "Content-Type": "application/json"
-        }
+        headers = self._headers()
         
         try:
             with httpx.Client() as client:
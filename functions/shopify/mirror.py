@@ -0,0 +1,522 @@
+import copy
+import datetime
+import html
+import logging
+import re
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from firebase_admin import firestore
+from firebase_functions import https_fn, options
+from google.cloud.firestore_v1.vector import Vector
+
+from telemetry import registry, span, traced
+from .client import ShopifyClient
+
+# Shopify -> Firestore Product Mirror
+# 'products_live' is the catalogue the assistant and bundle advisor search.
+# The mirror keeps it equal to Shopify:
+#   - bootstrap: a GraphQL bulk operation over every inventory item's levels
+#     per location (held in memory), then one over every product and its
+#     variants, whose JSONL result is streamed line by line
+#   - products/create|update|delete and inventory_levels/update webhooks
+# Every incoming product is reduced to the fields the mirror owns and diffed
+# against the stored document; only changed fields are written, and nothing
+# at all when a webhook carries no relevant change (Shopify sends
+# products/update for every inventory tick). Title/description/tag changes
+# re-embed the product. Fields the mirror does not own (embedding, review
+# metadata written by the admin UI) are never touched.
+
+logger = logging.getLogger(__name__)
+
+MIRROR_COLLECTION = "products_live"
+STATE_COLLECTION = "mirror_state"
+WRITE_BATCH_SIZE = 400
+EMBED_BATCH_SIZE = 100
+EMBED_MODEL = "text-embedding-004"
+
+MIRROR_FIELDS = (
+    "shopifyId", "title", "description", "handle", "status", "product_type", "vendor", "tags",
+    "price", "sku", "variants", "inventory_item_ids", "total_inventory", "in_stock", "shopify_updated_at",
+)
+TEXT_FIELDS = ("title", "description", "tags")
+# Changes to these alone are not worth a write
+BOOKKEEPING_FIELDS = ("shopify_updated_at",)
+
+# Bulk queries may nest at most two connections, so products > variants
+# and inventory items > their levels per location are two operations
+BULK_PRODUCTS_QUERY = """
+{
+  products {
+    edges {
+      node {
+        id title handle status productType vendor tags description updatedAt
+        variants {
+          edges {
+            node {
+              id sku price inventoryQuantity
+              inventoryItem { id }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+BULK_INVENTORY_QUERY = """
+{
+  inventoryItems {
+    edges {
+      node {
+        id
+        inventoryLevels {
+          edges { node { id location { id } quantities(names: ["available"]) { name quantity } } }
+        }
+      }
+    }
+  }
+}
+"""
+
+_TAGS = re.compile(r"<[^>]+>")
+
+
+def numeric_id(gid: Any) -> str:
+    """'gid://shopify/Product/123' -> '123' (REST IDs pass through)."""
+    return str(gid).rsplit("/", 1)[-1]
+
+
+def plain_text(body_html: Optional[str]) -> str:
+    return " ".join(html.unescape(_TAGS.sub(" ", body_html or "")).split())
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def _price(value: Any) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def product_document(product_id: str, title: str, description: str, handle: str, status: str,
+                     product_type: str, vendor: str, tags: List[str], variants: List[Dict[str, Any]],
+                     updated_at: Optional[str]) -> Dict[str, Any]:
+    """The mirror-owned fields of a products_live document."""
+    prices = [v["price"] for v in variants if v["price"] is not None]
+    total = sum(v["inventory"] or 0 for v in variants)
+    return {
+        "shopifyId": product_id,
+        "title": title,
+        "description": description,
+        "handle": handle,
+        "status": (status or "").lower(),
+        "product_type": product_type or None,
+        "vendor": vendor or None,
+        "tags": tags,
+        "price": min(prices) if prices else None,
+        "sku": variants[0]["sku"] if variants else None,
+        "variants": variants,
+        "inventory_item_ids": [v["inventory_item_id"] for v in variants if v["inventory_item_id"]],
+        "total_inventory": total,
+        "in_stock": total > 0,
+        "shopify_updated_at": updated_at,
+    }
+
+
+def from_webhook(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """products/create|update REST payload -> mirror document."""
+    tags = payload.get("tags") or ""
+    variants = [{
+        "id": str(v.get("id")),
+        "sku": v.get("sku") or None,
+        "price": _price(v.get("price")),
+        "inventory_item_id": v.get("inventory_item_id"),
+        "inventory": v.get("inventory_quantity"),
+    } for v in payload.get("variants") or []]
+    return product_document(
+        str(payload["id"]), payload.get("title"), plain_text(payload.get("body_html")), payload.get("handle"),
+        payload.get("status"), payload.get("product_type"), payload.get("vendor"),
+        [t.strip() for t in tags.split(",") if t.strip()] if isinstance(tags, str) else list(tags),
+        variants, payload.get("updated_at"),
+    )
+
+
+def inventory_levels(lines: Iterable[Dict[str, Any]]) -> Dict[int, Dict[str, int]]:
+    """Inventory item ID -> {location ID: available}, from the inventoryItems bulk result."""
+    levels: Dict[int, Dict[str, int]] = {}
+    for line in lines:
+        parent = line.get("__parentId")
+        if not parent or not str(line.get("id", "")).startswith("gid://shopify/InventoryLevel/"):
+            continue
+        available = sum(q.get("quantity") or 0 for q in line.get("quantities") or [] if q.get("name") == "available")
+        levels.setdefault(int(numeric_id(parent)), {})[numeric_id(line["location"]["id"])] = available
+    return levels
+
+
+def iter_bulk_products(lines: Iterable[Dict[str, Any]],
+                       levels: Optional[Dict[int, Dict[str, int]]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Groups bulk JSONL lines (products, then their variants, linked by
+    __parentId) into mirror documents, with per-location inventory from
+    `levels` (see inventory_levels). Shopify writes children after their
+    parent, so only the current product is held.
+    """
+    levels = levels or {}
+    product: Optional[Dict[str, Any]] = None
+    variants: List[Dict[str, Any]] = []
+
+    def finish():
+        return product_document(
+            numeric_id(product["id"]), product.get("title"), product.get("description") or "",
+            product.get("handle"), product.get("status"), product.get("productType"), product.get("vendor"),
+            product.get("tags") or [], variants, product.get("updatedAt"),
+        )
+
+    for line in lines:
+        kind = str(line.get("id", "")).split("/")[-2] if line.get("id") else ""
+        if kind == "Product":
+            if product is not None:
+                yield finish()
+            product, variants = line, []
+        elif kind == "ProductVariant" and product is not None:
+            item = line.get("inventoryItem") or {}
+            item_id = int(numeric_id(item["id"])) if item.get("id") else None
+            variant = {
+                "id": numeric_id(line["id"]),
+                "sku": line.get("sku") or None,
+                "price": _price(line.get("price")),
+                "inventory_item_id": item_id,
+                "inventory": line.get("inventoryQuantity"),
+            }
+            if item_id in levels:
+                variant["inventory_by_location"] = dict(levels[item_id])
+                variant["inventory"] = sum(levels[item_id].values())
+            variants.append(variant)
+    if product is not None:
+        yield finish()
+
+
+def keep_locations(incoming: Dict[str, Any], existing: Optional[Dict[str, Any]]):
+    """
+    REST payloads (and bulk variants whose item had no levels) carry only
+    per-variant totals; keep the per-location levels we already have.
+    """
+    known = {v.get("id"): v.get("inventory_by_location") for v in (existing or {}).get("variants") or []}
+    for variant in incoming["variants"]:
+        if known.get(variant["id"]) and "inventory_by_location" not in variant:
+            variant["inventory_by_location"] = known[variant["id"]]
+
+
+def diff_fields(existing: Optional[Dict[str, Any]], incoming: Dict[str, Any]) -> Dict[str, Any]:
+    """Incoming fields whose value differs from the stored document."""
+    existing = existing or {}
+    changes = {k: v for k, v in incoming.items() if existing.get(k) != v}
+    if all(k in BOOKKEEPING_FIELDS for k in changes):
+        return {}
+    return changes
+
+
+def embedding_text(doc: Dict[str, Any]) -> str:
+    # Same text the catalogue pipeline embeds for drafts
+    return f"{doc.get('title') or ''} {doc.get('description') or ''} {' '.join(doc.get('tags') or [])}"
+
+
+def embed_texts(texts: List[str], interactive: bool = False) -> Optional[List[List[float]]]:
+    """Embeddings through the shared Gemini scheduler; None if unavailable (the doc keeps its reindex flag)."""
+    try:
+        from google import genai
+        from ai.config import AIConfig
+        from ai.scheduler import Priority, schedule
+        client = schedule(genai.Client(
+            vertexai=True,
+            project=AIConfig.PROJECT_ID,
+            location=AIConfig.LOCATION
+        ), Priority.INTERACTIVE if interactive else Priority.BATCH)
+        with span("mirror.embed", texts=len(texts), quiet=True):
+            response = client.models.embed_content(model=EMBED_MODEL, contents=texts)
+        return [e.values for e in response.embeddings]
+    except Exception as e:
+        logger.warning(f"Mirror embedding failed for {len(texts)} products: {e}")
+        return None
+
+
+class ProductMirror:
+    """Applies Shopify product state to products_live, writing only what changed."""
+
+    def __init__(self, db, client: Optional[ShopifyClient] = None):
+        self.db = db
+        self.client = client or ShopifyClient()
+        self.stats = {"seen": 0, "written": 0, "unchanged": 0, "stale": 0, "fields_written": 0,
+                      "embedded": 0, "removed": 0}
+
+    def _ref(self, product_id: str):
+        return self.db.collection(MIRROR_COLLECTION).document(product_id)
+
+    @staticmethod
+    def _diff(existing: Optional[Dict[str, Any]], incoming: Dict[str, Any]):
+        """(outcome, changes): "stale", "unchanged" or "written", and the fields to merge."""
+        stored, received = parse_time((existing or {}).get("shopify_updated_at")), parse_time(incoming.get("shopify_updated_at"))
+        if stored and received and received < stored:
+            return "stale", {}
+        changes = diff_fields(existing, incoming)
+        if not changes:
+            return "unchanged", {}
+        if existing is None or any(f in changes for f in TEXT_FIELDS) or existing.get("embedding_reindex_needed"):
+            changes["embedding_reindex_needed"] = True
+        changes["mirror_synced_at"] = firestore.SERVER_TIMESTAMP
+        return "written", changes
+
+    def _count(self, outcome: str, changes: Dict[str, Any]):
+        self.stats["seen"] += 1
+        self.stats[outcome] += 1
+        if outcome != "written":
+            registry.counter(f"mirror.{outcome}").inc()
+            return
+        fields = len(changes) - 1  # not counting mirror_synced_at
+        self.stats["fields_written"] += fields
+        registry.counter("mirror.writes").inc()
+        registry.counter("mirror.fields_written").inc(fields)
+
+    def _changes(self, existing: Optional[Dict[str, Any]], incoming: Dict[str, Any]) -> Dict[str, Any]:
+        outcome, changes = self._diff(existing, incoming)
+        self._count(outcome, changes)
+        return changes
+
+    # --- Webhooks (one document at a time) ---
+
+    def sync(self, product_id: str, build: Callable[[Optional[Dict[str, Any]]], Dict[str, Any]],
+             source: str, defer_embedding: Callable[[], bool] = lambda: False) -> Dict[str, Any]:
+        """
+        Read-modify-write of one document in a transaction: build(existing)
+        returns the incoming mirror fields, derived from the document as read
+        in the transaction, so webhooks for the same product arriving together
+        cannot overwrite each other's variants. A changed text is embedded
+        after the commit, outside the transaction, unless defer_embedding()
+        says another writer will store it (the document keeps its reindex flag).
+        """
+        ref = self._ref(product_id)
+
+        def apply(transaction):
+            snapshot = ref.get(transaction=transaction)
+            existing = snapshot.to_dict() if snapshot.exists else None
+            outcome, changes = self._diff(existing, build(existing))
+            if changes:
+                transaction.set(ref, changes, merge=True)
+            return existing, outcome, changes
+
+        with span("mirror.write", source=source) as s:
+            existing, outcome, changes = firestore.transactional(apply)(self.db.transaction())
+            s.set(fields=len(changes))
+        self._count(outcome, changes)
+        if changes.get("embedding_reindex_needed"):
+            if defer_embedding():
+                registry.counter("mirror.embed_deferred").inc()
+            else:
+                self._embed(ref, embedding_text(dict(existing or {}, **changes)))
+        return changes
+
+    def _embed(self, ref, text: str):
+        vectors = embed_texts([text], interactive=True)
+        if not vectors:
+            return
+
+        def store(transaction):
+            snapshot = ref.get(transaction=transaction)
+            # A change since then has its own sync embed the newer text
+            if not snapshot.exists or embedding_text(snapshot.to_dict()) != text:
+                return False
+            transaction.set(ref, {"embedding_field": Vector(vectors[0]), "embedding_reindex_needed": False}, merge=True)
+            return True
+
+        if firestore.transactional(store)(self.db.transaction()):
+            self.stats["embedded"] += 1
+
+    # --- Bootstrap (whole catalogue) ---
+
+    def _bulk_results(self, query: str, root: str) -> Iterable[Dict[str, Any]]:
+        with span("mirror.bulk_operation", root=root):
+            operation = self.client.wait_for_bulk_operation(self.client.run_bulk_query(query))
+        return self.client.iter_bulk_results(operation["url"]) if operation.get("url") else []
+
+    def bootstrap(self, lines: Optional[Iterable[Dict[str, Any]]] = None,
+                  level_lines: Optional[Iterable[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Mirrors every Shopify product. `lines` and `level_lines` replace the
+        products and inventoryItems bulk operations (e.g. recorded JSONL
+        fixtures); normally both are run here, one after the other as Shopify
+        allows one bulk query per shop at a time.
+        """
+        started = time.time()
+        with span("mirror.bootstrap") as s:
+            with span("mirror.load_existing"):
+                existing = {
+                    doc.id: doc.to_dict()
+                    for doc in self.db.collection(MIRROR_COLLECTION)
+                    .select(list(MIRROR_FIELDS) + ["embedding_reindex_needed"]).stream()
+                }
+            if lines is None:
+                # Levels first: they are kept in memory while the products stream past
+                level_lines = self._bulk_results(BULK_INVENTORY_QUERY, "inventoryItems")
+            with span("mirror.load_levels"):
+                levels = inventory_levels(level_lines or [])
+            if lines is None:
+                lines = self._bulk_results(BULK_PRODUCTS_QUERY, "products")
+
+            batch, pending = self.db.batch(), 0
+            to_embed: List[Dict[str, Any]] = []
+            seen = set()
+
+            def commit_if_full(force: bool = False):
+                nonlocal batch, pending
+                if pending and (force or pending >= WRITE_BATCH_SIZE):
+                    batch.commit()
+                    batch, pending = self.db.batch(), 0
+
+            def embed_pending():
+                nonlocal pending
+                vectors = embed_texts([embedding_text(d) for d in to_embed])
+                if vectors:
+                    for doc, vector in zip(to_embed, vectors):
+                        batch.set(self._ref(doc["shopifyId"]), {
+                            "embedding_field": Vector(vector),
+                            "embedding_reindex_needed": False,
+                        }, merge=True)
+                        pending += 1
+                        commit_if_full()
+                    self.stats["embedded"] += len(to_embed)
+                to_embed.clear()
+
+            for incoming in iter_bulk_products(lines, levels):
+                product_id = incoming["shopifyId"]
+                seen.add(product_id)
+                current = existing.get(product_id)
+                keep_locations(incoming, current)
+                changes = self._changes(current, incoming)
+                if changes:
+                    batch.set(self._ref(product_id), changes, merge=True)
+                    pending += 1
+                    commit_if_full()
+                if changes.get("embedding_reindex_needed") or (current or {}).get("embedding_reindex_needed"):
+                    to_embed.append(dict(current or {}, **incoming))
+                    if len(to_embed) >= EMBED_BATCH_SIZE:
+                        embed_pending()
+
+            if to_embed:
+                embed_pending()
+
+            # Gone from Shopify since the last sync
+            for product_id, current in existing.items():
+                if product_id not in seen and current.get("status") != "deleted":
+                    batch.set(self._ref(product_id), {"status": "deleted", "mirror_synced_at": firestore.SERVER_TIMESTAMP}, merge=True)
+                    pending += 1
+                    self.stats["removed"] += 1
+                    commit_if_full()
+            commit_if_full(force=True)
+            s.set(**self.stats)
+
+        report = dict(self.stats, elapsed_ms=round((time.time() - started) * 1000, 1))
+        self.db.collection(STATE_COLLECTION).document("products").set(
+            dict(report, bootstrapped_at=firestore.SERVER_TIMESTAMP), merge=True)
+        return report
+
+
+def _observe_lag(updated_at: Optional[str], topic: str):
+    """Time from the change in Shopify to it being applied here."""
+    changed = parse_time(updated_at)
+    if changed is not None:
+        lag_ms = (datetime.datetime.now(datetime.timezone.utc) - changed).total_seconds() * 1000
+        registry.histogram("mirror.lag_ms").observe(lag_ms)
+        registry.histogram(f"mirror.{topic}.lag_ms").observe(lag_ms)
+
+
+# --- Webhook handlers (registered in webhooks/router.py) ---
+
+def handle_product_update(payload: Dict[str, Any]):
+    """products/create and products/update."""
+    db = firestore.client()
+    incoming = from_webhook(payload)
+
+    def build(existing: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        document = copy.deepcopy(incoming)  # the transaction may run this more than once
+        keep_locations(document, existing)
+        return document
+
+    # A bulk publish job writes the document and the draft's embedding itself;
+    # its products/create webhooks usually arrive before it gets to them
+    from .bulk_publish import is_being_published  # bulk_publish imports this module
+    changes = ProductMirror(db).sync(incoming["shopifyId"], build, "products/update",
+                                     defer_embedding=lambda: is_being_published(db, payload))
+    _observe_lag(payload.get("updated_at"), "products")
+    logger.info(f"Mirrored product {incoming['shopifyId']}: {len(changes)} fields changed")
+
+
+def handle_product_delete(payload: Dict[str, Any]):
+    db = firestore.client()
+    ref = db.collection(MIRROR_COLLECTION).document(str(payload.get("id")))
+    if ref.get().exists:
+        ref.set({"status": "deleted", "mirror_synced_at": firestore.SERVER_TIMESTAMP}, merge=True)
+        registry.counter("mirror.writes").inc()
+
+
+def handle_inventory_level_update(payload: Dict[str, Any]):
+    """
+    inventory_levels/update: available quantity of one item at one location.
+    Updates that variant's per-location map and the product's totals.
+    """
+    db = firestore.client()
+    item_id = payload.get("inventory_item_id")
+    docs = db.collection(MIRROR_COLLECTION).where("inventory_item_ids", "array_contains", item_id).limit(1).get()
+    if not docs:
+        registry.counter("mirror.inventory_unmatched").inc()
+        logger.info(f"Inventory item {item_id} is not mirrored; ignoring level update")
+        return
+
+    def build(existing: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        if existing is None:
+            return {}  # deleted since the query
+        variants = copy.deepcopy(existing.get("variants") or [])
+        for variant in variants:
+            if variant.get("inventory_item_id") == item_id:
+                by_location = variant.setdefault("inventory_by_location", {})
+                by_location[str(payload.get("location_id"))] = payload.get("available") or 0
+                variant["inventory"] = sum(by_location.values())
+        total = sum(v.get("inventory") or 0 for v in variants)
+        return {"variants": variants, "total_inventory": total, "in_stock": total > 0}
+
+    ProductMirror(db).sync(docs[0].id, build, "inventory_levels/update")
+    _observe_lag(payload.get("updated_at"), "inventory_levels")
+
+
+# --- Admin bootstrap ---
+
+@https_fn.on_call(
+    region="europe-west1",
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=540,
+)
+@traced("bootstrap_product_mirror")
+def bootstrap_product_mirror(req: https_fn.CallableRequest) -> dict:
+    """Full Shopify -> products_live sync. Admins only."""
+    if req.auth is None:
+        return {"error": "Sign in required"}
+    db = firestore.client()
+    profile = db.collection("users").document(req.auth.uid).get()
+    if not profile.exists or profile.get("role") != "admin":
+        return {"error": "Admin role required"}
+
+    client = ShopifyClient()
+    if not client.configured:
+        return {"error": "Shopify credentials are not configured"}
+    report = ProductMirror(db, client).bootstrap()
+    print(f"Product mirror bootstrap: {report}")
+    return report
@@ -0,0 +1,3 @@
+from .metrics import registry, Counter, Gauge, Histogram, MetricsRegistry
+from .exporters import Exporter, JsonLogExporter, InMemoryExporter, OpenTelemetryExporter
+from .tracing import Span, span, traced, current_span, set_exporters, add_exporter, flush_metrics
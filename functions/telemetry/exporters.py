@@ -0,0 +1,106 @@
+import json
+import logging
+import sys
+import threading
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class Exporter:
+    """Receives finished spans and periodic metric snapshots."""
+
+    def export_span(self, span) -> None:
+        pass
+
+    def export_metrics(self, snapshot: Dict[str, dict]) -> None:
+        pass
+
+
+class JsonLogExporter(Exporter):
+    """
+    Writes one JSON object per line to stdout.
+    Cloud Logging parses these as structured entries (severity/message + jsonPayload).
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def _write(self, entry: dict):
+        line = json.dumps(entry, default=str, separators=(",", ":"))
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def export_span(self, span) -> None:
+        if span.quiet:
+            return
+        entry = span.to_dict()
+        entry["severity"] = "ERROR" if span.status == "error" else "INFO"
+        entry["message"] = f"span {span.name} {span.duration_ms:.1f}ms"
+        self._write(entry)
+
+    def export_metrics(self, snapshot: Dict[str, dict]) -> None:
+        self._write({"severity": "INFO", "message": "metrics", "metrics": snapshot})
+
+
+class InMemoryExporter(Exporter):
+    """Keeps spans and metric snapshots in memory (tests, benchmarks)."""
+
+    def __init__(self):
+        self.spans: List = []
+        self.metrics: List[Dict[str, dict]] = []
+        self._lock = threading.Lock()
+
+    def export_span(self, span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def export_metrics(self, snapshot: Dict[str, dict]) -> None:
+        with self._lock:
+            self.metrics.append(snapshot)
+
+    def find(self, name: str) -> List:
+        return [s for s in self.spans if s.name == name]
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+            self.metrics.clear()
+
+
+class OpenTelemetryExporter(Exporter):
+    """
+    Records span durations into an OpenTelemetry histogram.
+    Requires opentelemetry-api (plus an SDK/exporter configured by the deployment).
+    """
+
+    def __init__(self, meter_name: str = "eshop.functions"):
+        from opentelemetry import metrics as otel_metrics
+        meter = otel_metrics.get_meter(meter_name)
+        self._histogram = meter.create_histogram(
+            "function.stage.duration", unit="ms", description="Duration of instrumented stages"
+        )
+
+    def export_span(self, span) -> None:
+        attrs = {"stage": span.name, "status": span.status}
+        self._histogram.record(span.duration_ms, attributes=attrs)
+
+
+def exporters_from_env(spec: str) -> List[Exporter]:
+    """Builds exporters from a comma-separated list: log, otel, memory, none."""
+    exporters: List[Exporter] = []
+    for name in [s.strip().lower() for s in spec.split(",") if s.strip()]:
+        if name == "log":
+            exporters.append(JsonLogExporter())
+        elif name == "memory":
+            exporters.append(InMemoryExporter())
+        elif name == "otel":
+            try:
+                exporters.append(OpenTelemetryExporter())
+            except ImportError:
+                logger.warning("opentelemetry not installed; otel exporter disabled.")
+        elif name != "none":
+            logger.warning(f"Unknown telemetry exporter '{name}'")
+    return exporters
@@ -0,0 +1,411 @@
+import datetime
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .metrics import registry
+from .tracing import Span, set_span_observer
+
+# Opt-in Handler Profiling
+# A traced Cloud Function handler can be profiled for one invocation, either
+# because its name is listed in PROFILE_FUNCTIONS ("*" for all of them) or,
+# when PROFILE_REQUEST_FLAG is on, because an authorised request asks for it:
+#   callables:      {"_profile": true} in the call data, from a signed-in admin
+#   HTTP functions: an "X-Profile: <PROFILE_REQUEST_SECRET>" header
+#   storage events: custom metadata profile=<PROFILE_REQUEST_SECRET> on the object
+# Without PROFILE_REQUEST_SECRET only admins' callables can ask; profiling
+# costs CPU and memory, so anonymous callers must not be able to switch it on.
+# While profiling, a sampler thread records every thread's stack and the
+# instance's resident memory every PROFILE_SAMPLE_INTERVAL_MS, attributed to
+# the stage (any open span) each thread is in, and tracemalloc records the
+# peak Python heap per stage and the allocation sites behind it. tracemalloc
+# slows allocation-heavy code several times over and its bookkeeping shows
+# up in resident memory; PROFILE_TRACEMALLOC=false keeps only the sampled
+# stacks and resident memory, for an undistorted RSS figure. The
+# report (JSON plus a .folded file for flame graphs) is uploaded to
+# gs://PROFILE_BUCKET/PROFILE_PREFIX<function>/<date>/. One invocation per
+# instance is profiled at a time; concurrent ones run normally.
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FUNCTIONS = {n.strip() for n in os.environ.get("PROFILE_FUNCTIONS", "").split(",") if n.strip()}
+PROFILE_REQUEST_FLAG = os.environ.get("PROFILE_REQUEST_FLAG", "false").lower() in ("1", "true", "yes")
+PROFILE_REQUEST_SECRET = os.environ.get("PROFILE_REQUEST_SECRET", "")
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "10"))
+PROFILE_TRACEMALLOC = os.environ.get("PROFILE_TRACEMALLOC", "true").lower() in ("1", "true", "yes")
+PROFILE_TRACE_FRAMES = int(os.environ.get("PROFILE_TRACE_FRAMES", "4"))
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "25"))
+# A new heap snapshot is taken each time traced memory grows by this factor (and at least 1 MiB),
+# so the snapshots together cost a small multiple of the last one
+PROFILE_SNAPSHOT_GROWTH = float(os.environ.get("PROFILE_SNAPSHOT_GROWTH", "1.25"))
+PROFILE_BUCKET = os.environ.get("PROFILE_BUCKET") or os.environ.get("FIREBASE_STORAGE_BUCKET")
+PROFILE_PREFIX = os.environ.get("PROFILE_PREFIX", "profiles/")
+
+_TRUE = ("1", "true", "yes", "on")
+_MAX_STACK_DEPTH = 64
+# Innermost frames of threads parked on a lock or queue; counted as idle, not as CPU samples
+_IDLE = ("threading.py:wait", "thread.py:_worker", "queue.py:get", "selectors.py:select")
+_FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_session_lock = threading.Lock()
+
+
+def _flag(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in _TRUE
+
+
+def _secret(value: Any) -> bool:
+    if not PROFILE_REQUEST_SECRET or not value:
+        return False
+    return hmac.compare_digest(str(value).encode("utf-8"), PROFILE_REQUEST_SECRET.encode("utf-8"))
+
+
+def _is_admin(uid: str) -> bool:
+    """Same check as the admin-only callables: users/{uid}.role == "admin"."""
+    from firebase_admin import firestore
+    try:
+        profile = firestore.client().collection("users").document(uid).get()
+    except Exception as e:
+        logger.warning(f"Could not check the profiling caller's role: {e}")
+        return False
+    return profile.exists and profile.get("role") == "admin"
+
+
+def requested(args: Tuple[Any, ...]) -> bool:
+    """Whether the handler's trigger payload asks to be profiled and comes from a caller allowed to ask."""
+    for arg in args:
+        data = getattr(arg, "data", None)
+        if hasattr(arg, "auth") and isinstance(data, dict):  # https_fn.CallableRequest
+            return _flag(data.get("_profile")) and arg.auth is not None and _is_admin(arg.auth.uid)
+        headers = getattr(arg, "headers", None)
+        if headers is not None and hasattr(arg, "args"):  # flask Request
+            return _secret(headers.get("X-Profile"))
+        metadata = getattr(data, "metadata", None)
+        if isinstance(metadata, dict):  # storage CloudEvent
+            return _secret(metadata.get("profile"))
+    return False
+
+
+def should_profile(name: str, args: Tuple[Any, ...]) -> bool:
+    if "*" in PROFILE_FUNCTIONS or name in PROFILE_FUNCTIONS:
+        return True
+    return PROFILE_REQUEST_FLAG and requested(args)
+
+
+def _relative(path: str) -> str:
+    if path.startswith(_FUNCTIONS_DIR):
+        return os.path.relpath(path, _FUNCTIONS_DIR)
+    return "/".join(path.split(os.sep)[-2:])
+
+
+def _rss_bytes() -> Optional[int]:
+    """Current resident set size (Linux); the instance memory limit applies to this."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _where(code) -> str:
+    return f"{_relative(code.co_filename)}:{code.co_name}"
+
+
+class StageStats:
+    __slots__ = ("calls", "wall_ms", "cpu_ms", "peak_bytes", "rss_bytes", "samples")
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_ms = 0.0
+        self.cpu_ms = 0.0
+        self.peak_bytes = 0
+        self.rss_bytes = 0
+        self.samples = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "wall_ms": round(self.wall_ms, 1),
+            "cpu_ms": round(self.cpu_ms, 1),
+            "peak_mib": round(self.peak_bytes / 2**20, 2),
+            "rss_mib": round(self.rss_bytes / 2**20, 1),
+            "samples": self.samples,
+        }
+
+
+class ProfileSession:
+    """Memory and CPU profile of one handler invocation (see module comment)."""
+
+    def __init__(self, function: str, root: Span, interval_ms: float = PROFILE_SAMPLE_INTERVAL_MS,
+                 trace_memory: bool = PROFILE_TRACEMALLOC, frames: int = PROFILE_TRACE_FRAMES,
+                 top_n: int = PROFILE_TOP_N):
+        self.function = function
+        self.root = root
+        self.interval_sec = max(interval_ms, 1.0) / 1000.0
+        self.trace_memory = trace_memory
+        self.frames = frames
+        self.top_n = top_n
+        self.stages: Dict[str, StageStats] = defaultdict(StageStats)
+        self.stacks: Dict[str, int] = defaultdict(int)  # folded stack -> samples
+        self.functions: Dict[str, int] = defaultdict(int)  # innermost frame -> samples
+        self.peak_bytes = 0
+        self.rss_start_bytes = _rss_bytes() or 0
+        self.rss_peak_bytes = self.rss_start_bytes
+        self.snapshots_taken = 0
+        self.idle_samples = 0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._snapshot_bytes = 0
+        self._active: Dict[int, List[str]] = defaultdict(list)  # thread ident -> open stage names
+        self._open: Dict[str, Tuple[float, float]] = {}  # span_id -> (perf_counter, thread_time)
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._owns_tracemalloc = False
+        self._stopped = False
+        self._started = 0.0
+        self._cpu_started = 0.0
+        self._process_cpu_started = 0.0
+
+    def start(self):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self._owns_tracemalloc = True
+            tracemalloc.reset_peak()
+        self._started = time.perf_counter()
+        self._cpu_started = time.thread_time()
+        self._process_cpu_started = time.process_time()
+        # The root span was entered before the observer existed
+        self._active[threading.get_ident()].append(self.root.name)
+        self.stages[self.root.name].calls += 1
+        set_span_observer(self.observe)
+        self._sampler = threading.Thread(target=self._sample_loop, name=f"profiler-{self.function}", daemon=True)
+        self._sampler.start()
+
+    def _fold_peak(self) -> int:
+        """Charges the heap peak since the last boundary to every stage open during it."""
+        if not self.trace_memory:
+            return 0
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.peak_bytes = max(self.peak_bytes, peak)
+        for names in self._active.values():
+            for name in set(names):
+                stage = self.stages[name]
+                stage.peak_bytes = max(stage.peak_bytes, peak)
+        return current
+
+    def observe(self, s: Span, entered: bool):
+        if self._stopped:
+            return
+        ident = threading.get_ident()
+        with self._lock:
+            self._fold_peak()
+            if entered:
+                self._active[ident].append(s.name)
+                self._open[s.span_id] = (time.perf_counter(), time.thread_time())
+            else:
+                self._close(ident, s)
+
+    def _close(self, ident: int, s: Span):
+        opened = self._open.pop(s.span_id, None)
+        names = self._active.get(ident)
+        if names and s.name in names:
+            del names[len(names) - 1 - names[::-1].index(s.name)]
+        if opened is None:
+            return
+        stage = self.stages[s.name]
+        stage.calls += 1
+        stage.wall_ms += (time.perf_counter() - opened[0]) * 1000
+        stage.cpu_ms += (time.thread_time() - opened[1]) * 1000
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval_sec):
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, frame in frames.items():
+                    if ident == me:
+                        continue
+                    where = _where(frame.f_code)
+                    if where.endswith(_IDLE):
+                        self.idle_samples += 1
+                        continue
+                    names = self._active.get(ident)
+                    stage = names[-1] if names else "(no span)"
+                    self.stages[stage].samples += 1
+                    self.functions[where] += 1
+                    self.stacks[self._folded(stage, frame)] += 1
+                current = self._fold_peak()
+                rss = _rss_bytes() or 0
+                self.rss_peak_bytes = max(self.rss_peak_bytes, rss)
+                for names in self._active.values():
+                    for name in set(names):
+                        stage = self.stages[name]
+                        stage.rss_bytes = max(stage.rss_bytes, rss)
+            del frames
+            self._maybe_snapshot(current)
+
+    @staticmethod
+    def _folded(stage: str, frame) -> str:
+        names = []
+        while frame is not None and len(names) < _MAX_STACK_DEPTH:
+            names.append(_where(frame.f_code))
+            frame = frame.f_back
+        names.append(stage.replace(";", ","))
+        return ";".join(reversed(names))
+
+    def _maybe_snapshot(self, current: int):
+        """Keeps the heap snapshot closest to the peak; retaking it is what costs."""
+        threshold = max(self._snapshot_bytes * PROFILE_SNAPSHOT_GROWTH, self._snapshot_bytes + 2**20)
+        if not self.trace_memory or current < threshold:
+            return
+        if self._snapshot_lock.acquire(blocking=False):
+            try:
+                self._take_snapshot(current)
+            finally:
+                self._snapshot_lock.release()
+
+    def _take_snapshot(self, current: int):
+        self._snapshot, self._snapshot_bytes = tracemalloc.take_snapshot(), current
+        self.snapshots_taken += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join(timeout=5)
+        with self._lock:
+            self._fold_peak()
+            self._stopped = True
+            stage = self.stages[self.root.name]
+            stage.wall_ms += (time.perf_counter() - self._started) * 1000
+            stage.cpu_ms += (time.thread_time() - self._cpu_started) * 1000
+        set_span_observer(None)
+        if not self.trace_memory:
+            return
+        if self._snapshot is None:
+            self._take_snapshot(tracemalloc.get_traced_memory()[0])
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+
+    def _allocation_sites(self) -> List[dict]:
+        if self._snapshot is None:
+            return []
+        snapshot = self._snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        by_traceback = {stat.traceback[0]: stat for stat in snapshot.statistics("traceback")}
+        sites = []
+        for stat in snapshot.statistics("lineno")[:self.top_n]:
+            frame = stat.traceback[0]
+            full = by_traceback.get(frame)
+            sites.append({
+                "site": f"{_relative(frame.filename)}:{frame.lineno}",
+                "mib": round(stat.size / 2**20, 3),
+                "blocks": stat.count,
+                "traceback": full.traceback.format() if full is not None else [],
+            })
+        return sites
+
+    def report(self) -> dict:
+        wall_ms = self.stages[self.root.name].wall_ms
+        total_samples = sum(self.functions.values()) or 1
+        top_functions = sorted(self.functions.items(), key=lambda item: -item[1])[:self.top_n]
+        try:
+            import resource
+            max_rss_mib = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        except ImportError:
+            max_rss_mib = None
+        return {
+            "function": self.function,
+            "trace_id": self.root.trace_id,
+            "started_at": datetime.datetime.fromtimestamp(self.root.start_time, datetime.timezone.utc).isoformat(),
+            "wall_ms": round(wall_ms, 1),
+            "process_cpu_ms": round((time.process_time() - self._process_cpu_started) * 1000, 1),
+            "memory": {
+                "traced": self.trace_memory,
+                "peak_mib": round(self.peak_bytes / 2**20, 2),
+                "rss_start_mib": round(self.rss_start_bytes / 2**20, 1),
+                "rss_peak_mib": round(self.rss_peak_bytes / 2**20, 1),
+                "snapshot_mib": round(self._snapshot_bytes / 2**20, 2),
+                "snapshots_taken": self.snapshots_taken,
+                "max_rss_mib": max_rss_mib,
+                "top_sites": self._allocation_sites(),
+            },
+            "stages": {name: stage.to_dict() for name, stage in
+                       sorted(self.stages.items(), key=lambda item: (-item[1].peak_bytes, -item[1].rss_bytes))},
+            "cpu": {
+                "sample_interval_ms": self.interval_sec * 1000,
+                "samples": sum(self.functions.values()),
+                "idle_samples": self.idle_samples,
+                "top_functions": [{"function": name, "samples": count, "share": round(count / total_samples, 3)}
+                                  for name, count in top_functions],
+            },
+        }
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+def upload_report(session: ProfileSession, report: dict) -> Optional[str]:
+    """Writes the report and folded stacks to Cloud Storage; returns the JSON's gs:// URI."""
+    if not PROFILE_BUCKET:
+        logger.warning("profiling: no PROFILE_BUCKET or FIREBASE_STORAGE_BUCKET; report only logged")
+        return None
+    from firebase_admin import storage
+    started = datetime.datetime.fromisoformat(report["started_at"])
+    name = f"{PROFILE_PREFIX}{session.function}/{started:%Y-%m-%d}/{started:%H%M%S}-{session.root.trace_id[:12]}"
+    bucket = storage.bucket(PROFILE_BUCKET)
+    bucket.blob(f"{name}.json").upload_from_string(json.dumps(report, indent=1, default=str),
+                                                   content_type="application/json")
+    bucket.blob(f"{name}.folded").upload_from_string(session.folded(), content_type="text/plain")
+    return f"gs://{PROFILE_BUCKET}/{name}.json"
+
+
+def profiled_call(name: str, root: Span, func: Callable, args: Tuple[Any, ...], kwargs: Dict[str, Any]):
+    """Runs a traced handler, profiling it when asked to (see should_profile)."""
+    if not should_profile(name, args):
+        return func(*args, **kwargs)
+    if not _session_lock.acquire(blocking=False):
+        registry.counter("profiling.skipped").inc()
+        return func(*args, **kwargs)
+    try:
+        session = ProfileSession(name, root, PROFILE_SAMPLE_INTERVAL_MS, PROFILE_TRACEMALLOC)
+        session.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            session.stop()
+            _publish(session)
+    finally:
+        _session_lock.release()
+
+
+def _publish(session: ProfileSession):
+    try:
+        report = session.report()
+        uri = upload_report(session, report)
+    except Exception as e:
+        registry.counter("profiling.errors").inc()
+        logger.warning(f"profiling: could not write the report for {session.function}: {e}")
+        return
+    memory = report["memory"]
+    registry.counter(f"profiling.{session.function}.sessions").inc()
+    registry.gauge(f"profiling.{session.function}.peak_mib").set(memory["peak_mib"])
+    registry.gauge(f"profiling.{session.function}.rss_peak_mib").set(memory["rss_peak_mib"])
+    session.root.set(profile=uri, profile_peak_mib=memory["peak_mib"], profile_rss_peak_mib=memory["rss_peak_mib"])
+    top = memory["top_sites"][0]["site"] if memory["top_sites"] else "-"
+    logger.info(f"profiling: {session.function} heap peak {memory['peak_mib']} MiB (top site {top}), "
+                f"RSS peak {memory['rss_peak_mib']} MiB, "
+                f"{report['cpu']['samples']} samples, report {uri}")
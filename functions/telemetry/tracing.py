@@ -0,0 +1,159 @@
+import contextlib
+import contextvars
+import functools
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from .exporters import Exporter, exporters_from_env
+from .metrics import registry
+
+# Lightweight request tracing
+# A span measures one stage (embedding, vector search, generation, Firestore
+# write...). Finished spans are handed to the configured exporters and their
+# durations are aggregated into per-stage histograms ("span.<name>").
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("telemetry_span", default=None)
+
+_exporters: List[Exporter] = exporters_from_env(os.environ.get("TELEMETRY_EXPORTERS", "log"))
+_exporters_lock = threading.Lock()
+
+METRICS_INTERVAL_SEC = float(os.environ.get("TELEMETRY_METRICS_INTERVAL_SEC", "60"))
+_last_metrics_flush = time.monotonic()
+
+# Told about every span entered (True) and left (False) while a profile is recording (see profiling.py)
+_span_observer: Optional[Callable[["Span", bool], None]] = None
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    start_time: float = 0.0  # epoch seconds
+    duration_ms: float = 0.0
+    status: str = "ok"
+    error: Optional[str] = None
+    quiet: bool = False  # aggregate into histograms only, don't log
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            "span": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def set_exporters(exporters: List[Exporter]):
+    """Replaces the active exporters (e.g. with an InMemoryExporter in tests)."""
+    global _exporters
+    with _exporters_lock:
+        _exporters = list(exporters)
+
+
+def add_exporter(exporter: Exporter):
+    with _exporters_lock:
+        _exporters.append(exporter)
+
+
+def set_span_observer(observer: Optional[Callable[["Span", bool], None]]):
+    global _span_observer
+    _span_observer = observer
+
+
+def flush_metrics():
+    """Pushes a snapshot of all metrics to every exporter."""
+    global _last_metrics_flush
+    _last_metrics_flush = time.monotonic()
+    snapshot = registry.snapshot()
+    for exporter in list(_exporters):
+        exporter.export_metrics(snapshot)
+
+
+def _finish(span: Span):
+    registry.histogram(f"span.{span.name}").observe(span.duration_ms)
+    if span.status == "error":
+        registry.counter(f"span.{span.name}.errors").inc()
+    for exporter in list(_exporters):
+        try:
+            exporter.export_span(span)
+        except Exception:
+            pass
+    if span.parent_id is None and time.monotonic() - _last_metrics_flush >= METRICS_INTERVAL_SEC:
+        flush_metrics()
+
+
+@contextlib.contextmanager
+def span(name: str, quiet: bool = False, **attributes: Any):
+    """
+    Times the enclosed block as a stage of the current trace.
+    Usage:
+        with span("vector_search", collection="products") as s:
+            ...
+            s.set(results=len(docs))
+    """
+    parent = _current_span.get()
+    s = Span(
+        name=name,
+        trace_id=parent.trace_id if parent else uuid.uuid4().hex,
+        span_id=uuid.uuid4().hex[:16],
+        parent_id=parent.span_id if parent else None,
+        attributes=dict(attributes),
+        start_time=time.time(),
+        quiet=quiet,
+    )
+    token = _current_span.set(s)
+    observer = _span_observer
+    if observer is not None:
+        observer(s, True)
+    start = time.perf_counter()
+    try:
+        yield s
+    except BaseException as e:
+        s.status = "error"
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        s.duration_ms = (time.perf_counter() - start) * 1000.0
+        if observer is not None:
+            observer(s, False)
+        _current_span.reset(token)
+        _finish(s)
+
+
+def traced(name: Optional[str] = None, quiet: bool = False):
+    """
+    Decorator form of `span`; defaults to the function name. A traced
+    function called outside any span (a Cloud Function handler) may be
+    profiled, see profiling.py.
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, quiet=quiet) as s:
+                if s.parent_id is None:
+                    from .profiling import profiled_call  # profiling imports this module
+                    return profiled_call(span_name, s, func, args, kwargs)
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,229 @@
+import base64
+import collections
+import contextvars
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from firebase_admin import firestore
+from google.api_core import exceptions as gexc
+
+from telemetry import registry
+
+# Webhook Admission
+# Every Shopify delivery goes through here before any business logic:
+#   1. read the body once, computing the HMAC while streaming it in
+#   2. drop redeliveries (X-Shopify-Webhook-Id) using a per-instance LRU
+#      backed by a Firestore marker document shared across instances
+#   3. parse JSON from the same buffer
+# Rejections never reach order mapping or AADE transmission.
+# The marker is written as "processing" with a lease and only becomes
+# "done" once the handler has succeeded (Admission.complete). A failed
+# attempt deletes it (Admission.release); one that crashed or timed out
+# leaves it to expire, after which Shopify's next retry is processed.
+# While the lease is live, retries get a 409 so Shopify tries again later.
+
+logger = logging.getLogger(__name__)
+
+DEDUP_COLLECTION = "webhook_deliveries"
+DEDUP_MEMORY_SIZE = int(os.environ.get("WEBHOOK_DEDUP_MEMORY_SIZE", "10000"))
+DEDUP_TTL_DAYS = 3  # Shopify retries for up to 48h
+# Longer than the handler's function timeout, so a live attempt is never taken over
+DEDUP_LEASE_SEC = int(os.environ.get("WEBHOOK_DEDUP_LEASE_SEC", "120"))
+READ_CHUNK = 64 * 1024
+
+ADMISSION_BUCKETS_US = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+# Set for the request when the delivery's marker was left by an attempt that never finished
+_redelivery: contextvars.ContextVar[bool] = contextvars.ContextVar("webhook_redelivery", default=False)
+
+
+def is_redelivery() -> bool:
+    """Whether an earlier attempt at the current delivery may have done part of the work."""
+    return _redelivery.get()
+
+
+@dataclass
+class Admission:
+    accepted: bool
+    status: int = 200
+    reason: str = "OK"
+    topic: Optional[str] = None
+    webhook_id: Optional[str] = None
+    payload: Optional[Dict[str, Any]] = None
+    elapsed_us: float = 0.0
+
+    def complete(self):
+        """Marks the delivery as handled, so later redeliveries are dropped (call on success)."""
+        if self.webhook_id:
+            deduplicator.complete(self.webhook_id)
+
+    def release(self):
+        """Forgets the delivery so a Shopify retry is processed again (call on failure)."""
+        if self.webhook_id:
+            deduplicator.forget(self.webhook_id)
+
+
+class WebhookDeduplicator:
+    """Bounded in-memory set of handled webhook IDs, backed by Firestore markers."""
+
+    def __init__(self, max_size: int = DEDUP_MEMORY_SIZE, collection: str = DEDUP_COLLECTION):
+        self.max_size = max_size
+        self.collection = collection
+        self._seen: "collections.OrderedDict[str, None]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, webhook_id: str):
+        with self._lock:
+            self._seen[webhook_id] = None
+            self._seen.move_to_end(webhook_id)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+
+    def check_and_mark(self, webhook_id: str, topic: Optional[str] = None) -> Optional[str]:
+        """
+        Claims the delivery for processing. Returns None if the caller should
+        process it, otherwise the marker state that blocks it ("done" or
+        "processing" under a live lease).
+        """
+        with self._lock:
+            if webhook_id in self._seen:
+                return "done"
+
+        db = firestore.client()
+        ref = db.collection(self.collection).document(webhook_id)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        marker = {
+            "topic": topic,
+            "state": "processing",
+            "lease_until": now + datetime.timedelta(seconds=DEDUP_LEASE_SEC),
+            "attempts": 1,
+            "received_at": firestore.SERVER_TIMESTAMP,
+            # Firestore TTL policy on this field cleans old markers
+            "expires_at": now + datetime.timedelta(days=DEDUP_TTL_DAYS),
+        }
+
+        def retake(transaction):
+            snap = ref.get(transaction=transaction)
+            data = snap.to_dict() if snap.exists else None
+            if data:
+                state = data.get("state", "done")
+                lease_until = data.get("lease_until")
+                if state == "done" or (lease_until is not None and lease_until > now):
+                    return state
+                marker["attempts"] = data.get("attempts", 1) + 1
+            transaction.set(ref, marker)
+            return None
+
+        try:
+            # First delivery: one write. Only an existing marker needs the transaction.
+            ref.create(marker)
+            return None
+        except gexc.AlreadyExists:
+            pass
+        except Exception as e:
+            # Dedup is best-effort: never drop a delivery because Firestore is unavailable
+            logger.warning(f"Webhook dedup marker write failed for {webhook_id}: {e}")
+            return None
+        try:
+            state = firestore.transactional(retake)(db.transaction())
+        except Exception as e:
+            logger.warning(f"Webhook dedup marker write failed for {webhook_id}: {e}")
+            return None
+        if state == "done":
+            self._remember(webhook_id)
+        elif state is None:
+            _redelivery.set(True)
+            registry.counter("webhook.dedup.lease_expired").inc()
+            logger.warning(f"Webhook {webhook_id} ({topic}): previous attempt did not finish; processing again")
+        return state
+
+    def complete(self, webhook_id: str):
+        self._remember(webhook_id)
+        try:
+            firestore.client().collection(self.collection).document(webhook_id).update({
+                "state": "done",
+                "lease_until": None,
+                "completed_at": firestore.SERVER_TIMESTAMP,
+            })
+        except Exception as e:
+            # The lease runs out and a redelivery is processed again (the handlers check the ledger)
+            logger.warning(f"Could not mark webhook {webhook_id} done: {e}")
+
+    def forget(self, webhook_id: str):
+        with self._lock:
+            self._seen.pop(webhook_id, None)
+        try:
+            firestore.client().collection(self.collection).document(webhook_id).delete()
+        except Exception as e:
+            logger.warning(f"Could not release webhook marker {webhook_id}: {e}")
+
+
+deduplicator = WebhookDeduplicator()
+
+
+def read_and_verify(stream, secret: Optional[str], signature: Optional[str]) -> Tuple[bytes, bool]:
+    """Reads the body in chunks, feeding each chunk to the HMAC as it arrives."""
+    mac = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256) if secret else None
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(READ_CHUNK)
+        if not chunk:
+            break
+        buffer += chunk
+        if mac is not None:
+            mac.update(chunk)
+    if mac is None:
+        return bytes(buffer), True
+    expected = base64.b64encode(mac.digest()).decode("utf-8")
+    return bytes(buffer), hmac.compare_digest(expected, signature or "")
+
+
+def _finish(admission: Admission, start: float) -> Admission:
+    admission.elapsed_us = (time.perf_counter() - start) * 1e6
+    registry.histogram("webhook.admission_us", ADMISSION_BUCKETS_US).observe(admission.elapsed_us)
+    registry.counter(f"webhook.admission.{admission.reason.split(':')[0].lower().replace(' ', '_')}").inc()
+    return admission
+
+
+def admit_shopify_webhook(req) -> Admission:
+    """Verifies, deduplicates and parses a Shopify webhook request."""
+    start = time.perf_counter()
+    _redelivery.set(False)
+    secret = os.environ.get("SHOPIFY_WEBHOOK_SECRET")
+    signature = req.headers.get("X-Shopify-Hmac-Sha256")
+    topic = req.headers.get("X-Shopify-Topic")
+    webhook_id = req.headers.get("X-Shopify-Webhook-Id")
+
+    if not secret:
+        logger.warning("SHOPIFY_WEBHOOK_SECRET not set. Skipping verification.")
+    elif not signature:
+        return _finish(Admission(False, 401, "Missing HMAC header", topic), start)
+
+    body, valid = read_and_verify(req.stream, secret, signature)
+    if not valid:
+        return _finish(Admission(False, 401, "Invalid HMAC signature", topic), start)
+
+    state = deduplicator.check_and_mark(webhook_id, topic) if webhook_id else None
+    if state == "done":
+        # 200 so Shopify stops retrying a delivery we already handled
+        return _finish(Admission(False, 200, "Duplicate delivery", topic), start)
+    if state is not None:
+        # Another attempt holds the lease; a non-2xx makes Shopify retry later
+        return _finish(Admission(False, 409, "Delivery in progress", topic), start)
+
+    try:
+        payload = json.loads(body)
+    except ValueError as e:
+        admission = Admission(False, 400, f"Invalid JSON: {e}", topic, webhook_id)
+        admission.release()
+        return _finish(admission, start)
+
+    return _finish(Admission(True, 200, "OK", topic, webhook_id, payload), start)
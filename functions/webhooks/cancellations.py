@@ -0,0 +1,51 @@
+import logging
+from typing import Dict, Any
+
+from aade.ledger import InvoiceLedger
+from telemetry import span
+from webhooks.transmission import TransmissionFailed, get_transmitter
+
+logger = logging.getLogger(__name__)
+
+def handle_order_cancelled(payload: Dict[str, Any]):
+    """
+    Handles 'orders/cancelled' webhook from Shopify.
+    Cancels every invoice transmitted for the order in myDATA.
+    """
+    order_id = payload.get("id")
+    order_name = payload.get("name")
+
+    logger.info(f"Processing cancelled order: {order_name} ({order_id})")
+
+    try:
+        ledger = InvoiceLedger()
+        entries = ledger.find_for_order(order_id)
+        if not entries:
+            logger.info(f"No transmitted invoice for {order_name}. Nothing to cancel.")
+            return
+
+        failed = []
+        for entry in entries:
+            mark = entry.get("mark")
+            if not isinstance(mark, int):
+                logger.warning(f"Invoice {entry.get('uid')} has no AADE mark ({mark}). Skipping cancellation.")
+                continue
+
+            with span("webhook.cancel_aade") as s:
+                result = get_transmitter().cancel_invoice_sync(mark)
+                s.set(success=bool(result.get("success")))
+
+            if result.get("success"):
+                ledger.mark_cancelled(entry["uid"], result.get("cancellation_mark"))
+                logger.info(f"Cancelled invoice {entry['uid']} (mark {mark}) for {order_name}.")
+            else:
+                logger.error(f"Failed to cancel invoice {entry['uid']} (mark {mark}): {result.get('error')}")
+                failed.append(entry["uid"])
+        if failed:
+            # The ones cancelled above are no longer 'transmitted', so a retry only repeats these
+            raise TransmissionFailed(f"AADE did not cancel {', '.join(failed)}")
+
+    except Exception as e:
+        # Propagated so the router counts the failure and Shopify retries the delivery
+        logger.error(f"Error cancelling AADE invoices for order {order_name}: {e}")
+        raise
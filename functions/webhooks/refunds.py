@@ -0,0 +1,115 @@
+import logging
+import datetime
+from typing import Dict, Any, List, Optional
+
+from aade.types import AADEInvoice, InvoiceType, Party, InvoiceSummary
+from aade.ledger import InvoiceLedger
+from webhooks.admission import is_redelivery
+from webhooks.shopify import issuer_party, build_row
+from webhooks.transmission import TransmissionFailed, transmit_and_record
+
+logger = logging.getLogger(__name__)
+
+def handle_refund_created(payload: Dict[str, Any]):
+    """
+    Handles 'refunds/create' webhook from Shopify.
+    Issues an AADE credit note correlated to the order's original invoice.
+    """
+    refund_id = payload.get("id")
+    order_id = payload.get("order_id")
+
+    logger.info(f"Processing refund {refund_id} for order {order_id}")
+
+    try:
+        ledger = InvoiceLedger()
+        if is_redelivery() and any(e.get("uid") == f"refund-{refund_id}" for e in ledger.find_for_order(
+                order_id, [InvoiceType.CREDIT_NOTE, InvoiceType.RETAIL_CREDIT_NOTE])):
+            logger.info(f"Refund {refund_id} was already credited by an earlier attempt. Skipping.")
+            return
+
+        originals = ledger.find_for_order(
+            order_id, [InvoiceType.SALES_INVOICE, InvoiceType.RETAIL_RECEIPT]
+        )
+        if not originals:
+            logger.warning(f"No transmitted invoice found for order {order_id}. Cannot credit refund {refund_id}.")
+            return
+
+        original = pick_original(originals)
+        if len(originals) > 1:
+            logger.warning(f"Order {order_id} has {len(originals)} transmitted invoices "
+                           f"({', '.join(str(e.get('uid')) for e in originals)}); "
+                           f"crediting refund {refund_id} against the first issued, {original.get('uid')}")
+        credit_note = map_refund_to_credit_note(payload, original)
+        if not credit_note:
+            logger.info(f"Refund {refund_id} has no refunded line items (e.g. shipping only). Skipping.")
+            return
+
+        result = transmit_and_record(credit_note, order_id, topic="refunds/create")
+
+        if not result.get("success"):
+            raise TransmissionFailed(f"AADE did not accept the credit note: {result.get('error')}")
+        logger.info(f"Sent credit note for refund {refund_id} to AADE. Mark: {result.get('mark')}")
+
+    except Exception as e:
+        # Propagated so the router counts the failure and Shopify retries the delivery
+        logger.error(f"Error processing AADE credit note for refund {refund_id}: {e}")
+        raise
+
+def _aa_key(aa: Any):
+    return (0, int(aa), "") if str(aa).isdigit() else (1, 0, str(aa))
+
+def pick_original(entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """The order's first issued invoice (issue date, then series and number), whatever the query order."""
+    return min(entries, key=lambda e: (e.get("issue_date") or "", e.get("series") or "", _aa_key(e.get("aa")), e.get("uid") or ""))
+
+def map_refund_to_credit_note(refund: Dict[str, Any], original: Dict[str, Any]) -> Optional[AADEInvoice]:
+    """
+    Maps a Shopify Refund JSON plus the ledger entry of the original invoice
+    to a credit note. Retail receipts are credited with 11.4, invoices with 5.1.
+    """
+    rows = []
+    total_net = 0.0
+    total_vat = 0.0
+
+    for line_number, refund_line in enumerate(refund.get("refund_line_items", []), start=1):
+        line_item = refund_line.get("line_item", {})
+        quantity = int(refund_line.get("quantity", 0))
+
+        # Same simplification as the sale: 'price' is treated as NET
+        net_value = float(line_item.get("price", "0.0")) * quantity
+        row = build_row(line_number, net_value)
+        rows.append(row)
+        total_net += row.net_value
+        total_vat += row.vat_amount
+
+    if not rows:
+        return None
+
+    if original.get("invoice_type") == InvoiceType.RETAIL_RECEIPT.value:
+        invoice_type = InvoiceType.RETAIL_CREDIT_NOTE
+        counterpart = None
+    else:
+        invoice_type = InvoiceType.CREDIT_NOTE
+        counterpart = Party(
+            vat_number=original.get("counterpart_vat"),
+            country=original.get("counterpart_country") or "GR"
+        )
+
+    mark = original.get("mark")
+    now = datetime.datetime.now()
+
+    return AADEInvoice(
+        uid=f"refund-{refund.get('id')}",
+        issuer=issuer_party(),
+        counterpart=counterpart,
+        invoice_type=invoice_type,
+        issue_date=now.date(),
+        currency=original.get("currency", "EUR"),
+        rows=rows,
+        summary=InvoiceSummary(
+            total_net_value=total_net,
+            total_vat_amount=total_vat,
+            total_gross_value=total_net + total_vat
+        ),
+        correlated_invoices=[mark] if isinstance(mark, int) else []
+    )
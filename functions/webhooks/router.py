@@ -0,0 +1,87 @@
+import importlib
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from telemetry import registry, span
+
+# Webhook Router
+# Dispatches admitted Shopify deliveries on X-Shopify-Topic. Handlers are
+# registered as "module:function" strings and imported on first use, so an
+# instance that only ever receives orders/paid never loads the refund or
+# cancellation code.
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookRouter:
+    def __init__(self):
+        self._targets: Dict[str, str] = {}
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    def register(self, topic: str, target: str):
+        """Registers a lazily imported handler, e.g. "webhooks.refunds:handle_refund_created"."""
+        self._targets[topic] = target
+
+    @property
+    def topics(self):
+        return sorted(self._targets)
+
+    def handler_for(self, topic: str) -> Optional[Callable[[Dict[str, Any]], Any]]:
+        handler = self._handlers.get(topic)
+        if handler is None and topic in self._targets:
+            with self._lock:
+                handler = self._handlers.get(topic)
+                if handler is None:
+                    module_name, func_name = self._targets[topic].split(":")
+                    handler = getattr(importlib.import_module(module_name), func_name)
+                    self._handlers[topic] = handler
+        return handler
+
+    def dispatch(self, topic: str, payload: Dict[str, Any]) -> bool:
+        """Runs the topic's handler. Returns False if no handler is registered."""
+        handler = self.handler_for(topic)
+        if handler is None:
+            registry.counter("webhook.unrouted").inc()
+            logger.warning(f"No webhook handler registered for topic '{topic}'")
+            return False
+
+        registry.counter(f"webhook.{topic}.received").inc()
+        try:
+            with span("webhook.handle", topic=topic) as s:
+                handler(payload)
+            registry.histogram(f"webhook.{topic}.duration_ms").observe(s.duration_ms)
+            registry.counter(f"webhook.{topic}.processed").inc()
+        except Exception:
+            registry.counter(f"webhook.{topic}.failed").inc()
+            raise
+        return True
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-topic counters and average throughput since instance start."""
+        uptime_min = max((time.time() - self._started) / 60.0, 1e-9)
+        stats = {}
+        for topic in self.topics:
+            received = registry.counter(f"webhook.{topic}.received").value
+            stats[topic] = {
+                "received": int(received),
+                "processed": int(registry.counter(f"webhook.{topic}.processed").value),
+                "failed": int(registry.counter(f"webhook.{topic}.failed").value),
+                "per_minute": round(received / uptime_min, 2),
+                "loaded": topic in self._handlers,
+            }
+        return stats
+
+
+router = WebhookRouter()
+router.register("orders/create", "webhooks.shopify:handle_order_created")
+router.register("orders/paid", "webhooks.shopify:handle_order_paid")
+router.register("orders/cancelled", "webhooks.cancellations:handle_order_cancelled")
+router.register("refunds/create", "webhooks.refunds:handle_refund_created")
+router.register("products/create", "shopify.mirror:handle_product_update")
+router.register("products/update", "shopify.mirror:handle_product_update")
+router.register("products/delete", "shopify.mirror:handle_product_delete")
+router.register("inventory_levels/update", "shopify.mirror:handle_inventory_level_update")
@@ -2,9 +2,11 @@ import logging
 import datetime
 from typing import Dict, Any, Optional
 
+from aade.ledger import InvoiceLedger
 from aade.types import AADEInvoice, InvoiceType, Party, InvoiceRow, InvoiceSummary
-from aade.invoice_generator import InvoiceGenerator
-from aade.invoice_transmitter import InvoiceTransmitter
+from telemetry import span
+from webhooks.admission import is_redelivery
+from webhooks.transmission import TransmissionFailed, transmit_and_record
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -19,30 +21,73 @@ def handle_order_paid(payload: Dict[str, Any]):
     order_name = payload.get("name")
     
     logger.info(f"Processing paid order: {order_name} ({order_id})")
-    
+
     try:
+        # A redelivery after an attempt that transmitted but never marked the
+        # delivery done (crash, timeout) must not issue a second invoice
+        if is_redelivery() and InvoiceLedger().find_for_order(
+                order_id, [InvoiceType.SALES_INVOICE, InvoiceType.RETAIL_RECEIPT]):
+            logger.info(f"Order {order_name} already has a transmitted invoice. Skipping.")
+            return
+
         # 1. Map Shopify Order to AADE Invoice
-        invoice = map_shopify_to_aade(payload)
+        with span("webhook.map_invoice"):
+            invoice = map_shopify_to_aade(payload)
         
         if not invoice:
             logger.warning(f"Could not map order {order_name} to AADE Invoice. Skipping.")
             return
             
-        # 2. Transmit to AADE
-        transmitter = InvoiceTransmitter()
-        result = transmitter.submit_invoice_sync(invoice) # We'll add a sync wrapper or use async properly
+        # 2. Transmit to AADE (and record in the invoice ledger)
+        result = transmit_and_record(invoice, order_id, order_name, topic="orders/paid")
         
-        # Note: In a real Cloud Function, we might need to handle async loops properly if using httpx async
-        # For now, assuming we might need to patch result or run async.
-        # Let's see if we can just log for now as the user asked for "Development" mode.
-        
-        if result.get("success"):
-            logger.info(f"Successfully sent invoice for {order_name} to AADE. Mark: {result.get('mark')}")
-        else:
-            logger.error(f"Failed to send invoice for {order_name}: {result.get('error')}")
-            
+        if not result.get("success"):
+            raise TransmissionFailed(f"AADE did not accept the invoice: {result.get('error')}")
+        logger.info(f"Successfully sent invoice for {order_name} to AADE. Mark: {result.get('mark')}")
+
     except Exception as e:
+        # Propagated so the router counts the failure and Shopify retries the delivery
         logger.error(f"Error processing AADE for order {order_name}: {e}")
+        raise
+    finally:
+        # Only once the invoice is out, so it never delays it; the basket is
+        # keyed by order, so recording it again on a retry is harmless
+        record_co_purchase(payload)
+
+def record_co_purchase(payload: Dict[str, Any]):
+    """Stores the order's products for the bundle graph's co-purchase signal (best effort)."""
+    try:
+        from firebase_admin import firestore
+        from ai.bundle_graph import record_basket
+        with span("webhook.record_basket"):
+            record_basket(firestore.client(), payload)
+    except Exception as e:
+        logger.warning(f"Could not record basket for order {payload.get('name')}: {e}")
+
+def handle_order_created(payload: Dict[str, Any]):
+    """
+    Handles 'orders/create' webhook from Shopify.
+    No fiscal document is issued until the order is paid; we only log it.
+    """
+    logger.info(f"Order created: {payload.get('name')} ({payload.get('id')}), "
+                f"financial status: {payload.get('financial_status')}")
+
+def issuer_party() -> Party:
+    """Our own company as the invoice issuer."""
+    return Party(
+        vat_number="000000000", # Replace with YOUR Company VAT
+        country="GR",
+        branch=0
+    )
+
+def build_row(line_number: int, net_value: float) -> InvoiceRow:
+    """Invoice row at the standard rate (simplified: 24% VAT on the net value)."""
+    return InvoiceRow(
+        line_number=line_number,
+        net_value=net_value,
+        vat_category=1, # 1=24%
+        vat_amount=net_value * 0.24
+    )
 
 def map_shopify_to_aade(order: Dict[str, Any]) -> Optional[AADEInvoice]:
     """
@@ -54,11 +99,7 @@ def map_shopify_to_aade(order: Dict[str, Any]) -> Optional[AADEInvoice]:
     billing_address = order.get("billing_address", {})
     company = billing_address.get("company")
     
-    issuer = Party(
-        vat_number="000000000", # Replace with YOUR Company VAT
-        country="GR",
-        branch=0
-    )
+    issuer = issuer_party()
     
     if company:
         # Business Invoice
@@ -117,18 +158,10 @@ def map_shopify_to_aade(order: Dict[str, Any]) -> Optional[AADEInvoice]:
         # Better: Use the 'pre_tax_price' if available, otherwise calculate.
         # For this MVP -> We will assume 'price' is NET for now to verify data flow.
         net_value = price * quantity
-        vat_rate_val = 0.24 
-        vat_amount = net_value * vat_rate_val
-        
-        row = InvoiceRow(
-            line_number=line_number,
-            net_value=net_value,
-            vat_category=1, # 1=24%
-            vat_amount=vat_amount
-        )
+        row = build_row(line_number, net_value)
         rows.append(row)
-        total_net += net_value
-        total_vat += vat_amount
+        total_net += row.net_value
+        total_vat += row.vat_amount
         line_number += 1
         
     # 3. Summary
@@ -148,8 +181,6 @@ def map_shopify_to_aade(order: Dict[str, Any]) -> Optional[AADEInvoice]:
         issuer=issuer,
         counterpart=counterpart,
         invoice_type=invoice_type,
-        series="A",
-        aa=str(order.get("order_number")),
         issue_date=now.date(),
         currency=order.get("currency", "EUR"),
         rows=rows,
@@ -0,0 +1,52 @@
+import logging
+from typing import Any, Dict, Optional
+
+from aade.types import AADEInvoice
+from aade.invoice_transmitter import InvoiceTransmitter
+from aade.ledger import InvoiceLedger
+from aade.numbering import assign_number, record_rejected
+from telemetry import span
+
+# Shared AADE transmission path for every webhook topic:
+# number the invoice, send it, then record the outcome in the invoice ledger.
+# A number AADE rejected (or XSD validation refused) is recorded as a gap in
+# its series; a retry of the order is numbered again.
+# Sends are queued on the process-wide AADE runtime (aade/runtime.py), but the
+# webhook waits for the result: Shopify is only acknowledged once the invoice
+# is transmitted and recorded, so an instance shutting down cannot lose one.
+# Handlers raise TransmissionFailed when AADE did not accept the document, so
+# the delivery is not marked done and Shopify retries it.
+
+logger = logging.getLogger(__name__)
+
+_transmitter: Optional[InvoiceTransmitter] = None
+
+
+class TransmissionFailed(Exception):
+    """AADE did not accept an invoice, credit note or cancellation."""
+
+
+def get_transmitter() -> InvoiceTransmitter:
+    """One transmitter per instance (credentials are read once)."""
+    global _transmitter
+    if _transmitter is None:
+        _transmitter = InvoiceTransmitter()
+    return _transmitter
+
+
+def transmit_and_record(invoice: AADEInvoice, order_id: Any, order_name: Optional[str] = None,
+                        topic: Optional[str] = None) -> Dict[str, Any]:
+    if invoice.aa is None:
+        assign_number(invoice)
+
+    with span("webhook.transmit_aade", invoice_type=invoice.invoice_type.value) as s:
+        result = get_transmitter().submit_invoice_sync(invoice)
+        s.set(success=bool(result.get("success")))
+    if not result.get("success"):
+        record_rejected(invoice, result.get("error"))
+
+    try:
+        InvoiceLedger().record(invoice, order_id, result, order_name=order_name, source_topic=topic)
+    except Exception as e:
+        logger.error(f"Could not record invoice {invoice.uid} for order {order_id} in ledger: {e}")
+    return result